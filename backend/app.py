@@ -1,10 +1,14 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file, stream_with_context, g
 from flask_cors import CORS
 import os
 import logging
 import json
+import uuid
+import hmac
 from werkzeug.utils import secure_filename
 import sys
+from functools import wraps
+from urllib.parse import quote
 
 # Добавляем путь к модулям
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -12,7 +16,17 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 # Импортируем модули
 from modules.character_generator import CharacterGenerator
 from modules.scene_generator import SceneGenerator
+from modules.bulk_importer import BulkImporter, BulkImportError
 from utils.dependency_manager import DependencyManager
+from utils.image_utils import image_encoder
+from utils.pose_library import PoseLibrary
+from utils.sd_wrapper import StableDiffusionWrapper
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.storage_gc import StorageGC, migrate_flat_layout
+from utils.comic_export import ComicExporter
+from utils.jobs import JobManager
+from utils.profiler import Profiler
+from utils.storage import path_from_url
 
 app = Flask(__name__)
 CORS(app)
@@ -22,28 +36,134 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Папки для хранения изображений и данных
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 CHARACTERS_FOLDER = os.path.join(UPLOAD_FOLDER, 'characters')
 SCENES_FOLDER = os.path.join(UPLOAD_FOLDER, 'scenes')
 TEMP_FOLDER = os.path.join(UPLOAD_FOLDER, 'temp')
+EXPORT_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache', 'export')
+POSES_FOLDER = os.path.join(UPLOAD_FOLDER, 'poses')
+JOBS_FOLDER = os.path.join(UPLOAD_FOLDER, 'jobs')
+PROFILES_FOLDER = os.path.join(UPLOAD_FOLDER, 'profiles')
 
 # Создаем папки, если они не существуют
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(CHARACTERS_FOLDER, exist_ok=True)
 os.makedirs(SCENES_FOLDER, exist_ok=True)
 os.makedirs(TEMP_FOLDER, exist_ok=True)
+os.makedirs(POSES_FOLDER, exist_ok=True)
 
 # Инициализация менеджера зависимостей
 dependency_manager = DependencyManager()
 
+# Общая обертка Stable Diffusion: модели загружаются один раз на процесс
+sd_wrapper = StableDiffusionWrapper()
+
+# Библиотека поз для ControlNet
+pose_library = PoseLibrary(POSES_FOLDER)
+
 # Инициализация генераторов
-character_generator = CharacterGenerator(CHARACTERS_FOLDER)
-scene_generator = SceneGenerator(SCENES_FOLDER)
+character_generator = CharacterGenerator(CHARACTERS_FOLDER, sd=sd_wrapper)
+scene_generator = SceneGenerator(
+    SCENES_FOLDER,
+    characters=character_generator.characters,
+    sd=sd_wrapper,
+    poses=pose_library
+)
+
+# Перенос файлов из плоских папок в шардированную структуру (однократно)
+migrate_flat_layout(CHARACTERS_FOLDER, character_generator.characters, CharacterGenerator.URL_PREFIX)
+migrate_flat_layout(SCENES_FOLDER, scene_generator.scenes, SceneGenerator.URL_PREFIX)
+
+# Экспорт комиксов в CBZ/PDF с кэшем перекодированных страниц
+comic_exporter = ComicExporter.from_env(EXPORT_CACHE_FOLDER)
+
+# Фоновые задачи (пакетный импорт): состояние и результаты в uploads/jobs
+job_manager = JobManager(JOBS_FOLDER, workers=max(1, int(os.environ.get('BULK_WORKERS', 2))))
+
+# Фоновая очистка uploads: запускается в рабочем процессе при первом запросе
+storage_gc = StorageGC.from_env(UPLOAD_FOLDER, character_generator, scene_generator, TEMP_FOLDER, job_manager)
+
+# Профилирование по запросу: включается только при заданном PROFILING_TOKEN
+profiler = Profiler.from_env(PROFILES_FOLDER)
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+
+def profiling_authorized(token):
+    return bool(PROFILING_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILING_TOKEN)
+
+@app.before_request
+def start_background_tasks():
+    if os.environ.get('GC_ENABLED', '1') == '1':
+        storage_gc.start()
+    if PROFILING_TOKEN and os.environ.get('PROFILE_CONTINUOUS') == '1':
+        profiler.start_continuous()
+
+@app.before_request
+def start_request_profile():
+    # CORS preflight браузера не должен расходовать отметку, предназначенную настоящему запросу
+    if request.method == 'OPTIONS':
+        return
+    # Заголовок X-Profile с токеном или запрос, заранее отмеченный через /api/admin/profiling/arm
+    if profiling_authorized(request.headers.get('X-Profile')) or (PROFILING_TOKEN and profiler.take_armed(request.path)):
+        g.profile_id = profiler.start_request({"method": request.method, "path": request.path})
+
+@app.after_request
+def add_profile_header(response):
+    profile_id = g.get('profile_id')
+    if profile_id:
+        response.headers['X-Profile-Id'] = profile_id
+        # Статус попадает в профиль: отказ допуска (429) не спутать с генерацией
+        g.profile_status = response.status_code
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    if g.get('profile_id'):
+        profiler.stop_request({"status": g.get('profile_status', 500)})
+
+# Допуск к генерации: лимиты на клиента и справедливая очередь
+admission = AdmissionController.from_env()
+
+def client_key():
+    """Идентификатор клиента для лимитов: API-ключ или IP-адрес"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+def admission_required(kind="interactive"):
+    """
+    Декоратор для роутов, запускающих генерацию.
+    Вместо накопления запросов отвечает 429 с заголовком Retry-After.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                with admission.admit(client_key(), kind):
+                    return view(*args, **kwargs)
+            except AdmissionRejected as e:
+                return _rejected_response(e)
+        return wrapper
+    return decorator
+
+def _rejected_response(e):
+    """Ответ 429 с заголовком Retry-After"""
+    response = jsonify({"error": e.reason, "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# Пакетный импорт персонажей
+bulk_importer = BulkImporter.from_env(character_generator, job_manager, admission, TEMP_FOLDER)
 
 # Роуты для статуса зависимостей
 @app.route('/api/status', methods=['GET'])
 def get_status():
     status = dependency_manager.get_status()
+    status["admission"] = admission.status()
+    status["storage_gc"] = storage_gc.last_run
+    if sd_wrapper.remote:
+        status["remote_backends"] = sd_wrapper.remote.status()
     return jsonify(status)
 
 @app.route('/api/dependencies/install', methods=['POST'])
@@ -59,6 +179,7 @@ def get_characters():
     return jsonify(characters)
 
 @app.route('/api/characters', methods=['POST'])
+@admission_required()
 def create_character():
     # Получаем текстовое описание из запроса
     data = request.form.to_dict()
@@ -70,7 +191,8 @@ def create_character():
         file = request.files['reference_image']
         if file.filename:
             # Сохраняем изображение во временной папке
-            filename = secure_filename(file.filename)
+            # Уникальный префикс: параллельные загрузки с одинаковым именем не перезапишут друг друга
+            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
             filepath = os.path.join(TEMP_FOLDER, filename)
             file.save(filepath)
             reference_image = filepath
@@ -79,6 +201,52 @@ def create_character():
     character = character_generator.generate(description, reference_image)
     return jsonify(character)
 
+@app.route('/api/characters/bulk', methods=['POST'])
+def bulk_create_characters():
+    """
+    Пакетное создание персонажей. Тело - NDJSON или ZIP с манифестом,
+    ответ - NDJSON: заголовок задачи, результаты по элементам по мере готовности
+    и итоговая строка. Прогресс также доступен через /api/jobs/<job_id>.
+    """
+    # Пакет списывает один токен лимита клиента, элементы делят очередь с весом "bulk"
+    try:
+        admission.charge(client_key())
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    
+    try:
+        items = bulk_importer.parse(request.stream, request.mimetype)
+    except BulkImportError as e:
+        return jsonify({"error": str(e)}), e.status
+    
+    job = job_manager.create("character_import", total=len(items))
+    results = bulk_importer.start(job, items, client_key())
+    
+    def generate():
+        yield json.dumps({"job_id": job['id'], "total": len(items)}) + "\n"
+        for result in job_manager.stream(results):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        yield json.dumps(job_manager.get(job['id']), ensure_ascii=False) + "\n"
+    
+    # Клиент может отключиться - задача при этом продолжит выполняться
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/results', methods=['GET'])
+def get_job_results(job_id):
+    if job_manager.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    path = job_manager.results_path(job_id)
+    if not os.path.exists(path):
+        return Response('', mimetype='application/x-ndjson')
+    return send_file(path, mimetype='application/x-ndjson')
+
 @app.route('/api/characters/<character_id>', methods=['PUT'])
 def update_character(character_id):
     data = request.form.to_dict()
@@ -89,7 +257,8 @@ def update_character(character_id):
         file = request.files['new_image']
         if file.filename:
             # Сохраняем изображение во временной папке
-            filename = secure_filename(file.filename)
+            # Уникальный префикс: параллельные загрузки с одинаковым именем не перезапишут друг друга
+            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
             filepath = os.path.join(TEMP_FOLDER, filename)
             file.save(filepath)
             new_image = filepath
@@ -101,36 +270,233 @@ def update_character(character_id):
     else:
         return jsonify({"error": "Character not found"}), 404
 
+@app.route('/api/characters/<character_id>/similar', methods=['GET'])
+def get_similar_characters(character_id):
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    max_distance = min(max(request.args.get('max_distance', 24, type=int), 0), 64)
+    similar = character_generator.similar(character_id, limit=limit, max_distance=max_distance)
+    if similar is None:
+        return jsonify({"error": "Character not found"}), 404
+    return jsonify(similar)
+
+def _get_strength(data, env_name, default):
+    """Сила изменения для генерации из латентов: доля выполняемых шагов"""
+    try:
+        strength = float(data.get('strength', os.environ.get(env_name, default)))
+    except (TypeError, ValueError):
+        strength = default
+    return min(max(strength, 0.05), 1.0)
+
+@app.route('/api/characters/<character_id>/variations', methods=['POST'])
+@admission_required()
+def create_character_variation(character_id):
+    data = request.get_json(silent=True) or {}
+    strength = _get_strength(data, 'VARIATION_STRENGTH', 0.35)
+    
+    character = character_generator.create_variation(character_id, strength)
+    if character:
+        return jsonify(character)
+    else:
+        return jsonify({"error": "Character not found"}), 404
+
+@app.route('/api/characters/<character_id>/edit', methods=['POST'])
+@admission_required()
+def edit_character(character_id):
+    data = request.get_json(silent=True) or {}
+    description = data.get('description')
+    if not description:
+        return jsonify({"error": "Description is required"}), 400
+    strength = _get_strength(data, 'EDIT_STRENGTH', 0.6)
+    
+    character = character_generator.edit_description(character_id, description, strength)
+    if character:
+        return jsonify(character)
+    else:
+        return jsonify({"error": "Character not found"}), 404
+
 @app.route('/api/characters/<character_id>', methods=['DELETE'])
 def delete_character(character_id):
     result = character_generator.delete(character_id)
     if result:
+        # Сцены персонажа удаляются, из общих сцен с другими персонажами он исключается
+        scene_generator.delete_for_character(character_id)
         return jsonify({"success": True})
     else:
         return jsonify({"error": "Character not found"}), 404
 
 # Роуты для генерации сюжетных изображений
 @app.route('/api/scenes', methods=['POST'])
+@admission_required()
 def create_scene():
     data = request.json
     character_id = data.get('character_id')
     plot_description = data.get('plot_description', '')
+    pose_id = data.get('pose_id')
+    # Несколько персонажей: [{"character_id": ..., "region": "left" | [x0, y0, x1, y1]}]
+    characters = data.get('characters')
+    if characters is not None and not isinstance(characters, list):
+        return jsonify({"error": "characters must be a list"}), 400
     
-    scene = scene_generator.generate(character_id, plot_description)
+    scene = scene_generator.generate(character_id, plot_description, pose_id, characters=characters)
     if scene:
         return jsonify(scene)
     else:
         return jsonify({"error": "Failed to generate scene"}), 400
 
+@app.route('/api/scenes/<scene_id>/variations', methods=['POST'])
+@admission_required()
+def create_scene_variation(scene_id):
+    data = request.get_json(silent=True) or {}
+    strength = _get_strength(data, 'VARIATION_STRENGTH', 0.4)
+    
+    scene = scene_generator.create_variation(scene_id, data.get('plot_description'), strength)
+    if scene:
+        return jsonify(scene)
+    else:
+        return jsonify({"error": "Scene not found"}), 404
+
+# Роуты для экспорта комиксов
+EXPORT_FORMATS = {
+    "cbz": ("application/vnd.comicbook+zip", "stream_cbz"),
+    "pdf": ("application/pdf", "stream_pdf"),
+}
+
+def _export_response(scenes, title, export_format, cover=None):
+    """Отдает архив потоком по мере сборки"""
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "Unsupported format"}), 400
+    
+    pages = [cover] if cover else []
+    pages += [path_from_url(SCENES_FOLDER, scene['image_url']) for scene in scenes]
+    for page in pages:
+        image_encoder.wait(page)
+    pages = [page for page in pages if os.path.exists(page)]
+    if not pages:
+        return jsonify({"error": "Nothing to export"}), 404
+    
+    mimetype, method = EXPORT_FORMATS[export_format]
+    stream = getattr(comic_exporter, method)(pages, title)
+    filename = secure_filename(title) or "comic"
+    # filename* сохраняет название на кириллице для браузеров, которые его поддерживают
+    disposition = (
+        f'attachment; filename="{filename}.{export_format}"; '
+        f"filename*=UTF-8''{quote(title)}.{export_format}"
+    )
+    return Response(
+        stream_with_context(stream),
+        mimetype=mimetype,
+        headers={"Content-Disposition": disposition}
+    )
+
+@app.route('/api/characters/<character_id>/export', methods=['GET'])
+def export_character(character_id):
+    character = character_generator.get_character(character_id)
+    if character is None:
+        return jsonify({"error": "Character not found"}), 404
+    
+    scenes = sorted(
+        (scene for scene in scene_generator.scenes.values() if character_id in scene_generator.scene_character_ids(scene)),
+        key=lambda scene: scene['created_at']
+    )
+    cover = character_generator.image_path(character) if request.args.get('cover', '1') == '1' else None
+    title = character.get('description', '')[:60] or character_id
+    return _export_response(scenes, title, request.args.get('format', 'cbz').lower(), cover)
+
+@app.route('/api/export', methods=['POST'])
+def export_storyboard():
+    data = request.get_json(silent=True) or {}
+    scenes = []
+    for scene_id in data.get('scene_ids', []):
+        scene = scene_generator.scenes.get(scene_id)
+        if scene is None:
+            return jsonify({"error": f"Scene not found: {scene_id}"}), 404
+        scenes.append(scene)
+    return _export_response(scenes, data.get('title', 'storyboard'), data.get('format', 'cbz').lower())
+
+# Роуты для библиотеки поз
+@app.route('/api/poses', methods=['GET'])
+def get_poses():
+    return jsonify(pose_library.list_poses())
+
+@app.route('/api/poses', methods=['POST'])
+def create_pose():
+    if 'image' not in request.files or not request.files['image'].filename:
+        return jsonify({"error": "Image is required"}), 400
+    
+    file = request.files['image']
+    filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+    filepath = os.path.join(TEMP_FOLDER, filename)
+    file.save(filepath)
+    
+    # Поза извлекается один раз и хранится как ключевые точки
+    pose = pose_library.add_pose(request.form.get('name', ''), filepath)
+    if pose:
+        return jsonify(pose)
+    else:
+        return jsonify({"error": "Failed to extract pose"}), 400
+
+# Роуты профилирования
+def profiling_admin_required(view):
+    """Доступ к профилям только с токеном в заголовке X-Profiling-Token"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not PROFILING_TOKEN:
+            return jsonify({"error": "Profiling is disabled"}), 404
+        if not profiling_authorized(request.headers.get('X-Profiling-Token')):
+            return jsonify({"error": "Invalid profiling token"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@profiling_admin_required
+def list_profiles():
+    return jsonify({"profiles": profiler.list_profiles(), "status": profiler.status()})
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@profiling_admin_required
+def get_profile(profile_id):
+    # collapsed - для flamegraph.pl/speedscope, trace - для chrome://tracing
+    profile_format = request.args.get('format', 'collapsed')
+    path = profiler.profile_file(profile_id, profile_format)
+    if path is None:
+        return jsonify({"error": "Profile not found"}), 404
+    mimetype = 'text/plain' if profile_format == 'collapsed' else 'application/json'
+    return send_file(path, mimetype=mimetype)
+
+@app.route('/api/admin/profiling/arm', methods=['POST'])
+@profiling_admin_required
+def arm_profiling():
+    data = request.get_json(silent=True) or {}
+    path = data.get('path', '/api/scenes')
+    profiler.arm(path, int(data.get('count', 1)))
+    return jsonify(profiler.status())
+
+@app.route('/api/admin/profiling/continuous', methods=['GET'])
+@profiling_admin_required
+def get_continuous_profile():
+    return Response(profiler.continuous_profile(), mimetype='text/plain')
+
+@app.route('/api/admin/profiling/continuous', methods=['POST'])
+@profiling_admin_required
+def set_continuous_profiling():
+    data = request.get_json(silent=True) or {}
+    profiler.set_continuous(bool(data.get('enabled', True)))
+    return jsonify(profiler.status())
+
 # Роуты для получения изображений
 @app.route('/uploads/characters/<path:filename>')
 def character_image(filename):
+    # Изображение может еще кодироваться в фоне
+    image_encoder.wait(os.path.join(CHARACTERS_FOLDER, filename))
     return send_from_directory(CHARACTERS_FOLDER, filename)
 
 @app.route('/uploads/scenes/<path:filename>')
 def scene_image(filename):
+    image_encoder.wait(os.path.join(SCENES_FOLDER, filename))
     return send_from_directory(SCENES_FOLDER, filename)
 
 if __name__ == '__main__':
-    print("Starting Flask app...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Встроенный сервер Flask - только для разработки.
+    # Для production используйте serve.py (python -m backend.serve)
+    print("Starting Flask development server...")
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000)
\ No newline at end of file
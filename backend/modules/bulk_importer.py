@@ -0,0 +1,306 @@
+import os
+import io
+import json
+import time
+import uuid
+import base64
+import shutil
+import logging
+import zipfile
+from concurrent.futures import as_completed
+from PIL import Image
+from utils.admission import AdmissionRejected
+from utils.image_utils import image_encoder
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+# Строка манифеста, которую не удалось разобрать как JSON
+_INVALID_JSON = object()
+
+
+class BulkImportError(Exception):
+    """
+    Пакет целиком не может быть принят (неверный формат, слишком много элементов).
+    status - HTTP-статус ответа.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class BulkImporter:
+    """
+    Пакетный импорт персонажей.
+
+    Принимает NDJSON (по персонажу в строке, референс - base64) или ZIP-архив
+    с манифестом manifest.ndjson / manifest.json и изображениями. Тело запроса
+    читается потоком: референсы сразу пишутся во временную папку, архив -
+    во временный файл, в памяти остается только список описаний.
+
+    Генерация идет фоновой задачей порциями по chunk_size: элементы порции
+    генерируются параллельно в пуле задач (каждый проходит допуск как "bulk"),
+    метаданные порции сохраняются одной записью в журнал, после чего
+    результаты по элементам отдаются клиенту.
+    """
+    MANIFEST_NAMES = ('manifest.ndjson', 'manifest.jsonl', 'manifest.json')
+    NDJSON_TYPES = {'application/x-ndjson', 'application/ndjson', 'application/jsonl'}
+    ZIP_TYPES = {'application/zip', 'application/x-zip-compressed'}
+
+    def __init__(self, character_generator, jobs, admission, temp_folder,
+                 chunk_size=8, max_items=1000, max_image_bytes=20 * 1024 * 1024):
+        self.character_generator = character_generator
+        self.jobs = jobs
+        self.admission = admission
+        self.temp_folder = temp_folder
+        self.chunk_size = max(1, chunk_size)
+        self.max_items = max_items
+        self.max_image_bytes = max_image_bytes
+
+    @classmethod
+    def from_env(cls, character_generator, jobs, admission, temp_folder):
+        """
+        Настройки из переменных окружения:
+            BULK_CHUNK_SIZE     персонажей в порции (8)
+            BULK_MAX_ITEMS      максимум персонажей в пакете (1000)
+            BULK_MAX_IMAGE_MB   максимальный размер референса, МБ (20)
+        """
+        return cls(
+            character_generator,
+            jobs,
+            admission,
+            temp_folder,
+            chunk_size=int(os.environ.get('BULK_CHUNK_SIZE', 8)),
+            max_items=int(os.environ.get('BULK_MAX_ITEMS', 1000)),
+            max_image_bytes=int(float(os.environ.get('BULK_MAX_IMAGE_MB', 20)) * 1024 * 1024),
+        )
+
+    # --- разбор пакета ---
+
+    def _temp_path(self, suffix):
+        return os.path.join(self.temp_folder, f"{uuid.uuid4().hex}_bulk{suffix}")
+
+    def _check_image(self, path):
+        try:
+            with Image.open(path) as image:
+                image.verify()
+        except Exception:
+            os.remove(path)
+            raise ValueError("reference_image is not a valid image")
+
+    def _item(self, items, index, entry):
+        """
+        Проверяет запись манифеста. Ошибки отдельной записи не отменяют пакет,
+        а попадают в ее результат.
+        """
+        if len(items) >= self.max_items:
+            raise BulkImportError(f"Too many items, maximum is {self.max_items}")
+        item = {"index": index, "ref": None, "description": "", "reference_image": None}
+        if entry is _INVALID_JSON:
+            item["error"] = "Invalid JSON"
+        elif not isinstance(entry, dict):
+            item["error"] = "Item must be a JSON object"
+        else:
+            item["ref"] = entry.get('ref')
+            item["description"] = entry.get('description') or ''
+            if not isinstance(item["description"], str) or not item["description"].strip():
+                item["error"] = "description is required"
+        items.append(item)
+        return item
+
+    def _parse_ndjson(self, stream, items):
+        index = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = _INVALID_JSON
+            item = self._item(items, index, entry)
+            index += 1
+            if item.get("error") or not entry.get('reference_image'):
+                continue
+
+            data = entry['reference_image']
+            if not isinstance(data, str):
+                item["error"] = "reference_image must be base64-encoded image"
+                continue
+            # Допускаем data URL: data:image/png;base64,...
+            if data.startswith('data:'):
+                data = data.split(',', 1)[-1]
+            if len(data) * 3 // 4 > self.max_image_bytes:
+                item["error"] = "reference_image is too large"
+                continue
+            try:
+                content = base64.b64decode(data, validate=True)
+            except ValueError:
+                item["error"] = "reference_image must be base64-encoded image"
+                continue
+            path = self._temp_path('.img')
+            with open(path, 'wb') as f:
+                f.write(content)
+            try:
+                self._check_image(path)
+            except ValueError as e:
+                item["error"] = str(e)
+                continue
+            item["reference_image"] = path
+
+    def _parse_zip(self, stream, items):
+        # ZIP читается с конца (центральный каталог), поэтому архив пишем во временный файл
+        archive_path = self._temp_path('.zip')
+        try:
+            with open(archive_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+            try:
+                archive = zipfile.ZipFile(archive_path)
+            except zipfile.BadZipFile:
+                raise BulkImportError("Invalid ZIP archive")
+
+            with archive:
+                names = set(archive.namelist())
+                manifest_name = next((name for name in self.MANIFEST_NAMES if name in names), None)
+                if manifest_name is None:
+                    raise BulkImportError(f"Manifest not found, expected one of: {', '.join(self.MANIFEST_NAMES)}")
+
+                with archive.open(manifest_name) as manifest:
+                    if manifest_name.endswith('.json'):
+                        try:
+                            entries = json.load(io.TextIOWrapper(manifest, encoding='utf-8'))
+                        except ValueError:
+                            raise BulkImportError("Invalid manifest JSON")
+                        if not isinstance(entries, list):
+                            raise BulkImportError("Manifest must be a JSON array")
+                    else:
+                        entries = []
+                        for line in io.TextIOWrapper(manifest, encoding='utf-8'):
+                            if line.strip():
+                                try:
+                                    entries.append(json.loads(line))
+                                except ValueError:
+                                    entries.append(_INVALID_JSON)
+
+                for index, entry in enumerate(entries):
+                    item = self._item(items, index, entry)
+                    if item.get("error") or not entry.get('reference_image'):
+                        continue
+
+                    name = entry['reference_image']
+                    if not isinstance(name, str) or name not in names:
+                        item["error"] = f"File not found in archive: {name}"
+                        continue
+                    if archive.getinfo(name).file_size > self.max_image_bytes:
+                        item["error"] = "reference_image is too large"
+                        continue
+                    path = self._temp_path(os.path.splitext(name)[1].lower())
+                    with archive.open(name) as source, open(path, 'wb') as target:
+                        shutil.copyfileobj(source, target, CHUNK_SIZE)
+                    try:
+                        self._check_image(path)
+                    except ValueError as e:
+                        item["error"] = str(e)
+                        continue
+                    item["reference_image"] = path
+        finally:
+            try:
+                os.remove(archive_path)
+            except FileNotFoundError:
+                pass
+
+    def parse(self, stream, mimetype):
+        """
+        Читает пакет из потока тела запроса.
+        Возвращает список элементов; при ошибке пакета бросает BulkImportError.
+        """
+        items = []
+        try:
+            if mimetype in self.ZIP_TYPES:
+                self._parse_zip(stream, items)
+            elif mimetype in self.NDJSON_TYPES:
+                self._parse_ndjson(stream, items)
+            else:
+                # Обычный JSON-массив пришлось бы читать в память целиком
+                raise BulkImportError("Content-Type must be application/x-ndjson or application/zip", status=415)
+        except BaseException:
+            self.cleanup(items)
+            raise
+        if not items:
+            raise BulkImportError("No items in request")
+        return items
+
+    def cleanup(self, items):
+        """
+        Удаляет временные файлы референсов
+        """
+        for item in items:
+            if item.get("reference_image"):
+                try:
+                    os.remove(item["reference_image"])
+                except FileNotFoundError:
+                    pass
+                item["reference_image"] = None
+
+    # --- генерация ---
+
+    def _generate(self, item, client):
+        # Лимит клиента списан один раз за весь пакет; элементы проходят только
+        # очередь с весом "bulk" и при ее заполнении ждут, а не получают 429
+        while True:
+            try:
+                with self.admission.admit(client, "bulk", charge=False):
+                    return self.character_generator.generate(
+                        item["description"], item["reference_image"], commit=False
+                    )
+            except AdmissionRejected as e:
+                time.sleep(e.retry_after)
+
+    def _run_chunk(self, chunk, client):
+        results = []
+        characters = {}
+        futures = {}
+        for item in chunk:
+            if item.get("error"):
+                results.append({"index": item["index"], "ref": item["ref"], "status": "error", "error": item["error"]})
+            else:
+                futures[self.jobs.submit(self._generate, item, client)] = item
+
+        for future in as_completed(futures):
+            item = futures[future]
+            result = {"index": item["index"], "ref": item["ref"]}
+            try:
+                character = future.result()
+            except Exception as e:
+                logger.error(f"Ошибка пакетной генерации персонажа {item['index']}: {e}")
+                character = None
+            # Пакет не спешит: прежде чем сообщить об успехе, дожидаемся записи изображения
+            if character and not image_encoder.wait(self.character_generator.image_path(character)):
+                logger.error(f"Изображение пакетного персонажа {item['index']} не записано")
+                self.character_generator.image_index.remove_character(character["id"])
+                character = None
+            if character:
+                characters[character["id"]] = character
+                result.update(status="ok", character=character)
+            else:
+                result.update(status="error", error="Generation failed")
+            results.append(result)
+
+        self.cleanup(chunk)
+        # Одна запись в журнал метаданных на порцию
+        self.character_generator.characters.put_many(characters)
+        return sorted(results, key=lambda r: r["index"])
+
+    def start(self, job, items, client):
+        """
+        Запускает генерацию пакета фоновой задачей.
+        Возвращает очередь результатов для JobManager.stream.
+        """
+        def runner(job, report):
+            try:
+                for start in range(0, len(items), self.chunk_size):
+                    report(self._run_chunk(items[start:start + self.chunk_size], client))
+            finally:
+                self.cleanup(items)
+
+        return self.jobs.start(job, runner)
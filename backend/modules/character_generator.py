@@ -1,41 +1,39 @@
 import os
-import json
 import uuid
-import shutil
 import logging
 from datetime import datetime
 from utils.sd_wrapper import StableDiffusionWrapper
+from utils.storage import MetadataStore, atomic_copy, sharded_path, relative_path, path_from_url
+from utils.image_utils import image_encoder
+from utils.image_hash import ImageHashIndex
 
 logger = logging.getLogger(__name__)
 
 class CharacterGenerator:
-    def __init__(self, output_folder):
+    NEGATIVE_PROMPT = "bad anatomy, bad proportions, blurry, low quality"
+    URL_PREFIX = "/uploads/characters"
+    
+    def __init__(self, output_folder, sd=None):
         self.output_folder = output_folder
         self.metadata_file = os.path.join(output_folder, 'characters_metadata.json')
-        self.sd = StableDiffusionWrapper()
+        self.sd = sd or StableDiffusionWrapper()
         
         # Создаем папку вывода, если не существует
         os.makedirs(output_folder, exist_ok=True)
         
-        # Загружаем существующие метаданные
-        self.load_metadata()
+        # Загружаем существующие метаданные (снапшот + журнал изменений)
+        self.characters = MetadataStore(self.metadata_file)
+        
+        # Перцептивные хэши изображений: дедупликация референсов и поиск похожих
+        self.image_index = ImageHashIndex(os.path.join(output_folder, 'image_index_metadata.json'))
     
     def load_metadata(self):
-        """Загружает метаданные о персонажах из файла"""
-        if os.path.exists(self.metadata_file):
-            try:
-                with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                    self.characters = json.load(f)
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка при чтении файла метаданных: {self.metadata_file}")
-                self.characters = {}
-        else:
-            self.characters = {}
+        """Перечитывает метаданные о персонажах с диска"""
+        self.characters.reload()
     
     def save_metadata(self):
-        """Сохраняет метаданные о персонажах в файл"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.characters, f, ensure_ascii=False, indent=2)
+        """Записывает снапшот метаданных и очищает журнал изменений"""
+        self.characters.compact()
     
     def get_all_characters(self):
         """Возвращает список всех персонажей"""
@@ -45,56 +43,170 @@ class CharacterGenerator:
         """Получает персонажа по ID"""
         return self.characters.get(character_id)
     
-    def generate(self, description, reference_image=None):
+    def file_path(self, character_id, filename):
+        """Путь к файлу персонажа в шардированной структуре папок"""
+        return sharded_path(self.output_folder, character_id, filename)
+    
+    def file_url(self, path):
+        """URL файла персонажа"""
+        return f"{self.URL_PREFIX}/{relative_path(self.output_folder, path)}"
+    
+    def image_path(self, character):
+        """Путь к основному изображению персонажа"""
+        return path_from_url(self.output_folder, character['image_url'])
+    
+    def character_files(self, character):
+        """Все файлы персонажа: изображение, референсы, латенты"""
+        files = [self.image_path(character)]
+        files += [path_from_url(self.output_folder, url) for url in character.get('references', [])]
+        if character.get('latents'):
+            files.append(self.latents_path(character))
+        return files
+    
+    def latents_path(self, character):
+        """Путь к сохраненным латентам персонажа или None"""
+        if not character.get('latents'):
+            return None
+        return os.path.join(self.output_folder, character['latents'])
+    
+    def _index_main_image(self, character_id, image_path, hashes=None):
+        """Добавляет основное изображение персонажа в индекс хэшей"""
+        if hashes is None:
+            hashes = self._main_image_hashes(image_path)
+        self.image_index.add(character_id, self.file_url(image_path), "main", hashes)
+    
+    def _rollback_on_encode_error(self, character_id, image_path, previous=None):
+        """
+        Изображение кодируется в фоне уже после ответа клиенту. Если запись
+        не удастся, новый персонаж удаляется, а измененный получает прежние метаданные.
+        """
+        def rollback(error):
+            logger.error(f"Изображение персонажа {character_id} не записано, изменения отменены: {error}")
+            if previous is None:
+                self.delete(character_id)
+                return
+            self.characters.put(character_id, previous)
+            try:
+                # Прежний файл остался на месте: запись атомарная
+                self._index_main_image(character_id, image_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось переиндексировать персонажа {character_id}: {e}")
+        
+        image_encoder.watch(image_path, rollback)
+    
+    def _main_image_hashes(self, image_path):
+        # Пока изображение кодируется в фоне, хэшируем его копию в памяти, не дожидаясь записи
+        image = image_encoder.peek(image_path)
+        if image is None:
+            image = image_encoder.load(image_path)
+        return self.image_index.compute(image_path, image, digest=False)
+    
+    def index_missing(self):
+        """
+        Индексирует персонажей, созданных до появления индекса хэшей.
+        Возвращает число проиндексированных персонажей.
+        """
+        indexed = 0
+        batch = {}
+        for character_id, character in self.characters.items():
+            if self.image_index.has_character(character_id):
+                continue
+            try:
+                images = [(character['image_url'], "main", self._main_image_hashes(self.image_path(character)))]
+                for url in character.get('references', []):
+                    path = path_from_url(self.output_folder, url)
+                    images.append((url, "reference", self.image_index.compute(path)))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось проиндексировать персонажа {character_id}: {e}")
+                continue
+            batch[character_id] = images
+            indexed += 1
+            # Порциями: одна запись в журнал индекса на несколько сотен персонажей
+            if len(batch) >= 500:
+                self.image_index.add_many(batch)
+                batch = {}
+        if batch:
+            self.image_index.add_many(batch)
+        return indexed
+    
+    def similar(self, character_id, limit=10, max_distance=24):
+        """
+        Похожие персонажи по перцептивным хэшам изображений
+        """
+        if character_id not in self.characters:
+            return None
+        result = []
+        for other_id, distance in self.image_index.similar(character_id, limit=limit, max_distance=max_distance):
+            # В индексе могут остаться записи несохраненных персонажей
+            character = self.characters.get(other_id)
+            if character is not None:
+                result.append({"character": character, "distance": distance})
+        return result
+    
+    def _build_prompt(self, description):
+        base_prompt = f"anime character, full body, white background, high quality, detailed"
+        return f"{description}, {base_prompt}"
+    
+    def generate(self, description, reference_image=None, commit=True):
         """
         Генерирует персонажа на основе текстового описания
-        и опционального референсного изображения
+        и опционального референсного изображения.
+        При commit=False метаданные не сохраняются - их записывает вызывающий
+        (пакетный импорт сохраняет порцию персонажей одной операцией)
+        и он же проверяет, что изображение записано.
         """
         # Генерируем уникальный ID для персонажа
         character_id = str(uuid.uuid4())
         timestamp = datetime.now().isoformat()
         
         # Формируем промпт для генерации
-        base_prompt = f"anime character, full body, white background, high quality, detailed"
-        prompt = f"{description}, {base_prompt}"
+        prompt = self._build_prompt(description)
+        latents_path = self.file_path(character_id, f"{character_id}.latents.npz")
         
         # Если есть референсное изображение, используем его
         if reference_image:
             image_path = self._save_character_image(character_id, reference_image, "reference")
             # Генерируем персонажа на основе референса и описания
-            output_path = os.path.join(self.output_folder, f"{character_id}.png")
+            output_path = self.file_path(character_id, image_encoder.filename(character_id))
             success = self.sd.generate_with_reference(
                 prompt=prompt,
                 reference_image=reference_image,
                 output_path=output_path,
-                negative_prompt="bad anatomy, bad proportions, blurry, low quality"
+                negative_prompt=self.NEGATIVE_PROMPT
             )
         else:
             # Генерируем персонажа только на основе описания
-            output_path = os.path.join(self.output_folder, f"{character_id}.png")
+            output_path = self.file_path(character_id, image_encoder.filename(character_id))
             success = self.sd.generate(
                 prompt=prompt,
                 output_path=output_path,
-                negative_prompt="bad anatomy, bad proportions, blurry, low quality"
+                negative_prompt=self.NEGATIVE_PROMPT,
+                latents_path=latents_path
             )
         
         if not success:
             logger.error(f"Не удалось сгенерировать персонажа с описанием: {description}")
+            self.image_index.remove_character(character_id)
             return None
         
+        self._index_main_image(character_id, output_path)
+        
         # Создаем метаданные персонажа
         character = {
             "id": character_id,
             "description": description,
             "created_at": timestamp,
             "updated_at": timestamp,
-            "image_url": f"/uploads/characters/{character_id}.png",
-            "references": [f"/uploads/characters/{character_id}_reference.png"] if reference_image else []
+            "image_url": self.file_url(output_path),
+            "references": [self.file_url(image_path)] if reference_image else [],
+            # Финальные латенты для быстрых вариаций и правок (нет в мок-режиме)
+            "latents": relative_path(self.output_folder, latents_path) if os.path.exists(latents_path) else None
         }
         
         # Сохраняем метаданные
-        self.characters[character_id] = character
-        self.save_metadata()
+        if commit:
+            self.characters.put(character_id, character)
+            self._rollback_on_encode_error(character_id, output_path)
         
         return character
     
@@ -102,10 +214,10 @@ class CharacterGenerator:
         """
         Обновляет данные персонажа и/или заменяет изображение
         """
-        if character_id not in self.characters:
+        character = self.characters.get(character_id)
+        if character is None:
             return None
-        
-        character = self.characters[character_id]
+        previous = self.characters.get(character_id)
         
         # Обновляем описание, если оно предоставлено
         if 'description' in data:
@@ -113,12 +225,104 @@ class CharacterGenerator:
         
         # Обновляем изображение, если оно предоставлено
         if new_image:
-            # Сохраняем новое изображение
-            self._save_character_image(character_id, new_image, "main")
+            hashes = self.image_index.compute(new_image)
+            current = self.image_index.get(character_id, character['image_url'])
+            # Повторная загрузка того же файла - перекодировать нечего
+            if current is None or current.get('source_sha1') != hashes['sha1']:
+                self._save_character_image(character_id, new_image, "main", self.image_path(character))
+                hashes['source_sha1'] = hashes.pop('sha1')
+                hashes['sha1'] = None
+                self._index_main_image(character_id, self.image_path(character), hashes)
+                # Латенты больше не соответствуют изображению
+                character['latents'] = None
         
         # Обновляем временную метку
         character['updated_at'] = datetime.now().isoformat()
-        self.save_metadata()
+        self.characters.put(character_id, character)
+        if new_image:
+            self._rollback_on_encode_error(character_id, self.image_path(character), previous)
+        
+        return character
+    
+    def create_variation(self, character_id, strength=0.35):
+        """
+        Создает нового персонажа - вариацию существующего.
+        Генерация начинается с сохраненных латентов исходного персонажа,
+        поэтому выполняется лишь доля шагов, равная strength.
+        """
+        source = self.characters.get(character_id)
+        if source is None:
+            return None
+        
+        variation_id = str(uuid.uuid4())
+        timestamp = datetime.now().isoformat()
+        output_path = self.file_path(variation_id, image_encoder.filename(variation_id))
+        latents_path = self.file_path(variation_id, f"{variation_id}.latents.npz")
+        
+        success = self.sd.generate_from_latents(
+            prompt=self._build_prompt(source['description']),
+            source_latents_path=self.latents_path(source),
+            output_path=output_path,
+            negative_prompt=self.NEGATIVE_PROMPT,
+            strength=strength,
+            latents_path=latents_path,
+            source_image=self.image_path(source)
+        )
+        
+        if not success:
+            logger.error(f"Не удалось создать вариацию персонажа {character_id}")
+            return None
+        
+        self._index_main_image(variation_id, output_path)
+        
+        character = {
+            "id": variation_id,
+            "description": source['description'],
+            "created_at": timestamp,
+            "updated_at": timestamp,
+            "image_url": self.file_url(output_path),
+            "references": [],
+            "latents": relative_path(self.output_folder, latents_path) if os.path.exists(latents_path) else None,
+            "parent_id": character_id
+        }
+        
+        self.characters.put(variation_id, character)
+        self._rollback_on_encode_error(variation_id, output_path)
+        
+        return character
+    
+    def edit_description(self, character_id, description, strength=0.6):
+        """
+        Меняет описание персонажа и перерисовывает изображение,
+        начиная с его сохраненных латентов
+        """
+        character = self.characters.get(character_id)
+        if character is None:
+            return None
+        # Латенты перезаписываются новыми, к прежнему изображению они уже не подходят
+        previous = dict(character, latents=None)
+        
+        latents_path = self.file_path(character_id, f"{character_id}.latents.npz")
+        success = self.sd.generate_from_latents(
+            prompt=self._build_prompt(description),
+            source_latents_path=self.latents_path(character),
+            output_path=self.image_path(character),
+            negative_prompt=self.NEGATIVE_PROMPT,
+            strength=strength,
+            latents_path=latents_path,
+            source_image=self.image_path(character)
+        )
+        
+        if not success:
+            logger.error(f"Не удалось изменить персонажа {character_id} по описанию: {description}")
+            return None
+        
+        self._index_main_image(character_id, self.image_path(character))
+        character['description'] = description
+        character['latents'] = relative_path(self.output_folder, latents_path) if os.path.exists(latents_path) else None
+        character['updated_at'] = datetime.now().isoformat()
+        self.characters.put(character_id, character)
+        self._rollback_on_encode_error(character_id, self.image_path(character), previous)
         
         return character
     
@@ -126,38 +330,58 @@ class CharacterGenerator:
         """
         Удаляет персонажа и все его изображения
         """
-        if character_id not in self.characters:
+        character = self.characters.get(character_id)
+        if character is None:
             return False
         
         # Удаляем изображения персонажа
-        main_image = os.path.join(self.output_folder, f"{character_id}.png")
+        main_image = self.image_path(character)
+        image_encoder.wait(main_image)
+        image_encoder.forget(main_image)
         if os.path.exists(main_image):
             os.remove(main_image)
         
-        # Удаляем все референсные изображения
-        for ref_pattern in [f"{character_id}_reference.png"]:
-            ref_path = os.path.join(self.output_folder, ref_pattern)
-            if os.path.exists(ref_path):
+        # Удаляем референсные изображения (кроме общих с другими персонажами) и латенты
+        shared = {
+            path_from_url(self.output_folder, url) for url in character.get('references', [])
+            if self.image_index.is_shared(url, character_id)
+        }
+        for ref_path in self.character_files(character)[1:]:
+            if ref_path not in shared and os.path.exists(ref_path):
                 os.remove(ref_path)
         
         # Удаляем метаданные
-        del self.characters[character_id]
-        self.save_metadata()
+        self.characters.delete(character_id)
+        self.image_index.remove_character(character_id)
         
         return True
     
-    def _save_character_image(self, character_id, image_path, image_type="main"):
+    def _save_character_image(self, character_id, image_path, image_type="main", destination=None):
         """
         Сохраняет изображение персонажа в нужную папку
         """
         if image_type == "main":
-            destination = os.path.join(self.output_folder, f"{character_id}.png")
+            # Основное изображение перекодируем в формат вывода
+            destination = destination or self.file_path(character_id, image_encoder.filename(character_id))
+            image_encoder.save(image_encoder.load(image_path), destination)
+            return destination
         elif image_type == "reference":
-            destination = os.path.join(self.output_folder, f"{character_id}_reference.png")
+            hashes = self.image_index.compute(image_path)
+            duplicate_url = self.image_index.find_duplicate(hashes['sha1'])
+            if duplicate_url is not None:
+                existing = path_from_url(self.output_folder, duplicate_url)
+                if os.path.exists(existing):
+                    # Такой же файл уже сохранен - используем его
+                    self.image_index.add(character_id, duplicate_url, "reference", hashes)
+                    return existing
+            destination = self.file_path(character_id, f"{character_id}_reference.png")
+            atomic_copy(image_path, destination)
+            self.image_index.add(character_id, self.file_url(destination), "reference", hashes)
+            return destination
         else:
-            destination = os.path.join(self.output_folder, f"{character_id}_{image_type}.png")
+            destination = self.file_path(character_id, f"{character_id}_{image_type}.png")
         
-        # Копируем или перемещаем файл
-        shutil.copy2(image_path, destination)
+        # Копируем файл атомарно, чтобы не оставить недописанное изображение
+        atomic_copy(image_path, destination)
         
         return destination
\ No newline at end of file
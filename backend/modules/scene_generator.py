@@ -1,102 +1,322 @@
 import os
-import json
 import uuid
 import logging
 from datetime import datetime
 from utils.sd_wrapper import StableDiffusionWrapper
+from utils.storage import MetadataStore, sharded_path, relative_path, path_from_url
+from utils.image_utils import image_encoder
+from utils.profiler import span
 
 logger = logging.getLogger(__name__)
 
 class SceneGenerator:
-    def __init__(self, output_folder):
+    SCENE_WIDTH = 768
+    SCENE_HEIGHT = 512
+    URL_PREFIX = "/uploads/scenes"
+    NEGATIVE_PROMPT = "bad anatomy, bad proportions, blurry, low quality"
+    MAX_CHARACTERS = int(os.environ.get('MAX_SCENE_CHARACTERS', 4))
+    # Области кадра для персонажей: (x0, y0, x1, y1) в долях ширины и высоты
+    REGIONS = {
+        "full": (0.0, 0.0, 1.0, 1.0),
+        "left": (0.0, 0.0, 0.5, 1.0),
+        "right": (0.5, 0.0, 1.0, 1.0),
+        "center": (0.25, 0.0, 0.75, 1.0),
+        "left_third": (0.0, 0.0, 1 / 3, 1.0),
+        "middle_third": (1 / 3, 0.0, 2 / 3, 1.0),
+        "right_third": (2 / 3, 0.0, 1.0, 1.0),
+    }
+    
+    def __init__(self, output_folder, characters=None, sd=None, poses=None):
         self.output_folder = output_folder
         self.metadata_file = os.path.join(output_folder, 'scenes_metadata.json')
-        self.sd = StableDiffusionWrapper()
+        self.sd = sd or StableDiffusionWrapper()
+        self.poses = poses
         self.characters_folder = os.path.dirname(output_folder) + '/characters'
         self.characters_metadata = os.path.join(self.characters_folder, 'characters_metadata.json')
         
         # Создаем папку вывода, если не существует
         os.makedirs(output_folder, exist_ok=True)
         
-        # Загружаем существующие метаданные
-        self.load_metadata()
+        # Загружаем существующие метаданные (снапшот + журнал изменений)
+        self.scenes = MetadataStore(self.metadata_file)
+        
+        # Метаданные о персонажах: общее хранилище генератора персонажей,
+        # чтобы новые персонажи были видны без перезапуска
+        self.characters = characters if characters is not None else MetadataStore(self.characters_metadata)
+    
+    def file_path(self, scene_id, filename):
+        """Путь к файлу сцены в шардированной структуре папок"""
+        return sharded_path(self.output_folder, scene_id, filename)
+    
+    def file_url(self, path):
+        """URL файла сцены"""
+        return f"{self.URL_PREFIX}/{relative_path(self.output_folder, path)}"
+    
+    def scene_files(self, scene):
+        """Все файлы сцены: изображение и латенты"""
+        files = [path_from_url(self.output_folder, scene['image_url'])]
+        if scene.get('latents'):
+            files.append(os.path.join(self.output_folder, scene['latents']))
+        return files
     
     def load_metadata(self):
-        """Загружает метаданные о сценах из файла"""
-        if os.path.exists(self.metadata_file):
-            try:
-                with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                    self.scenes = json.load(f)
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка при чтении файла метаданных: {self.metadata_file}")
-                self.scenes = {}
-        else:
-            self.scenes = {}
-        
-        # Загружаем метаданные о персонажах
-        if os.path.exists(self.characters_metadata):
-            try:
-                with open(self.characters_metadata, 'r', encoding='utf-8') as f:
-                    self.characters = json.load(f)
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка при чтении файла метаданных персонажей: {self.characters_metadata}")
-                self.characters = {}
-        else:
-            self.characters = {}
+        """Перечитывает метаданные о сценах и персонажах с диска"""
+        self.scenes.reload()
+        self.characters.reload()
     
     def save_metadata(self):
-        """Сохраняет метаданные о сценах в файл"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.scenes, f, ensure_ascii=False, indent=2)
+        """Записывает снапшот метаданных и очищает журнал изменений"""
+        self.scenes.compact()
     
-    def generate(self, character_id, plot_description):
+    def scene_character_ids(self, scene):
+        """ID всех персонажей сцены (у старых сцен - только character_id)"""
+        if scene.get('characters'):
+            return [entry['character_id'] for entry in scene['characters']]
+        return [scene['character_id']]
+    
+    def _parse_region(self, region):
         """
-        Генерирует сюжетную сцену с указанным персонажем и описанием сюжета
+        Область персонажа в долях кадра (x0, y0, x1, y1): название из REGIONS
+        или список из четырех чисел. None - если область задана неверно.
         """
-        # Проверяем, существует ли персонаж
-        if character_id not in self.characters:
-            logger.error(f"Персонаж с ID {character_id} не найден")
+        if region is None:
+            return self.REGIONS['full']
+        if isinstance(region, str):
+            return self.REGIONS.get(region)
+        try:
+            x0, y0, x1, y1 = (float(value) for value in region)
+        except (TypeError, ValueError):
+            return None
+        if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+            return None
+        return (x0, y0, x1, y1)
+    
+    def _load_cast(self, characters):
+        """
+        Проверяет персонажей сцены и их области.
+        Возвращает список (персонаж, область, путь к изображению) или None.
+        """
+        if not characters or len(characters) > self.MAX_CHARACTERS:
+            logger.error(f"В сцене должно быть от 1 до {self.MAX_CHARACTERS} персонажей")
             return None
         
-        character = self.characters[character_id]
-        character_image = os.path.join(self.characters_folder, f"{character_id}.png")
+        cast = []
+        for entry in characters:
+            character_id = entry.get('character_id') if isinstance(entry, dict) else None
+            character = self.characters.get(character_id) if character_id else None
+            if character is None:
+                logger.error(f"Персонаж с ID {character_id} не найден")
+                return None
+            region = self._parse_region(entry.get('region'))
+            if region is None:
+                logger.error(f"Неверная область персонажа {character_id}: {entry.get('region')}")
+                return None
+            
+            character_image = path_from_url(self.characters_folder, character['image_url'])
+            # Изображение персонажа могло еще не дописаться в фоне
+            image_encoder.wait(character_image)
+            if not os.path.exists(character_image):
+                logger.error(f"Изображение персонажа не найдено: {character_image}")
+                return None
+            cast.append((character, region, character_image))
+        return cast
+    
+    def _rollback_on_encode_error(self, scene_id, image_path):
+        """
+        Изображение кодируется в фоне уже после ответа клиенту:
+        если запись не удастся, сцена удаляется
+        """
+        def rollback(error):
+            logger.error(f"Изображение сцены {scene_id} не записано, сцена удалена: {error}")
+            self.delete(scene_id)
         
-        if not os.path.exists(character_image):
-            logger.error(f"Изображение персонажа не найдено: {character_image}")
+        image_encoder.watch(image_path, rollback)
+    
+    def _character_prompt(self, character):
+        # Текст не зависит от сцены, поэтому его эмбеддинг кэшируется и переиспользуется
+        return f"{character.get('description', '')}, anime style"
+    
+    def _scene_prompt(self, characters, plot_description):
+        descriptions = " and ".join(character.get('description', '') for character in characters)
+        return f"{descriptions} in {plot_description}, anime style, high quality, detailed"
+    
+    def generate(self, character_id=None, plot_description="", pose_id=None, characters=None):
+        """
+        Генерирует сюжетную сцену с указанным персонажем и описанием сюжета.
+        characters - несколько персонажей: [{"character_id": ..., "region": ...}],
+        region - название области из REGIONS или [x0, y0, x1, y1] в долях кадра.
+        Все персонажи генерируются за один проход диффузии с региональными промптами.
+        pose_id - поза из библиотеки поз для ControlNet
+        """
+        if characters is None:
+            characters = [{"character_id": character_id}]
+        cast = self._load_cast(characters)
+        if cast is None:
             return None
         
+        # Карта позы рисуется из сохраненных ключевых точек (с кэшем)
+        pose_image = None
+        if pose_id:
+            if self.poses is None or not self.poses.has_pose(pose_id):
+                logger.error(f"Поза с ID {pose_id} не найдена")
+                return None
+            with span("render_pose"):
+                pose_image = self.poses.render(pose_id, self.SCENE_WIDTH, self.SCENE_HEIGHT)
+        
         # Генерируем уникальный ID для сцены
         scene_id = str(uuid.uuid4())
         timestamp = datetime.now().isoformat()
         
-        # Формируем промпт для генерации
-        character_description = character.get('description', '')
-        prompt = f"{character_description} in {plot_description}, anime style, high quality, detailed"
+        # Генерируем сцену на основе персонажей и описания сюжета
+        output_path = self.file_path(scene_id, image_encoder.filename(scene_id))
+        latents_path = self.file_path(scene_id, f"{scene_id}.latents.npz")
+        if len(cast) == 1 and cast[0][1] == self.REGIONS['full']:
+            character, _, character_image = cast[0]
+            success = self.sd.generate_scene(
+                prompt=self._scene_prompt([character], plot_description),
+                character_image=character_image,
+                output_path=output_path,
+                negative_prompt=self.NEGATIVE_PROMPT,
+                pose_image=pose_image,
+                width=self.SCENE_WIDTH,
+                height=self.SCENE_HEIGHT,
+                latents_path=latents_path
+            )
+        else:
+            success = self.sd.generate_regional_scene(
+                prompt=f"{plot_description}, anime style, high quality, detailed",
+                regions=[(self._character_prompt(character), region) for character, region, _ in cast],
+                output_path=output_path,
+                negative_prompt=self.NEGATIVE_PROMPT,
+                pose_image=pose_image,
+                width=self.SCENE_WIDTH,
+                height=self.SCENE_HEIGHT,
+                latents_path=latents_path
+            )
+        
+        character_ids = [character['id'] for character, _, _ in cast]
+        if not success:
+            logger.error(f"Не удалось сгенерировать сцену с персонажами {character_ids} и сюжетом: {plot_description}")
+            return None
+        
+        # Создаем метаданные сцены
+        scene = {
+            "id": scene_id,
+            "character_id": character_ids[0],
+            "characters": [
+                {"character_id": character['id'], "region": list(region)} for character, region, _ in cast
+            ],
+            "plot_description": plot_description,
+            "pose_id": pose_id,
+            "created_at": timestamp,
+            "image_url": self.file_url(output_path),
+            "latents": relative_path(self.output_folder, latents_path) if os.path.exists(latents_path) else None
+        }
+        
+        # Сохраняем метаданные
+        self.scenes.put(scene_id, scene)
+        self._rollback_on_encode_error(scene_id, output_path)
+        
+        return scene
+    
+    def create_variation(self, scene_id, plot_description=None, strength=0.4):
+        """
+        Создает вариацию сцены, начиная с ее сохраненных латентов.
+        Можно поменять описание сюжета - композиция кадра сохранится.
+        """
+        source = self.scenes.get(scene_id)
+        if source is None:
+            return None
+        
+        characters = []
+        for character_id in self.scene_character_ids(source):
+            character = self.characters.get(character_id)
+            if character is None:
+                logger.error(f"Персонаж с ID {character_id} не найден")
+                return None
+            characters.append(character)
+        
+        plot_description = plot_description or source['plot_description']
+        prompt = self._scene_prompt(characters, plot_description)
         
-        # Генерируем сцену на основе персонажа и описания сюжета
-        output_path = os.path.join(self.output_folder, f"{scene_id}.png")
-        success = self.sd.generate_scene(
+        variation_id = str(uuid.uuid4())
+        timestamp = datetime.now().isoformat()
+        output_path = self.file_path(variation_id, image_encoder.filename(variation_id))
+        latents_path = self.file_path(variation_id, f"{variation_id}.latents.npz")
+        source_latents = os.path.join(self.output_folder, source['latents']) if source.get('latents') else None
+        
+        success = self.sd.generate_from_latents(
             prompt=prompt,
-            character_image=character_image,
+            source_latents_path=source_latents,
             output_path=output_path,
-            negative_prompt="bad anatomy, bad proportions, blurry, low quality"
+            negative_prompt=self.NEGATIVE_PROMPT,
+            strength=strength,
+            latents_path=latents_path,
+            width=self.SCENE_WIDTH,
+            height=self.SCENE_HEIGHT,
+            source_image=path_from_url(self.output_folder, source['image_url'])
         )
         
         if not success:
-            logger.error(f"Не удалось сгенерировать сцену с персонажем {character_id} и сюжетом: {plot_description}")
+            logger.error(f"Не удалось создать вариацию сцены {scene_id}")
             return None
         
-        # Создаем метаданные сцены
         scene = {
-            "id": scene_id,
-            "character_id": character_id,
+            "id": variation_id,
+            "character_id": source['character_id'],
+            "characters": source.get('characters'),
             "plot_description": plot_description,
+            "pose_id": source.get('pose_id'),
             "created_at": timestamp,
-            "image_url": f"/uploads/scenes/{scene_id}.png"
+            "image_url": self.file_url(output_path),
+            "latents": relative_path(self.output_folder, latents_path) if os.path.exists(latents_path) else None,
+            "parent_id": scene_id
         }
         
-        # Сохраняем метаданные
-        self.scenes[scene_id] = scene
-        self.save_metadata()
+        self.scenes.put(variation_id, scene)
+        self._rollback_on_encode_error(variation_id, output_path)
+        
+        return scene
+    
+    def delete(self, scene_id):
+        """
+        Удаляет сцену и ее файлы
+        """
+        scene = self.scenes.get(scene_id)
+        if scene is None:
+            return False
+        
+        for path in self.scene_files(scene):
+            image_encoder.wait(path)
+            image_encoder.forget(path)
+            if os.path.exists(path):
+                os.remove(path)
+        
+        self.scenes.delete(scene_id)
+        return True
+    
+    def delete_for_character(self, character_id):
+        """
+        Убирает удаленного персонажа из сцен. Сцены, где он единственный
+        или главный персонаж (character_id), удаляются; из общих сцен с другими
+        персонажами он только исключается, и сцены остаются у остальных.
+        Возвращает число удаленных сцен.
+        """
+        deleted = []
+        updated = {}
+        for scene_id, scene in self.scenes.items():
+            if character_id not in self.scene_character_ids(scene):
+                continue
+            if scene['character_id'] == character_id:
+                deleted.append(scene_id)
+            else:
+                scene['characters'] = [
+                    entry for entry in scene['characters'] if entry['character_id'] != character_id
+                ]
+                updated[scene_id] = scene
         
-        return scene
\ No newline at end of file
+        # Общие сцены обновляются одной записью в журнал
+        self.scenes.put_many(updated)
+        for scene_id in deleted:
+            self.delete(scene_id)
+        return len(deleted)
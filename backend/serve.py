@@ -0,0 +1,256 @@
+"""
+Точка входа для production-запуска бэкенда.
+
+Запуск из папки backend:        python serve.py
+Запуск из корня проекта:        python -m backend.serve
+
+Вместо встроенного dev-сервера Flask (reloader, debugger, один поток)
+используется многопоточный WSGI-сервер: gunicorn на Linux/macOS и waitress
+на Windows. Приложение и общее состояние (метаданные, генераторы)
+загружаются один раз до форка воркеров.
+
+Настройки читаются из переменных окружения:
+    SERVE_BACKEND           gunicorn | waitress (по умолчанию - по платформе)
+    SERVE_HOST              адрес (0.0.0.0)
+    SERVE_PORT              порт (5000)
+    SERVE_WORKERS           число процессов gunicorn (1)
+    SERVE_THREADS           число потоков на процесс (16); одновременные генерации
+                            ограничивает GENERATION_SLOTS, остальные потоки ждут
+                            в справедливой очереди
+    SERVE_TIMEOUT           максимальная длительность запроса, сек (300); только gunicorn,
+                            в waitress ограничения длительности запроса нет
+    SERVE_GRACEFUL_TIMEOUT  время на завершение генераций при остановке, сек (120)
+    SERVE_KEEPALIVE         время простоя keep-alive соединения до закрытия, сек (5);
+                            в waitress - channel_timeout
+    SERVE_BACKLOG           размер очереди входящих соединений (64)
+"""
+import os
+import sys
+import signal
+import logging
+import threading
+import time
+
+# Добавляем путь к модулям, чтобы работал и запуск через python -m backend.serve
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Некорректное значение {name}={value!r}, используется {default}")
+        return default
+
+
+def load_config():
+    """
+    Собирает настройки сервера из переменных окружения
+    """
+    default_backend = 'waitress' if os.name == 'nt' else 'gunicorn'
+    return {
+        "backend": os.environ.get('SERVE_BACKEND', default_backend).lower(),
+        "host": os.environ.get('SERVE_HOST', '0.0.0.0'),
+        "port": _env_int('SERVE_PORT', 5000),
+        "workers": max(1, _env_int('SERVE_WORKERS', 1)),
+        "threads": max(1, _env_int('SERVE_THREADS', 16)),
+        "timeout": _env_int('SERVE_TIMEOUT', 300),
+        "graceful_timeout": _env_int('SERVE_GRACEFUL_TIMEOUT', 120),
+        "keepalive": _env_int('SERVE_KEEPALIVE', 5),
+        "backlog": _env_int('SERVE_BACKLOG', 64),
+    }
+
+
+class InFlightTracker:
+    """
+    WSGI-обертка, считающая запросы в обработке.
+    После начала остановки новые запросы получают 503, а уже начатые
+    генерации дорабатывают до конца.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+        self.draining = False
+        self._cond = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._cond:
+            if self.draining:
+                start_response('503 Service Unavailable', [
+                    ('Content-Type', 'application/json'),
+                    ('Retry-After', '5'),
+                    ('Connection', 'close'),
+                ])
+                return [b'{"error": "Server is shutting down"}']
+            self.in_flight += 1
+
+        try:
+            result = self.app(environ, start_response)
+        except Exception:
+            self._release()
+            raise
+        return _ClosingIterator(result, self._release)
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def drain(self, timeout):
+        """
+        Запрещает новые запросы и ждет завершения начатых.
+        Возвращает True, если все запросы завершились за отведенное время.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.draining = True
+            while self.in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+class _ClosingIterator:
+    """
+    Вызывает callback после того, как сервер закрыл тело ответа
+    (в том числе для потоковых ответов)
+    """
+    def __init__(self, iterable, callback):
+        self._iterable = iterable
+        self._callback = callback
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._callback()
+
+
+def create_app():
+    """
+    Импортирует Flask-приложение. При импорте создаются генераторы
+    и загружаются метаданные - это и есть общее состояние до форка.
+    """
+    from app import app
+    return app
+
+
+def run_gunicorn(config):
+    from gunicorn.app.base import BaseApplication
+
+    # Слив запросов при остановке выполняет сам gunicorn: воркер перестает принимать
+    # соединения и ждет начатые запросы до graceful_timeout. tracker.drain() здесь
+    # не вызывается, трекер нужен только для счетчика в логе.
+    tracker = InFlightTracker(create_app())
+
+    def worker_int(worker):
+        logger.info(f"Воркер {worker.pid} останавливается, запросов в обработке: {tracker.in_flight}")
+
+    def worker_exit(server, worker):
+        logger.info(f"Воркер {worker.pid} завершен")
+
+    class ComicGenApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{config['host']}:{config['port']}",
+                "workers": config['workers'],
+                "threads": config['threads'],
+                # gthread обслуживает keep-alive и несколько запросов на процесс
+                "worker_class": "gthread",
+                "timeout": config['timeout'],
+                "graceful_timeout": config['graceful_timeout'],
+                "keepalive": config['keepalive'],
+                "backlog": config['backlog'],
+                "preload_app": True,
+                "worker_int": worker_int,
+                "worker_exit": worker_exit,
+                "accesslog": "-",
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return tracker
+
+    logger.info(f"Запуск gunicorn: {config}")
+    ComicGenApplication().run()
+
+
+def waitress_options(config):
+    """
+    Параметры create_server для waitress
+    """
+    return {
+        "host": config['host'],
+        "port": config['port'],
+        "threads": config['threads'],
+        # channel_timeout закрывает только простаивающие соединения (без запросов
+        # в обработке), то есть это и есть keep-alive; долгие генерации он не обрывает
+        "channel_timeout": config['keepalive'],
+        "backlog": config['backlog'],
+    }
+
+
+def run_waitress(config):
+    from waitress.server import create_server
+
+    tracker = InFlightTracker(create_app())
+    server = create_server(tracker, **waitress_options(config))
+
+    def drain_and_stop():
+        if not tracker.drain(config['graceful_timeout']):
+            logger.warning(f"Не дождались завершения запросов: {tracker.in_flight}")
+        # Прерываем цикл событий в основном потоке
+        import _thread
+        _thread.interrupt_main()
+
+    def handle_signal(signum, frame):
+        if tracker.draining:
+            # Повторный сигнал (или сигнал от drain_and_stop) - останавливаемся сразу
+            raise KeyboardInterrupt
+        logger.info("Получен сигнал остановки, завершаем начатые генерации...")
+        # Ждем в отдельном потоке: цикл событий должен продолжать отправлять ответы
+        threading.Thread(target=drain_and_stop, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    logger.info(f"Запуск waitress: {config}")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+
+    if config['backend'] == 'gunicorn':
+        run_gunicorn(config)
+    elif config['backend'] == 'waitress':
+        run_waitress(config)
+    else:
+        logger.error(f"Неизвестный SERVE_BACKEND: {config['backend']}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
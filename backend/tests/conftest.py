@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import importlib
+import tempfile
+
+import pytest
+
+# Модули backend импортируются так же, как в app.py: from utils... / from modules...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.character_generator import CharacterGenerator
+from modules.scene_generator import SceneGenerator
+from utils.sd_wrapper import StableDiffusionWrapper
+
+
+PROFILING_TOKEN = "test-token"
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    """
+    Приложение Flask с uploads во временной папке.
+    Настройки читаются при импорте, поэтому окружение задается до него.
+    """
+    os.environ['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='uploads-')
+    os.environ['PROFILING_TOKEN'] = PROFILING_TOKEN
+    os.environ['GC_ENABLED'] = '0'
+    os.environ.pop('SD_BACKEND', None)
+    return importlib.import_module('app')
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def eventually(predicate, timeout=5):
+    """
+    Ждет выполнения условия: часть работы (откат после ошибки записи,
+    фоновые задачи) идет в других потоках
+    """
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def generators(tmp_path, monkeypatch):
+    """Генераторы персонажей и сцен в мок-режиме во временной папке"""
+    monkeypatch.delenv('SD_BACKEND', raising=False)
+    sd = StableDiffusionWrapper()
+    characters = CharacterGenerator(str(tmp_path / 'characters'), sd=sd)
+    scenes = SceneGenerator(str(tmp_path / 'scenes'), characters=characters.characters, sd=sd)
+    return characters, scenes
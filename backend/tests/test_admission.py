@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+from utils.admission import AdmissionController, AdmissionRejected, TokenBucket
+
+from conftest import eventually
+
+
+def _hold(controller, client="holder"):
+    """Занимает единственный слот генерации, пока не будет вызван release"""
+    acquired, release = threading.Event(), threading.Event()
+
+    def run():
+        with controller.admit(client):
+            acquired.set()
+            release.wait(5)
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert acquired.wait(5)
+    return release, thread
+
+
+def _queue(controller, order, requests):
+    """Ставит запросы в очередь строго по порядку и возвращает потоки"""
+    threads = []
+    for name, client, kind in requests:
+        def run(name=name, client=client, kind=kind):
+            with controller.admit(client, kind):
+                order.append(name)
+        queued = controller.status()["queued"]
+        thread = threading.Thread(target=run)
+        thread.start()
+        eventually(lambda: controller.status()["queued"] == queued + 1)
+        threads.append(thread)
+    return threads
+
+
+def _run(controller, requests):
+    order = []
+    release, holder = _hold(controller)
+    threads = _queue(controller, order, requests)
+    release.set()
+    for thread in threads + [holder]:
+        thread.join(5)
+    return order
+
+
+def test_interactive_request_overtakes_queued_bulk_items():
+    controller = AdmissionController(slots=1, rate_per_minute=600, burst=100)
+
+    order = _run(controller, [
+        ("bulk-1", "a", "bulk"), ("bulk-2", "a", "bulk"), ("bulk-3", "a", "bulk"),
+        ("interactive", "b", "interactive"),
+    ])
+
+    assert order[0] == "interactive"
+
+
+def test_bulk_items_do_not_delay_same_client_interactive_requests():
+    controller = AdmissionController(slots=1, rate_per_minute=600, burst=100)
+
+    order = _run(controller, [
+        ("bulk-1", "a", "bulk"), ("bulk-2", "a", "bulk"), ("interactive", "a", "interactive"),
+    ])
+
+    assert order[0] == "interactive"
+
+
+def test_clients_share_slots_fairly():
+    controller = AdmissionController(slots=1, rate_per_minute=600, burst=100)
+
+    order = _run(controller, [
+        ("a-1", "a", "interactive"), ("a-2", "a", "interactive"), ("a-3", "a", "interactive"),
+        ("b-1", "b", "interactive"),
+    ])
+
+    assert order == ["a-1", "b-1", "a-2", "a-3"]
+
+
+def test_full_queue_is_rejected_immediately():
+    controller = AdmissionController(slots=1, max_queue=1, rate_per_minute=600, burst=100)
+    release, holder = _hold(controller)
+    threads = _queue(controller, [], [("waiting", "a", "interactive")])
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        with controller.admit("b"):
+            pass
+    assert rejected.value.reason == "Generation queue is full"
+    assert rejected.value.retry_after >= 1
+
+    release.set()
+    for thread in threads + [holder]:
+        thread.join(5)
+
+
+def test_queue_timeout_removes_ticket():
+    controller = AdmissionController(slots=1, queue_timeout=0.05, rate_per_minute=600, burst=100)
+    release, holder = _hold(controller)
+
+    with pytest.raises(AdmissionRejected, match="Timed out"):
+        with controller.admit("a"):
+            pass
+    assert controller.status()["queued"] == 0
+
+    release.set()
+    holder.join(5)
+    with controller.admit("a"):
+        assert controller.status()["running"] == 1
+
+
+def test_rate_limit_is_per_client_and_shared_with_charge():
+    controller = AdmissionController(slots=2, rate_per_minute=1, burst=2)
+
+    controller.charge("a")
+    with controller.admit("a"):
+        pass
+    with pytest.raises(AdmissionRejected, match="Rate limit") as rejected:
+        controller.charge("a")
+    assert rejected.value.retry_after > 1
+
+    # Элементы уже оплаченного пакета проверяются только по очереди
+    with controller.admit("a", kind="bulk", charge=False):
+        pass
+    with controller.admit("b", cost=2):
+        pass
+
+
+def test_token_bucket_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('utils.admission.time.monotonic', lambda: now[0])
+    bucket = TokenBucket(rate=2, capacity=2)
+
+    assert bucket.consume(2) == 0
+    assert bucket.consume() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.consume() == 0
+    assert not bucket.full
+    now[0] += 10
+    assert bucket.full
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv('GENERATION_SLOTS', '0')
+    monkeypatch.setenv('ADMISSION_MAX_QUEUE', '3')
+    monkeypatch.setenv('ADMISSION_WEIGHT_BULK', '0.5')
+
+    controller = AdmissionController.from_env()
+
+    assert controller.slots == 1
+    assert controller.max_queue == 3
+    assert controller.weights == {"interactive": 4.0, "bulk": 0.5}
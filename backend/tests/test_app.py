@@ -0,0 +1,41 @@
+import io
+import zipfile
+
+from utils.image_utils import image_encoder
+
+
+def _cast(app_module, *descriptions):
+    generator = app_module.character_generator
+    created = [generator.generate(description) for description in descriptions]
+    for character in created:
+        image_encoder.wait(generator.image_path(character))
+    return created
+
+
+def test_character_export_includes_shared_scenes(client, app_module):
+    knight, wizard = _cast(app_module, "knight", "wizard")
+    scenes = app_module.scene_generator
+    scenes.generate(knight['id'], "castle")
+    scenes.generate(plot_description="duel", characters=[
+        {"character_id": knight['id'], "region": "left"},
+        {"character_id": wizard['id'], "region": "right"},
+    ])
+
+    response = client.get(f"/api/characters/{wizard['id']}/export?format=cbz&cover=0")
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as archive:
+        assert len([name for name in archive.namelist() if not name.endswith('.xml')]) == 1
+
+
+def test_deleting_character_keeps_shared_scene_for_others(client, app_module):
+    knight, wizard = _cast(app_module, "knight", "wizard")
+    shared = app_module.scene_generator.generate(plot_description="duel", characters=[
+        {"character_id": knight['id'], "region": "left"},
+        {"character_id": wizard['id'], "region": "right"},
+    ])
+
+    assert client.delete(f"/api/characters/{wizard['id']}").status_code == 200
+
+    scene = app_module.scene_generator.scenes.get(shared['id'])
+    assert scene is not None
+    assert app_module.scene_generator.scene_character_ids(scene) == [knight['id']]
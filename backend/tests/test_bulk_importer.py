@@ -0,0 +1,125 @@
+import base64
+import io
+import json
+import os
+import zipfile
+
+import pytest
+from PIL import Image
+
+from modules.bulk_importer import BulkImporter, BulkImportError
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), (10, 20, 30)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def importer(tmp_path):
+    return BulkImporter(None, None, None, str(tmp_path), max_items=5)
+
+
+def _ndjson(*lines):
+    return io.BytesIO("\n".join(lines).encode('utf-8'))
+
+
+def _zip(manifest, files=None, name='manifest.ndjson'):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(name, manifest)
+        for file_name, content in (files or {}).items():
+            archive.writestr(file_name, content)
+    buffer.seek(0)
+    return buffer
+
+
+def test_ndjson_items_report_errors_per_line(importer):
+    image = base64.b64encode(_png()).decode('ascii')
+    items = importer.parse(_ndjson(
+        json.dumps({"description": "knight", "ref": "a", "reference_image": image}),
+        "{broken",
+        json.dumps("Invalid JSON"),
+        json.dumps({"description": ""}),
+        json.dumps({"description": "wizard", "reference_image": "data:image/png;base64," + base64.b64encode(b"nope").decode()}),
+    ), 'application/x-ndjson')
+
+    assert [item.get("error") for item in items] == [
+        None,
+        "Invalid JSON",
+        "Item must be a JSON object",
+        "description is required",
+        "reference_image is not a valid image",
+    ]
+    assert items[0]["ref"] == "a"
+    assert os.path.exists(items[0]["reference_image"])
+
+    importer.cleanup(items)
+    assert items[0]["reference_image"] is None
+
+
+def test_zip_manifest_with_images(importer):
+    manifest = "\n".join([
+        json.dumps({"description": "knight", "reference_image": "images/knight.png"}),
+        json.dumps("Invalid JSON"),
+        "not json",
+        json.dumps({"description": "ghost", "reference_image": "images/missing.png"}),
+    ])
+    items = importer.parse(_zip(manifest, {"images/knight.png": _png()}), 'application/zip')
+
+    assert [item.get("error") for item in items] == [
+        None,
+        "Item must be a JSON object",
+        "Invalid JSON",
+        "File not found in archive: images/missing.png",
+    ]
+    with Image.open(items[0]["reference_image"]) as image:
+        assert image.size == (16, 16)
+    importer.cleanup(items)
+
+
+def test_zip_json_manifest_must_be_array(importer):
+    with pytest.raises(BulkImportError, match="array"):
+        importer.parse(_zip(json.dumps({"description": "x"}), name='manifest.json'), 'application/zip')
+
+
+def test_zip_without_manifest_is_rejected(importer):
+    with pytest.raises(BulkImportError, match="Manifest not found"):
+        importer.parse(_zip("", name='readme.txt'), 'application/zip')
+
+
+def test_too_many_items_removes_spooled_images(importer, tmp_path):
+    image = base64.b64encode(_png()).decode('ascii')
+    lines = [json.dumps({"description": f"hero {i}", "reference_image": image}) for i in range(6)]
+
+    with pytest.raises(BulkImportError, match="Too many items"):
+        importer.parse(_ndjson(*lines), 'application/x-ndjson')
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("mimetype", ['application/json', 'text/plain'])
+def test_unsupported_content_type_is_415(importer, mimetype):
+    with pytest.raises(BulkImportError) as error:
+        importer.parse(_ndjson('[{"description": "knight"}]'), mimetype)
+    assert error.value.status == 415
+
+
+def test_bulk_endpoint_streams_results(client):
+    body = "\n".join([json.dumps({"description": f"hero {i}", "ref": i}) for i in range(3)] + ["{broken"])
+    response = client.post('/api/characters/bulk', data=body, content_type='application/x-ndjson')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    header, results, summary = lines[0], lines[1:-1], lines[-1]
+    assert header["total"] == 4
+    assert sorted(r["index"] for r in results) == [0, 1, 2, 3]
+    assert [r["status"] for r in sorted(results, key=lambda r: r["index"])] == ["ok", "ok", "ok", "error"]
+    assert summary["status"] == "completed" and summary["done"] == 3 and summary["failed"] == 1
+
+    stored = client.get(f"/api/jobs/{header['job_id']}/results").get_data(as_text=True).splitlines()
+    assert len(stored) == 4
+
+
+def test_bulk_endpoint_rejects_json_array(client):
+    response = client.post('/api/characters/bulk', json=[{"description": "knight"}])
+    assert response.status_code == 415
@@ -0,0 +1,82 @@
+import io
+import os
+import re
+import zipfile
+
+import pytest
+from PIL import Image
+
+from utils.comic_export import ComicExporter
+
+
+@pytest.fixture
+def exporter(tmp_path):
+    return ComicExporter(str(tmp_path / 'cache'))
+
+
+def _image(folder, name, size=(40, 30), color=(200, 10, 10)):
+    path = str(folder / name)
+    Image.new('RGB', size, color).save(path)
+    return path
+
+
+def test_cbz_stores_pages_in_order_with_comic_info(tmp_path, exporter):
+    pages = [_image(tmp_path, 'a.png'), _image(tmp_path, 'b.bmp'), _image(tmp_path, 'c.webp')]
+
+    chunks = list(exporter.stream_cbz(pages, title="Tom & Jerry"))
+
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['001.png', '002.jpg', '003.webp', 'ComicInfo.xml']
+        assert {info.compress_type for info in archive.infolist()} == {zipfile.ZIP_STORED}
+        with open(pages[0], 'rb') as f:
+            assert archive.read('001.png') == f.read()
+        assert Image.open(io.BytesIO(archive.read('002.jpg'))).format == 'JPEG'
+        comic_info = archive.read('ComicInfo.xml').decode('utf-8')
+    assert '<Title>Tom &amp; Jerry</Title>' in comic_info
+    assert '<PageCount>3</PageCount>' in comic_info
+    assert len(chunks) > 1
+
+
+def test_pdf_structure(tmp_path, exporter):
+    pages = [_image(tmp_path, 'a.png', (40, 30)), _image(tmp_path, 'b.png', (20, 50))]
+
+    pdf = b''.join(exporter.stream_pdf(pages, title="Story"))
+
+    assert pdf.startswith(b'%PDF-1.4\n') and pdf.endswith(b'%%EOF\n')
+    xref_offset = int(re.search(rb'startxref\n(\d+)\n', pdf).group(1))
+    assert pdf[xref_offset:].startswith(b'xref\n0 10\n')
+    entries = re.findall(rb'(\d{10}) 00000 n ', pdf[xref_offset:])
+    assert len(entries) == 9
+    for number, offset in enumerate(entries, start=1):
+        assert pdf[int(offset):].startswith(f"{number} 0 obj\n".encode('ascii'))
+    assert b'/Type /Pages /Kids [4 0 R 7 0 R] /Count 2' in pdf
+    assert b'/MediaBox [0 0 40 30]' in pdf and b'/MediaBox [0 0 20 50]' in pdf
+    assert pdf.count(b'/Filter /DCTDecode') == 2
+
+
+def test_jpeg_pages_are_cached_until_source_changes(tmp_path, exporter, monkeypatch):
+    page = _image(tmp_path, 'a.png')
+    cached = exporter.jpeg_page(page)
+
+    monkeypatch.setattr('utils.comic_export.image_encoder.load', lambda path: pytest.fail("re-encoded"))
+    assert exporter.jpeg_page(page) == cached
+    monkeypatch.undo()
+
+    _image(tmp_path, 'a.png', (50, 50))
+    os.utime(page, ns=(0, 10 ** 9))
+    changed = exporter.jpeg_page(page)
+    assert changed != cached
+    assert Image.open(changed).size == (50, 50)
+
+
+def test_cache_trim_removes_least_recently_used_pages(tmp_path, exporter):
+    pages = [_image(tmp_path, f'{index}.png', color=(index * 60, 0, 0)) for index in range(3)]
+    cached = [exporter.jpeg_page(page) for page in pages]
+    for age, path in zip((300, 200, 100), cached):
+        os.utime(path, (os.path.getmtime(path) - age, os.path.getmtime(path)))
+
+    exporter.cache_limit_bytes = os.path.getsize(cached[2]) + os.path.getsize(cached[1])
+    exporter._trim_cache()
+
+    assert [os.path.exists(path) for path in cached] == [False, True, True]
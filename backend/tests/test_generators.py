@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from utils.image_utils import image_encoder
+from utils.storage import path_from_url
+
+from conftest import eventually
+
+
+@pytest.fixture
+def failing_encode(monkeypatch):
+    """Фоновая запись изображений не удается (например, диск заполнен)"""
+    def enable():
+        def fail(image, output_path):
+            raise OSError("disk full")
+        monkeypatch.setattr(image_encoder, 'workers', 1)
+        monkeypatch.setattr(image_encoder, '_encode', fail)
+    return enable
+
+
+def test_character_is_removed_when_image_write_fails(generators, failing_encode):
+    characters, _ = generators
+    failing_encode()
+
+    character = characters.generate("knight")
+    assert character is not None
+    assert image_encoder.wait(characters.image_path(character)) is False
+
+    eventually(lambda: characters.get_character(character['id']) is None)
+    eventually(lambda: not characters.image_index.has_character(character['id']))
+
+
+def test_edit_restores_previous_metadata_when_image_write_fails(generators, failing_encode):
+    characters, _ = generators
+    character = characters.generate("knight")
+    image_encoder.wait(characters.image_path(character))
+
+    failing_encode()
+    characters.edit_description(character['id'], "wizard")
+    assert image_encoder.wait(characters.image_path(character)) is False
+
+    eventually(lambda: characters.get_character(character['id'])['description'] == "knight")
+    restored = characters.get_character(character['id'])
+    assert os.path.exists(characters.image_path(restored))
+
+
+def test_scene_is_removed_when_image_write_fails(generators, failing_encode):
+    characters, scenes = generators
+    character = characters.generate("knight")
+    image_encoder.wait(characters.image_path(character))
+
+    failing_encode()
+    scene = scenes.generate(character['id'], "a castle")
+    assert scene is not None
+    assert image_encoder.wait(path_from_url(scenes.output_folder, scene['image_url'])) is False
+
+    eventually(lambda: scenes.scenes.get(scene['id']) is None)
+
+
+def _cast(characters, *descriptions):
+    created = [characters.generate(description) for description in descriptions]
+    for character in created:
+        image_encoder.wait(characters.image_path(character))
+    return created
+
+
+def test_multi_character_scene_generates_in_one_call(generators):
+    characters, scenes = generators
+    knight, wizard = _cast(characters, "knight", "wizard")
+
+    scene = scenes.generate(plot_description="duel", characters=[
+        {"character_id": knight['id'], "region": "left"},
+        {"character_id": wizard['id'], "region": [0.5, 0, 1, 1]},
+    ])
+
+    assert scene['character_id'] == knight['id']
+    assert scenes.scene_character_ids(scene) == [knight['id'], wizard['id']]
+    assert scene['characters'][1]['region'] == [0.5, 0, 1, 1]
+
+
+def test_scene_rejects_bad_region_and_unknown_character(generators):
+    characters, scenes = generators
+    knight, = _cast(characters, "knight")
+
+    assert scenes.generate(characters=[{"character_id": knight['id'], "region": [0.6, 0, 0.4, 1]}]) is None
+    assert scenes.generate(characters=[{"character_id": knight['id'], "region": "top"}]) is None
+    assert scenes.generate(characters=[{"character_id": "missing"}]) is None
+    assert scenes.generate(characters=[{"character_id": knight['id']}] * (scenes.MAX_CHARACTERS + 1)) is None
+
+
+def test_deleting_secondary_character_keeps_shared_scene(generators):
+    characters, scenes = generators
+    knight, wizard = _cast(characters, "knight", "wizard")
+    solo = scenes.generate(wizard['id'], "library")
+    shared = scenes.generate(plot_description="duel", characters=[
+        {"character_id": knight['id'], "region": "left"},
+        {"character_id": wizard['id'], "region": "right"},
+    ])
+
+    characters.delete(wizard['id'])
+    assert scenes.delete_for_character(wizard['id']) == 1
+
+    assert scenes.scenes.get(solo['id']) is None
+    kept = scenes.scenes.get(shared['id'])
+    assert scenes.scene_character_ids(kept) == [knight['id']]
+    assert image_encoder.wait(path_from_url(scenes.output_folder, kept['image_url']))
+
+
+def test_deleting_primary_character_removes_shared_scene(generators):
+    characters, scenes = generators
+    knight, wizard = _cast(characters, "knight", "wizard")
+    shared = scenes.generate(plot_description="duel", characters=[
+        {"character_id": knight['id'], "region": "left"},
+        {"character_id": wizard['id'], "region": "right"},
+    ])
+
+    assert scenes.delete_for_character(knight['id']) == 1
+    assert scenes.scenes.get(shared['id']) is None
+    assert not os.path.exists(path_from_url(scenes.output_folder, shared['image_url']))
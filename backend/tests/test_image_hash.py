@@ -0,0 +1,125 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from utils.image_hash import ImageHashIndex, dhash, phash
+from utils.image_utils import image_encoder
+
+
+def _picture(seed):
+    rng = np.random.default_rng(seed)
+    image = Image.fromarray((rng.random((8, 8)) * 255).astype(np.uint8)).resize((256, 256), Image.BILINEAR)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse([60, 60, 180, 200], fill=int(rng.integers(0, 255)))
+    return image.convert('RGB')
+
+
+def _distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _recompressed(image):
+    buffer = io.BytesIO()
+    image.resize((180, 180)).save(buffer, format='JPEG', quality=60)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+def _hashes(phash_value, sha1=None):
+    return {"phash": f"{phash_value:016x}", "dhash": "0" * 16, "sha1": sha1}
+
+
+@pytest.fixture
+def index(tmp_path):
+    return ImageHashIndex(str(tmp_path / 'image_hashes.json'))
+
+
+@pytest.mark.parametrize('hash_fn', [phash, dhash])
+def test_hashes_survive_resize_and_recompression(hash_fn):
+    image, other = _picture(1), _picture(2)
+
+    assert _distance(hash_fn(image), hash_fn(_recompressed(image))) <= 6
+    assert _distance(hash_fn(image), hash_fn(other)) > 16
+
+
+def test_compute_reports_file_digest_only_when_asked(tmp_path, index):
+    path = str(tmp_path / 'a.png')
+    _picture(1).save(path)
+
+    hashes = index.compute(path)
+
+    assert hashes['phash'] == f"{phash(_picture(1)):016x}"
+    assert len(hashes['sha1']) == 40
+    assert index.compute(path, _picture(1), digest=False)['sha1'] is None
+
+
+def test_duplicates_match_exact_reference_content_only(index):
+    index.add('a', '/uploads/characters/a_ref.png', "reference", _hashes(1, sha1='s1'))
+    index.add('a', '/uploads/characters/a.png', "main", _hashes(1, sha1='s2'))
+
+    assert index.find_duplicate('s1') == '/uploads/characters/a_ref.png'
+    assert index.find_duplicate('s2') is None
+    assert index.find_duplicate('other') is None
+
+
+def test_shared_images_and_removal(index):
+    index.add('a', '/ref.png', "reference", _hashes(1, sha1='s1'))
+    index.add('b', '/ref.png', "reference", _hashes(1, sha1='s1'))
+
+    assert index.is_shared('/ref.png', 'a')
+    index.remove_character('b')
+    assert not index.is_shared('/ref.png', 'a')
+    assert not index.has_character('b')
+
+
+def test_readding_an_image_replaces_its_hashes(index):
+    index.add('a', '/a.png', "main", _hashes(1))
+    index.add('a', '/a.png', "main", _hashes(2))
+
+    assert index.get('a', '/a.png')['phash'] == f"{2:016x}"
+    assert len(index.entries.get('a')['images']) == 1
+
+
+def test_similar_orders_by_distance_and_respects_limits(index):
+    index.add_many({
+        'a': [('/a.png', "main", _hashes(0b0000)), ('/a_ref.png', "reference", _hashes(0xff00))],
+        'b': [('/b.png', "main", _hashes(0b0111))],
+        'c': [('/c.png', "main", _hashes(0b0001))],
+        'd': [('/d.png', "main", _hashes(0xff03))],
+        'far': [('/far.png', "main", _hashes(0xffff_ffff_ffff_ffff))],
+    })
+
+    assert index.similar('a') == [('c', 1), ('d', 2), ('b', 3)]
+    assert index.similar('a', limit=2) == [('c', 1), ('d', 2)]
+    assert index.similar('a', max_distance=1) == [('c', 1)]
+    assert index.similar('missing') == []
+
+    index.remove_character('c')
+    assert index.similar('a', limit=1) == [('d', 2)]
+
+
+def test_same_reference_file_is_stored_once(tmp_path, generators):
+    characters, _ = generators
+    reference = str(tmp_path / 'upload.png')
+    _picture(3).save(reference)
+
+    first = characters.generate("knight", reference)
+    second = characters.generate("knight again", reference)
+
+    assert first['references'] == second['references']
+    characters.delete(first['id'])
+    assert os.path.exists(characters.character_files(second)[1])
+
+
+def test_characters_without_index_entries_are_indexed(generators):
+    characters, _ = generators
+    character = characters.generate("knight")
+    image_encoder.wait(characters.image_path(character))
+    characters.image_index.remove_character(character['id'])
+
+    assert characters.index_missing() == 1
+    assert characters.image_index.has_character(character['id'])
+    assert characters.index_missing() == 0
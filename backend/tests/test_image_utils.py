@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from utils.image_utils import ImageEncoder
+
+
+def _image(color=(255, 0, 0)):
+    return Image.new('RGB', (32, 32), color=color)
+
+
+@pytest.fixture
+def failing_encoder(monkeypatch):
+    encoder = ImageEncoder(output_format='png', workers=1)
+    gate = threading.Event()
+
+    def fail(image, output_path):
+        gate.wait(5)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(encoder, '_encode', fail)
+    return encoder, gate
+
+
+def test_background_save_is_visible_after_wait(tmp_path):
+    encoder = ImageEncoder(output_format='png', workers=1)
+    path = str(tmp_path / 'a' / 'image.png')
+
+    assert encoder.save(_image(), path)
+    assert encoder.wait(path)
+    assert os.path.exists(path)
+    assert not os.path.exists(path + ImageEncoder.PENDING_SUFFIX)
+
+
+def test_synchronous_save_raises_write_errors(tmp_path, monkeypatch):
+    encoder = ImageEncoder(output_format='png', workers=0)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr('utils.image_utils.save_image', fail)
+
+    with pytest.raises(OSError):
+        encoder.save(_image(), str(tmp_path / 'image.png'))
+
+
+def test_failed_background_save_is_reported(tmp_path, failing_encoder):
+    encoder, gate = failing_encoder
+    path = str(tmp_path / 'image.png')
+    errors = []
+
+    encoder.save(_image(), path)
+    encoder.watch(path, errors.append)
+    gate.set()
+
+    assert encoder.wait(path) is False
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ImageEncoder.PENDING_SUFFIX)
+    assert [str(error) for error in errors] == ["disk full"]
+
+    # Ошибка видна и тем, кто спрашивает после завершения записи
+    late = []
+    encoder.watch(path, late.append)
+    assert len(late) == 1
+    assert encoder.wait(path) is False
+
+
+def test_new_save_clears_previous_failure(tmp_path, failing_encoder, monkeypatch):
+    encoder, gate = failing_encoder
+    path = str(tmp_path / 'image.png')
+    gate.set()
+    encoder.save(_image(), path)
+    assert encoder.wait(path) is False
+
+    monkeypatch.undo()
+    encoder.save(_image(), path)
+    assert encoder.wait(path) is True
+
+
+def test_wait_follows_pending_marker_of_other_process(tmp_path):
+    writer = ImageEncoder(output_format='png', workers=0)
+    reader = ImageEncoder(output_format='png', workers=1)
+    path = str(tmp_path / 'image.png')
+    open(path + ImageEncoder.PENDING_SUFFIX, 'wb').close()
+
+    def finish():
+        time.sleep(0.2)
+        writer.save(_image(), path)
+        os.remove(path + ImageEncoder.PENDING_SUFFIX)
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+    started = time.monotonic()
+    assert reader.wait(path, timeout=5) is True
+    assert time.monotonic() - started >= 0.15
+    thread.join()
+
+
+def test_wait_reports_failure_of_other_process(tmp_path):
+    reader = ImageEncoder(output_format='png', workers=1)
+    path = str(tmp_path / 'image.png')
+    open(path + ImageEncoder.PENDING_SUFFIX, 'wb').close()
+
+    # Другой процесс убрал метку, но файл так и не записал
+    threading.Timer(0.1, os.remove, args=(path + ImageEncoder.PENDING_SUFFIX,)).start()
+    assert reader.wait(path, timeout=5) is False
+
+
+def test_load_ignores_memory_copy_overwritten_by_other_process(tmp_path):
+    local = ImageEncoder(output_format='png', workers=1, keep_in_memory=4)
+    other = ImageEncoder(output_format='png', workers=0)
+    path = str(tmp_path / 'image.png')
+
+    local.save(_image((255, 0, 0)), path)
+    assert local.wait(path)
+    assert local.load(path).getpixel((0, 0)) == (255, 0, 0)
+
+    other.save(_image((0, 0, 255)), path)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    assert local.load(path).getpixel((0, 0)) == (0, 0, 255)
+
+
+def test_peek_returns_image_while_encoding(tmp_path, failing_encoder):
+    encoder, gate = failing_encoder
+    path = str(tmp_path / 'image.png')
+    image = _image()
+
+    encoder.save(image, path)
+    assert encoder.peek(path) is image
+    gate.set()
+    encoder.wait(path)
+    assert encoder.peek(path) is None
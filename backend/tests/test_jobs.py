@@ -0,0 +1,78 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils.jobs import JobManager
+from utils.storage_gc import StorageGC
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    return JobManager(str(tmp_path / 'jobs'), workers=1)
+
+
+def _age(jobs, job, seconds):
+    job['updated_at'] = (datetime.now() - timedelta(seconds=seconds)).isoformat()
+    jobs.jobs.put(job['id'], job)
+
+
+def _results(jobs, job_id, age=0):
+    path = jobs.results_path(job_id)
+    with open(path, 'w') as f:
+        f.write('{"status": "ok"}\n')
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_results_are_appended_per_report_and_record_keeps_counters(jobs):
+    job = jobs.create("bulk", total=3)
+
+    def runner(job, report):
+        report([{"status": "ok", "ref": "a"}, {"status": "error", "ref": "b"}])
+        report([{"status": "ok", "ref": "c"}])
+
+    results = list(jobs.stream(jobs.start(job, runner)))
+
+    assert [r["ref"] for r in results] == ["a", "b", "c"]
+    with open(jobs.results_path(job['id'])) as f:
+        assert [json.loads(line)["ref"] for line in f] == ["a", "b", "c"]
+    record = jobs.get(job['id'])
+    assert (record["status"], record["done"], record["failed"]) == ("completed", 2, 1)
+    assert "results" not in record
+
+
+def test_remove_expired_deletes_old_jobs_with_results(jobs):
+    old, fresh = jobs.create("bulk"), jobs.create("bulk")
+    _age(jobs, old, 7200)
+    old_results, fresh_results = _results(jobs, old['id']), _results(jobs, fresh['id'])
+
+    assert jobs.remove_expired(3600) == 1
+
+    assert jobs.get(old['id']) is None and not os.path.exists(old_results)
+    assert jobs.get(fresh['id']) is not None and os.path.exists(fresh_results)
+
+
+def test_remove_expired_deletes_old_orphan_results(jobs):
+    orphan = _results(jobs, 'gone', age=7200)
+    recent = _results(jobs, 'writing', age=0)
+
+    assert jobs.remove_expired(3600) == 0
+
+    assert not os.path.exists(orphan)
+    assert os.path.exists(recent)
+
+
+def test_gc_pass_removes_expired_jobs(tmp_path, generators, jobs):
+    characters, scenes = generators
+    temp = tmp_path / 'temp'
+    temp.mkdir()
+    gc = StorageGC(str(tmp_path), characters, scenes, str(temp), jobs, jobs_ttl=3600)
+    job = jobs.create("bulk")
+    _age(jobs, job, 7200)
+
+    assert gc.run_once()["jobs_removed"] == 1
+    assert jobs.get(job['id']) is None
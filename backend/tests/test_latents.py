@@ -0,0 +1,143 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.character_generator import CharacterGenerator
+from modules.scene_generator import SceneGenerator
+from utils.image_utils import image_encoder
+from utils.sd_wrapper import StableDiffusionWrapper
+
+
+class LatentsSD(StableDiffusionWrapper):
+    """Мок-генерация, которая, как реальный пайплайн, сохраняет латенты"""
+
+    def __init__(self):
+        super().__init__()
+        self.from_latents = []
+
+    def _store_latents(self, latents_path):
+        if latents_path is not None:
+            os.makedirs(os.path.dirname(latents_path), exist_ok=True)
+            np.savez_compressed(latents_path, latents=np.zeros((1, 4, 8, 8), dtype=np.float16))
+
+    def generate(self, prompt, output_path, negative_prompt="", width=512, height=768, latents_path=None):
+        self._store_latents(latents_path)
+        return super().generate(prompt, output_path, negative_prompt, width, height)
+
+    def generate_scene(self, *args, latents_path=None, **kwargs):
+        self._store_latents(latents_path)
+        return super().generate_scene(*args, **kwargs)
+
+    def generate_from_latents(self, prompt, source_latents_path, output_path, negative_prompt="",
+                              strength=0.5, latents_path=None, width=512, height=768, source_image=None):
+        self.from_latents.append((source_latents_path, strength, source_image))
+        return self.generate(prompt, output_path, negative_prompt, width, height, latents_path)
+
+
+@pytest.fixture
+def sd():
+    return LatentsSD()
+
+
+@pytest.fixture
+def characters(tmp_path, sd):
+    return CharacterGenerator(str(tmp_path / 'characters'), sd=sd)
+
+
+def test_character_records_point_to_stored_latents(characters):
+    character = characters.generate("knight")
+
+    assert character['latents'].endswith(f"{character['id']}.latents.npz")
+    assert os.path.exists(characters.latents_path(character))
+    assert characters.latents_path(character) in characters.character_files(character)
+
+
+def test_variation_starts_from_source_latents(characters, sd):
+    source = characters.generate("knight")
+
+    variation = characters.create_variation(source['id'], strength=0.3)
+
+    assert sd.from_latents == [(characters.latents_path(source), 0.3, characters.image_path(source))]
+    assert variation['parent_id'] == source['id']
+    assert variation['description'] == source['description']
+    assert os.path.exists(characters.latents_path(variation))
+    assert characters.create_variation('missing') is None
+
+
+def test_edit_replaces_latents_in_place(characters, sd):
+    character = characters.generate("knight")
+    latents = characters.latents_path(character)
+
+    edited = characters.edit_description(character['id'], "knight in red armor", strength=0.6)
+
+    assert sd.from_latents == [(latents, 0.6, characters.image_path(character))]
+    assert edited['description'] == "knight in red armor"
+    assert characters.latents_path(edited) == latents
+    assert characters.characters.get(character['id'])['description'] == "knight in red armor"
+
+
+def test_scene_variation_starts_from_scene_latents(tmp_path, characters, sd):
+    scenes = SceneGenerator(str(tmp_path / 'scenes'), characters=characters.characters, sd=sd)
+    character = characters.generate("knight")
+    image_encoder.wait(characters.image_path(character))
+    scene = scenes.generate(character['id'], "on a hill")
+
+    variation = scenes.create_variation(scene['id'], strength=0.4)
+
+    source_latents, strength, _ = sd.from_latents[-1]
+    assert source_latents == os.path.join(scenes.output_folder, scene['latents'])
+    assert strength == 0.4
+    assert variation['parent_id'] == scene['id']
+    assert variation['latents'] and variation['latents'] != scene['latents']
+
+
+def test_mock_mode_variation_falls_back_to_full_generation(generators):
+    characters, _ = generators
+    source = characters.generate("knight")
+    assert source['latents'] is None
+
+    variation = characters.create_variation(source['id'])
+
+    assert variation['latents'] is None
+    assert image_encoder.wait(characters.image_path(variation))
+
+
+class _Tensor:
+    def __init__(self, array):
+        self.array = array
+
+    def detach(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def float(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+def test_pipeline_output_is_kept_as_float16_latents(tmp_path, sd, monkeypatch):
+    latents = np.random.rand(1, 4, 8, 8).astype(np.float32)
+    calls = []
+
+    class Pipeline:
+        def __call__(self, **kwargs):
+            calls.append(kwargs)
+            return type('Output', (), {"images": _Tensor(latents)})()
+
+    monkeypatch.setattr(sd, '_decode_latents', lambda value: Image.new('RGB', (8, 8)))
+    output_path = str(tmp_path / 'out.png')
+    latents_path = str(tmp_path / 'out.latents.npz')
+
+    sd._run_pipeline(Pipeline(), output_path, latents_path, prompt="knight")
+
+    assert calls == [{"output_type": "latent", "prompt": "knight"}]
+    with np.load(latents_path) as data:
+        assert data['latents'].dtype == np.float16
+        np.testing.assert_allclose(data['latents'], latents, atol=1e-3)
+    assert image_encoder.wait(output_path)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.pose_library import NUM_KEYPOINTS, STOCK_POSES, PoseLibrary, render_pose_map
+
+
+@pytest.fixture
+def library(tmp_path):
+    return PoseLibrary(str(tmp_path / 'poses'), cache_size=2)
+
+
+@pytest.fixture
+def reference(tmp_path):
+    path = str(tmp_path / 'pose.png')
+    Image.new('RGB', (200, 100), (255, 255, 255)).save(path)
+    return path
+
+
+def _person(x=0.5, y=0.5, confidence=1.0):
+    person = np.zeros((1, NUM_KEYPOINTS, 3), dtype=np.float32)
+    person[0, :, 0] = x
+    person[0, :, 1] = np.linspace(0.1, 0.9, NUM_KEYPOINTS)
+    person[0, :, 2] = confidence
+    return person
+
+
+def test_stock_pose_is_rendered_at_requested_size_and_cached(library):
+    pose_map = library.render('standing', 512, 768)
+
+    assert pose_map.size == (512, 768)
+    assert pose_map.getbbox() is not None
+    assert library.render('standing', 512, 768) is pose_map
+    assert library.render('standing', 512, 512) is not pose_map
+
+
+def test_render_cache_is_bounded(library):
+    first = library.render('standing', 64, 64)
+    library.render('walking', 64, 64)
+    library.render('arms_up', 64, 64)
+
+    assert len(library._maps) == 2
+    assert library.render('standing', 64, 64) is not first
+
+
+def test_unknown_pose_renders_nothing(library):
+    assert library.render('missing', 64, 64) is None
+    assert not library.has_pose('missing')
+
+
+def test_added_pose_keypoints_are_stored_and_reused(tmp_path, library, reference, monkeypatch):
+    calls = []
+
+    def extract(image):
+        calls.append(image.size)
+        return _person()
+    monkeypatch.setattr(library, 'extract_keypoints', extract)
+
+    pose = library.add_pose('hero', reference)
+    assert pose['people'] == 1 and library.has_pose(pose['id'])
+    assert library.add_pose('again', reference)['id'] == pose['id']
+    assert calls == [(200, 100)]
+
+    reopened = PoseLibrary(str(tmp_path / 'poses'))
+    keypoints, aspect = reopened.get_keypoints(pose['id'])
+    assert aspect == pytest.approx(2.0)
+    np.testing.assert_allclose(keypoints, _person())
+    assert [p['id'] for p in reopened.list_poses()] == list(STOCK_POSES) + [pose['id']]
+
+
+def test_add_pose_without_detector_or_people_fails(library, reference, monkeypatch):
+    def missing_detector():
+        raise ImportError('controlnet_aux')
+    monkeypatch.setattr(library, '_get_detector', missing_detector)
+    assert library.add_pose('hero', reference) is None
+
+    monkeypatch.setattr(library, 'extract_keypoints', lambda image: None)
+    assert library.add_pose('hero', reference) is None
+    assert len(library.poses) == 0
+
+
+def test_pose_map_keeps_source_aspect_inside_target(library):
+    # Кадр 1:2 вписывается в квадрат по центру: рисунок только в средней половине
+    pose_map = render_pose_map(_person(x=1.0), 0.5, 200, 200)
+
+    left, _, right, _ = pose_map.getbbox()
+    assert 140 <= left and right <= 160
+
+
+def test_low_confidence_keypoints_are_not_drawn():
+    assert render_pose_map(_person(confidence=0.05), 1.0, 64, 64).getbbox() is None
+
+
+def test_scene_generation_passes_rendered_pose(generators, library, monkeypatch):
+    characters, scenes = generators
+    scenes.poses = library
+    character = characters.generate("knight")
+    received = []
+    generate_scene = scenes.sd.generate_scene
+
+    def spy(*args, pose_image=None, **kwargs):
+        received.append(pose_image)
+        return generate_scene(*args, pose_image=pose_image, **kwargs)
+    monkeypatch.setattr(scenes.sd, 'generate_scene', spy)
+
+    scene = scenes.generate(character['id'], "on a hill", pose_id='walking')
+
+    assert scene['pose_id'] == 'walking'
+    assert received == [library.render('walking', scenes.SCENE_WIDTH, scenes.SCENE_HEIGHT)]
+    assert scenes.generate(character['id'], "on a hill", pose_id='missing') is None
@@ -0,0 +1,111 @@
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+from utils.admission import AdmissionController
+from utils.profiler import Profiler, collapse_stack, format_collapsed, span
+
+from conftest import PROFILING_TOKEN
+
+ADMIN = {"X-Profiling-Token": PROFILING_TOKEN}
+
+
+def test_collapse_stack_orders_frames_from_root_to_leaf():
+    def leaf():
+        return collapse_stack(sys._getframe())
+
+    stack = leaf()
+    assert stack.endswith("test_profiler.py:test_collapse_stack_orders_frames_from_root_to_leaf;test_profiler.py:leaf")
+
+
+def test_format_collapsed_sorts_by_count():
+    assert format_collapsed(Counter({"a;b": 1, "a;c": 3})) == "a;c 3\na;b 1\n"
+
+
+def test_request_profile_stores_spans_samples_and_meta(tmp_path):
+    profiler = Profiler(str(tmp_path), interval=0.001)
+    profile_id = profiler.start_request({"path": "/api/scenes"})
+    with span("diffusion"):
+        time.sleep(0.05)
+    assert profiler.stop_request({"status": 200}) == profile_id
+
+    with open(profiler.profile_file(profile_id, 'json'), encoding='utf-8') as f:
+        info = json.load(f)
+    assert info["path"] == "/api/scenes"
+    assert info["status"] == 200
+    assert [s["name"] for s in info["spans"]] == ["diffusion"]
+    assert info["spans"][0]["duration"] >= 0.04
+    assert info["samples"] > 0
+    assert "test_profiler.py" in open(profiler.profile_file(profile_id, 'collapsed'), encoding='utf-8').read()
+
+
+def test_span_outside_profile_is_noop(tmp_path):
+    with span("anything"):
+        pass
+    assert Profiler(str(tmp_path)).stop_request() is None
+
+
+def test_old_profiles_are_trimmed(tmp_path):
+    profiler = Profiler(str(tmp_path), keep=2)
+    for _ in range(4):
+        profiler.start_request({})
+        profiler.stop_request()
+        time.sleep(0.01)
+    assert len(profiler.list_profiles()) == 2
+
+
+def test_profile_file_rejects_paths():
+    profiler = Profiler.__new__(Profiler)
+    profiler.folder = "/tmp"
+    assert profiler.profile_file("../etc/passwd", 'json') is None
+    assert profiler.profile_file("abc", 'exe') is None
+
+
+def test_arm_counts_down(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    profiler.arm("/api/scenes", 2)
+    assert profiler.take_armed("/api/scenes")
+    assert profiler.take_armed("/api/scenes")
+    assert not profiler.take_armed("/api/scenes")
+
+
+def test_continuous_buffer_is_capped(tmp_path):
+    profiler = Profiler(str(tmp_path), continuous_interval=0.005, window=0.02, windows=3)
+    stop = threading.Event()
+    worker = threading.Thread(target=stop.wait)
+    worker.start()
+    profiler.set_continuous(True)
+    time.sleep(0.3)
+    profiler.set_continuous(False)
+    stop.set()
+    worker.join()
+
+    assert profiler.status()["continuous_windows"] == 3
+    assert profiler.continuous_profile()
+
+
+def test_cors_preflight_does_not_consume_armed_profile(client):
+    client.post('/api/admin/profiling/arm', json={"path": "/api/scenes", "count": 1}, headers=ADMIN)
+
+    preflight = client.options('/api/scenes', headers={
+        "Origin": "http://localhost:3000",
+        "Access-Control-Request-Method": "POST",
+        "Access-Control-Request-Headers": "content-type",
+    })
+    assert 'X-Profile-Id' not in preflight.headers
+
+    response = client.post('/api/scenes', json={"character_id": "missing", "plot_description": "x"})
+    assert 'X-Profile-Id' in response.headers
+
+
+def test_rejected_request_profile_records_status(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'admission', AdmissionController(rate_per_minute=1, burst=0))
+
+    response = client.post('/api/scenes', json={"character_id": "missing"}, headers={"X-Profile": PROFILING_TOKEN})
+    assert response.status_code == 429
+    profile_id = response.headers['X-Profile-Id']
+
+    info = client.get(f'/api/admin/profiles/{profile_id}?format=json', headers=ADMIN).get_json()
+    assert info["status"] == 429
@@ -0,0 +1,130 @@
+import os
+import socket
+
+import pytest
+from PIL import Image
+
+from utils.image_utils import image_encoder
+from utils.remote_backend import RemoteBackendError, RemoteBackendPool
+from utils.sd_stub_server import start_stub_server
+from utils.sd_wrapper import StableDiffusionWrapper
+
+
+@pytest.fixture
+def stubs():
+    servers = []
+
+    def start(**kwargs):
+        server = start_stub_server(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}/api/v1"
+
+
+def _pool(*servers, **kwargs):
+    kwargs.setdefault('health_interval', 3600)
+    return RemoteBackendPool([s if isinstance(s, str) else s.url for s in servers], **kwargs)
+
+
+def _status(pool, server):
+    return next(b for b in pool.status() if b['url'] == server.url)
+
+
+def test_txt2img_writes_image(stubs, tmp_path):
+    server = stubs()
+    output = str(tmp_path / 'out.png')
+
+    assert _pool(server).txt2img("knight", output, width=64, height=96)
+
+    image_encoder.wait(output)
+    with Image.open(output) as image:
+        assert image.size == (64, 96)
+    assert server.received == ['/api/v1/txt2img']
+
+
+def test_failed_server_is_retried_on_another(stubs, tmp_path):
+    broken, healthy = stubs(fail_rate=1.0), stubs()
+    pool = _pool(broken, healthy, retries=1)
+
+    for index in range(2):
+        assert pool.txt2img("knight", str(tmp_path / f'{index}.png'))
+
+    assert len(healthy.received) == 2
+    assert _status(pool, broken)['failures'] == len(broken.received)
+    assert _status(pool, healthy)['failures'] == 0
+
+
+def test_connection_error_is_retried_on_another(stubs, tmp_path):
+    healthy = stubs()
+    dead = _unused_url()
+    pool = _pool(dead, healthy, retries=1)
+
+    for index in range(3):
+        assert pool.txt2img("knight", str(tmp_path / f'{index}.png'))
+    assert len(healthy.received) == 3
+
+
+def test_server_is_ejected_after_repeated_failures(stubs, tmp_path):
+    broken, healthy = stubs(fail_rate=1.0), stubs()
+    pool = _pool(broken, healthy, retries=1, eject_after=2, eject_time=60)
+
+    for index in range(6):
+        pool.txt2img("knight", str(tmp_path / f'{index}.png'))
+
+    assert len(broken.received) == 2
+    assert not _status(pool, broken)['healthy']
+    assert len(healthy.received) == 6
+
+
+def test_health_check_returns_ejected_server(stubs):
+    server = stubs()
+    pool = _pool(server, eject_after=1, eject_time=60)
+    pool._record_failure(pool.backends[0])
+    assert not pool.backends[0].healthy
+
+    assert pool.check_health(pool.backends[0])
+    assert pool.backends[0].healthy
+
+
+def test_all_servers_failing_raises(stubs, tmp_path):
+    pool = _pool(stubs(fail_rate=1.0), stubs(fail_rate=1.0), retries=1)
+    with pytest.raises(RemoteBackendError):
+        pool.txt2img("knight", str(tmp_path / 'out.png'))
+
+
+def test_client_error_is_returned_without_retry(stubs, tmp_path):
+    first, second = stubs(), stubs()
+    pool = _pool(first, second, retries=1)
+
+    with pytest.raises(RemoteBackendError, match="422"):
+        pool.txt2img("", str(tmp_path / 'out.png'))
+
+    assert len(first.received) + len(second.received) == 1
+    assert all(backend['failures'] == 0 for backend in pool.status())
+    assert not os.path.exists(tmp_path / 'out.png')
+
+
+def test_remote_variation_sends_source_image(stubs, tmp_path, monkeypatch):
+    server = stubs()
+    monkeypatch.setenv('SD_BACKEND', 'remote')
+    monkeypatch.setenv('SD_API_URL', server.url)
+    sd = StableDiffusionWrapper()
+    source = str(tmp_path / 'source.png')
+    Image.new('RGB', (64, 64)).save(source)
+
+    assert sd.generate_from_latents("knight", None, str(tmp_path / 'out.png'), strength=0.3, source_image=source)
+    assert server.received == ['/api/v1/img2img']
+
+    # Без исходного изображения - обычная генерация по тексту
+    assert sd.generate_from_latents("knight", None, str(tmp_path / 'other.png'))
+    assert server.received[-1] == '/api/v1/txt2img'
@@ -0,0 +1,88 @@
+import threading
+
+from serve import InFlightTracker, load_config, waitress_options
+
+
+def _wsgi_app(started, release):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        started.set()
+        release.wait(5)
+        return [b'ok']
+    return app
+
+
+def _call(tracker, statuses):
+    def start_response(status, headers):
+        statuses.append(status)
+    result = tracker({}, start_response)
+    body = b''.join(result)
+    if hasattr(result, 'close'):
+        result.close()
+    return body
+
+
+def test_load_config_reads_env_and_ignores_invalid_values(monkeypatch):
+    monkeypatch.setenv('SERVE_BACKEND', 'Waitress')
+    monkeypatch.setenv('SERVE_THREADS', '0')
+    monkeypatch.setenv('SERVE_KEEPALIVE', '15')
+    monkeypatch.setenv('SERVE_PORT', 'abc')
+
+    config = load_config()
+
+    assert config['backend'] == 'waitress'
+    assert config['threads'] == 1
+    assert config['keepalive'] == 15
+    assert config['port'] == 5000
+
+
+def test_waitress_keepalive_maps_to_channel_timeout(monkeypatch):
+    monkeypatch.setenv('SERVE_KEEPALIVE', '7')
+    monkeypatch.setenv('SERVE_TIMEOUT', '600')
+
+    options = waitress_options(load_config())
+
+    assert options['channel_timeout'] == 7
+
+    # Параметры должны приниматься самим waitress
+    from waitress.adjustments import Adjustments
+    assert Adjustments(**options).channel_timeout == 7
+
+
+def test_drain_waits_for_in_flight_requests_and_rejects_new_ones():
+    started, release = threading.Event(), threading.Event()
+    tracker = InFlightTracker(_wsgi_app(started, release))
+    worker = threading.Thread(target=_call, args=(tracker, []))
+    worker.start()
+    assert started.wait(5)
+
+    drained = []
+    drainer = threading.Thread(target=lambda: drained.append(tracker.drain(5)))
+    drainer.start()
+    while not tracker.draining:
+        pass
+
+    statuses = []
+    assert _call(tracker, statuses) == b'{"error": "Server is shutting down"}'
+    assert statuses == ['503 Service Unavailable']
+
+    release.set()
+    worker.join(5)
+    drainer.join(5)
+    assert drained == [True]
+    assert tracker.in_flight == 0
+
+
+def test_drain_times_out_with_stuck_request():
+    started, release = threading.Event(), threading.Event()
+    tracker = InFlightTracker(_wsgi_app(started, release))
+    worker = threading.Thread(target=_call, args=(tracker, []))
+    worker.start()
+    assert started.wait(5)
+
+    assert tracker.drain(0.05) is False
+    assert tracker.in_flight == 1
+
+    release.set()
+    worker.join(5)
+    assert tracker.in_flight == 0
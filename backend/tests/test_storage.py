@@ -0,0 +1,119 @@
+import json
+import os
+
+import pytest
+
+from utils.storage import MetadataStore, atomic_write, path_from_url, relative_path, sharded_path
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'characters_metadata.json')
+
+
+def test_state_is_restored_from_snapshot_and_journal(path):
+    store = MetadataStore(path, compact_every=1000)
+    store.put('a', {"name": "a"})
+    store.put_many({'b': {"name": "b"}, 'c': {"name": "c"}})
+    store.delete('b')
+
+    assert not os.path.exists(path)
+    reopened = MetadataStore(path)
+    assert dict(reopened.items()) == {'a': {"name": "a"}, 'c': {"name": "c"}}
+
+
+def test_torn_last_journal_line_is_skipped_and_overwritten(path):
+    store = MetadataStore(path, compact_every=1000)
+    store.put('a', {"v": 1})
+    with open(store.journal_path, 'ab') as f:
+        f.write(b'{"op": "put", "id": "b", "rec')
+
+    reopened = MetadataStore(path, compact_every=1000)
+    assert reopened.keys() == ['a']
+
+    reopened.put('c', {"v": 3})
+    assert sorted(MetadataStore(path).keys()) == ['a', 'c']
+
+
+def test_corrupt_journal_entry_does_not_stop_replay(path):
+    store = MetadataStore(path, compact_every=1000)
+    store.put('a', {"v": 1})
+    with open(store.journal_path, 'ab') as f:
+        f.write(b'not json\n')
+    store.put('b', {"v": 2})
+
+    assert sorted(MetadataStore(path).keys()) == ['a', 'b']
+
+
+def test_compaction_writes_snapshot_and_truncates_journal(path):
+    store = MetadataStore(path, compact_every=3)
+    for index in range(4):
+        store.put(str(index), {"v": index})
+
+    with open(path, encoding='utf-8') as f:
+        assert sorted(json.load(f)) == ['0', '1', '2']
+    with open(store.journal_path, 'rb') as f:
+        assert len(f.read().splitlines()) == 1
+    assert sorted(MetadataStore(path).keys()) == ['0', '1', '2', '3']
+
+
+def test_corrupt_snapshot_is_set_aside(path):
+    with open(path, 'w') as f:
+        f.write('{"a": ')
+
+    store = MetadataStore(path)
+
+    assert len(store) == 0
+    assert not os.path.exists(path)
+    [corrupt] = store.corrupt_snapshots()
+    with open(corrupt) as f:
+        assert f.read() == '{"a": '
+
+
+def test_changes_from_another_instance_are_picked_up(path):
+    first, second = MetadataStore(path), MetadataStore(path)
+    version = first.version()
+
+    second.put('a', {"v": 1})
+    assert first.get('a') == {"v": 1}
+    assert first.version() != version
+
+    second.compact()
+    second.delete('a')
+    assert 'a' not in first
+
+
+def test_get_returns_a_copy(path):
+    store = MetadataStore(path)
+    store.put('a', {"v": 1})
+
+    store.get('a')['v'] = 2
+
+    assert store['a'] == {"v": 1}
+    with pytest.raises(KeyError):
+        store['missing']
+
+
+def test_atomic_write_keeps_old_file_on_error(tmp_path):
+    target = str(tmp_path / 'file.txt')
+    with atomic_write(target, 'w') as f:
+        f.write('old')
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(target, 'w') as f:
+            f.write('new')
+            raise RuntimeError
+
+    with open(target) as f:
+        assert f.read() == 'old'
+    assert os.listdir(tmp_path) == ['file.txt']
+
+
+def test_sharded_paths_round_trip(tmp_path):
+    folder = str(tmp_path)
+    path = sharded_path(folder, 'abc', 'abc.png')
+
+    relative = relative_path(folder, path)
+
+    assert relative.count('/') == 2 and relative.endswith('/abc.png')
+    assert path_from_url(folder, f"/uploads/characters/{relative}") == path
@@ -0,0 +1,170 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils.image_utils import image_encoder
+from utils.storage import MetadataStore, sharded_path
+from utils.storage_gc import StorageGC, migrate_flat_layout
+
+
+@pytest.fixture
+def gc(tmp_path, generators):
+    characters, scenes = generators
+    temp = tmp_path / 'temp'
+    temp.mkdir()
+    return StorageGC(str(tmp_path), characters, scenes, str(temp),
+                     orphan_grace=60, temp_ttl=60, deletes_per_second=1000)
+
+
+def _file(path, age=0, size=10):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _character(characters, description="knight"):
+    character = characters.generate(description)
+    image_encoder.wait(characters.image_path(character))
+    return character
+
+
+def test_walk_skips_files_removed_during_scan(gc, tmp_path):
+    folder = tmp_path / 'walk'
+    paths = [_file(str(folder / f'{index}.tmp')) for index in range(5)]
+
+    walk = gc._walk(str(folder))
+    first, _ = next(walk)
+    # Файлы исчезают между scandir и stat (переименование временного файла записи)
+    for path in paths:
+        if path != first.path:
+            os.remove(path)
+
+    assert list(walk) == []
+
+
+def test_clean_temp_removes_only_expired_uploads(gc):
+    old = _file(os.path.join(gc.temp_folder, 'old.png'), age=120)
+    fresh = _file(os.path.join(gc.temp_folder, 'fresh.png'))
+
+    assert gc.clean_temp(time.time()) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+
+def test_orphan_files_are_removed_after_grace(gc, generators):
+    characters, _ = generators
+    kept = [_character(characters, f"hero {index}") for index in range(30)]
+    old = _file(sharded_path(characters.output_folder, 'gone', 'gone.png'), age=120)
+    fresh = _file(sharded_path(characters.output_folder, 'new', 'new.png'))
+
+    removed, total_size = gc.remove_orphan_files(time.time())
+
+    assert removed == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+    assert all(os.path.exists(characters.image_path(character)) for character in kept)
+    assert total_size > 0
+
+
+def test_mass_orphan_deletion_is_refused(gc, generators):
+    characters, _ = generators
+    _character(characters)
+    orphans = [_file(sharded_path(characters.output_folder, f'o{index}', f'o{index}.png'), age=120) for index in range(5)]
+
+    removed, _ = gc.remove_orphan_files(time.time())
+
+    assert removed == 0
+    assert all(os.path.exists(path) for path in orphans)
+
+
+def test_orphans_are_kept_while_metadata_is_corrupt(gc, generators):
+    characters, scenes = generators
+    character = _character(characters)
+    scenes.generate(character['id'], "castle")
+    characters.save_metadata()
+
+    # Снапшот поврежден: хранилище откладывает его и стартует пустым
+    with open(characters.metadata_file, 'w') as f:
+        f.write('{"truncated')
+    characters.characters = MetadataStore(characters.metadata_file)
+    scenes.characters = characters.characters
+    assert len(characters.characters) == 0
+    # Проверяем только защиту от поврежденного снапшота
+    gc.orphan_grace = -1
+    gc.max_orphan_fraction = 1.0
+
+    stats = gc.run_once()
+
+    assert stats["scenes_removed"] == 0 and stats["orphans_removed"] == 0
+    assert os.path.exists(characters.image_path(character))
+    assert len(scenes.scenes) == 1
+
+
+def test_orphan_scenes_respect_grace_and_primary_character(gc, generators):
+    characters, scenes = generators
+    knight, wizard = _character(characters, "knight"), _character(characters, "wizard")
+    old = (datetime.now() - timedelta(hours=1)).isoformat()
+
+    def scene(primary, created_at, secondary=None):
+        record = {"id": f"s-{primary}-{created_at}", "character_id": primary, "created_at": created_at,
+                  "image_url": "/uploads/scenes/x.png", "characters": [{"character_id": primary}]}
+        if secondary:
+            record["characters"].append({"character_id": secondary})
+        scenes.scenes.put(record["id"], record)
+        return record["id"]
+
+    orphan = scene("missing", old)
+    recent = scene("missing", datetime.now().isoformat())
+    shared = scene(knight['id'], old, secondary="missing")
+    owned = scene(wizard['id'], old)
+
+    assert gc.remove_orphan_scenes(time.time()) == 1
+    assert orphan not in scenes.scenes
+    assert recent in scenes.scenes and shared in scenes.scenes and owned in scenes.scenes
+
+
+def test_quota_drops_oldest_latents_first(gc, generators):
+    characters, _ = generators
+    records = []
+    for index, age in enumerate((300, 100, 200)):
+        character = _character(characters, f"hero {index}")
+        latents = _file(characters.file_path(character['id'], 'latents.npz'), age=age, size=1000)
+        character['latents'] = os.path.relpath(latents, characters.output_folder)
+        characters.characters.put(character['id'], character)
+        records.append(character)
+
+    gc.quota_bytes = 10_000
+    freed = gc.enforce_quota(11_500)
+
+    assert freed == 2000
+    latents = [characters.characters.get(c['id'])['latents'] for c in records]
+    assert latents[0] is None and latents[2] is None and latents[1] is not None
+
+
+def test_run_once_reports_stats(gc, generators):
+    characters, _ = generators
+    _character(characters)
+    stats = gc.run_once()
+    assert stats["orphans_removed"] == 0
+    assert stats["total_size"] > 0
+    assert gc.last_run["total_size"] == stats["total_size"]
+
+
+def test_flat_layout_is_migrated_once(tmp_path):
+    folder = str(tmp_path / 'characters')
+    store = MetadataStore(os.path.join(folder, 'characters_metadata.json'))
+    _file(os.path.join(folder, 'abc.png'))
+    store.put('abc', {"id": 'abc', "image_url": "/uploads/characters/abc.png", "references": []})
+
+    assert migrate_flat_layout(folder, store, "/uploads/characters") == 1
+    assert migrate_flat_layout(folder, store, "/uploads/characters") == 0
+
+    url = store.get('abc')['image_url']
+    assert url == "/uploads/characters/" + os.path.relpath(sharded_path(folder, 'abc', 'abc.png'), folder)
+    assert os.path.exists(sharded_path(folder, 'abc', 'abc.png'))
+    assert not os.path.exists(os.path.join(folder, 'abc.png'))
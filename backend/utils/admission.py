@@ -0,0 +1,192 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """
+    Запрос не допущен к генерации: клиент превысил лимит или очередь заполнена
+    """
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount=1):
+        """
+        Забирает токены. Возвращает 0, если получилось, иначе - через сколько секунд повторить.
+        """
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else 60
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """
+    Допуск запросов к генерации.
+
+    - ведро токенов на каждого клиента (API-ключ или IP);
+    - ограниченная общая очередь: при переполнении сразу 429 с Retry-After,
+      а не бесконечное ожидание;
+    - взвешенная справедливая очередь (WFQ) на slots одновременных генераций:
+      каждый клиент получает свою долю, интерактивные запросы весят больше пакетных.
+      Интерактивные и пакетные запросы клиента - разные потоки очереди,
+      поэтому пакет не задерживает интерактивные запросы того же клиента.
+
+    Ограничения действуют в пределах одного процесса сервера.
+    """
+    def __init__(self, slots=1, max_queue=32, rate_per_minute=30, burst=10,
+                 queue_timeout=300, weights=None):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self.weights = weights or {"interactive": 4.0, "bulk": 1.0}
+
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._avg_duration = 10.0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Настройки из переменных окружения:
+            GENERATION_SLOTS             одновременных генераций (1)
+            ADMISSION_MAX_QUEUE          максимум ожидающих запросов (32)
+            RATE_LIMIT_PER_MINUTE        генераций в минуту на клиента (30)
+            RATE_LIMIT_BURST             допустимый всплеск запросов (10)
+            ADMISSION_QUEUE_TIMEOUT      максимальное ожидание в очереди, сек (300)
+            ADMISSION_WEIGHT_INTERACTIVE вес интерактивных запросов (4)
+            ADMISSION_WEIGHT_BULK        вес пакетных запросов (1)
+        """
+        return cls(
+            slots=max(1, int(os.environ.get('GENERATION_SLOTS', 1))),
+            max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 32)),
+            rate_per_minute=float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30)),
+            burst=float(os.environ.get('RATE_LIMIT_BURST', 10)),
+            queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 300)),
+            weights={
+                "interactive": float(os.environ.get('ADMISSION_WEIGHT_INTERACTIVE', 4)),
+                "bulk": float(os.environ.get('ADMISSION_WEIGHT_BULK', 1)),
+            },
+        )
+
+    def _estimate_wait(self, queued):
+        return self._avg_duration * (queued + 1) / self.slots
+
+    def _cleanup(self):
+        # Забываем полные ведра и простаивающих клиентов, чтобы словари не росли
+        if len(self._buckets) > 10000:
+            self._buckets = {k: b for k, b in self._buckets.items() if not b.full}
+        if len(self._last_finish) > 10000:
+            self._last_finish = {k: f for k, f in self._last_finish.items() if f > self._virtual_time}
+
+    def _consume(self, client, cost):
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            self._cleanup()
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+        retry_after = bucket.consume(cost)
+        if retry_after:
+            raise AdmissionRejected("Rate limit exceeded", retry_after)
+
+    def charge(self, client, cost=1):
+        """
+        Списывает токены клиента без постановки в очередь (например, за запуск пакета,
+        элементы которого затем проходят admit(..., charge=False)).
+        При превышении лимита бросает AdmissionRejected.
+        """
+        with self._cond:
+            self._consume(client, cost)
+
+    @contextmanager
+    def admit(self, client, kind="interactive", cost=1, charge=True):
+        """
+        Ждет своей очереди на генерацию. При отказе бросает AdmissionRejected.
+        cost - число генераций в запросе (для пакетов).
+        charge=False - токены уже списаны через charge(), проверяется только очередь.
+        """
+        weight = self.weights.get(kind, 1.0)
+        flow = (client, kind)
+        with self._cond:
+            queued = len(self._heap)
+            if queued >= self.max_queue:
+                raise AdmissionRejected("Generation queue is full", self._estimate_wait(queued))
+            if charge:
+                self._consume(client, cost)
+
+            # Тег завершения WFQ: поток не может уйти вперед больше, чем позволяет его вес
+            start = max(self._virtual_time, self._last_finish.get(flow, 0.0))
+            finish = start + cost / weight
+            self._last_finish[flow] = finish
+            ticket = (finish, next(self._sequence), client)
+            heapq.heappush(self._heap, ticket)
+
+            deadline = time.monotonic() + self.queue_timeout
+            while not (self._running < self.slots and self._heap[0] is ticket):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._heap.remove(ticket)
+                    heapq.heapify(self._heap)
+                    self._cond.notify_all()
+                    raise AdmissionRejected("Timed out waiting in generation queue", self._estimate_wait(len(self._heap)))
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._heap)
+            self._running += 1
+            self._virtual_time = max(self._virtual_time, finish)
+            self._cond.notify_all()
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = (time.monotonic() - started) / max(cost, 1)
+            with self._cond:
+                self._running -= 1
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+                self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            return {
+                "running": self._running,
+                "queued": len(self._heap),
+                "slots": self.slots,
+                "max_queue": self.max_queue,
+            }
@@ -0,0 +1,243 @@
+import os
+import time
+import hashlib
+import logging
+import zipfile
+import threading
+from xml.sax.saxutils import escape
+from PIL import Image
+from utils.storage import atomic_write
+from utils.image_utils import image_encoder
+
+logger = logging.getLogger(__name__)
+
+# Форматы, которые читалки CBZ открывают без перекодирования
+CBZ_NATIVE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+CHUNK_SIZE = 256 * 1024
+
+
+class _StreamBuffer:
+    """
+    Файл только для записи, из которого генератор забирает накопленные байты.
+    zipfile пишет в него архив, а мы сразу отдаем данные клиенту.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        Забирает накопленные байты (пустой список, если ничего не записано)
+        """
+        if not self._chunks:
+            return []
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return [data]
+
+
+class ComicExporter:
+    """
+    Потоковая сборка комикса в CBZ или PDF.
+
+    Страницы обрабатываются по одной, поэтому расход памяти не зависит
+    от их количества. Перекодированные страницы (JPEG для PDF, а также
+    страницы в форматах, которые не понимают читалки CBZ) кэшируются на диске
+    по пути, времени изменения и размеру исходного файла, так что повторный
+    экспорт почти ничего не стоит.
+    """
+    def __init__(self, cache_folder, jpeg_quality=90, cache_limit_bytes=512 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.jpeg_quality = jpeg_quality
+        self.cache_limit_bytes = cache_limit_bytes
+        os.makedirs(cache_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+
+    @classmethod
+    def from_env(cls, cache_folder):
+        """
+        Настройки из переменных окружения:
+            EXPORT_JPEG_QUALITY  качество JPEG-страниц (90)
+            EXPORT_CACHE_MB      размер кэша страниц, МБ (512)
+        """
+        return cls(
+            cache_folder,
+            jpeg_quality=int(os.environ.get('EXPORT_JPEG_QUALITY', 90)),
+            cache_limit_bytes=int(float(os.environ.get('EXPORT_CACHE_MB', 512)) * 1024 * 1024),
+        )
+
+    # --- кэш страниц ---
+
+    def _cache_path(self, image_path):
+        stat = os.stat(image_path)
+        key = f"{os.path.abspath(image_path)}:{stat.st_mtime_ns}:{stat.st_size}:jpeg{self.jpeg_quality}"
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_folder, digest[:2], f"{digest}.jpg")
+
+    def _trim_cache(self):
+        """
+        Удаляет самые старые страницы, если кэш превысил лимит
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cache_limit_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    def jpeg_page(self, image_path):
+        """
+        Возвращает путь к JPEG-версии страницы, перекодируя ее при первом обращении
+        """
+        cache_path = self._cache_path(image_path)
+        if os.path.exists(cache_path):
+            # Отмечаем использование для вытеснения самых старых страниц
+            os.utime(cache_path)
+            return cache_path
+
+        image = image_encoder.load(image_path)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        with atomic_write(cache_path, 'wb') as f:
+            image.save(f, format='JPEG', quality=self.jpeg_quality)
+
+        with self._lock:
+            self._writes_since_trim += 1
+            trim = self._writes_since_trim >= 100
+            if trim:
+                self._writes_since_trim = 0
+        if trim:
+            self._trim_cache()
+        return cache_path
+
+    # --- CBZ ---
+
+    def stream_cbz(self, pages, title=""):
+        """
+        Генератор байтов CBZ-архива. pages - список путей к изображениям по порядку.
+        Изображения уже сжаты, поэтому кладутся в архив без сжатия.
+        """
+        buffer = _StreamBuffer()
+        width = max(3, len(str(len(pages))))
+
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for number, image_path in enumerate(pages, start=1):
+                image_encoder.wait(image_path)
+                extension = os.path.splitext(image_path)[1].lower()
+                if extension not in CBZ_NATIVE_EXTENSIONS:
+                    image_path = self.jpeg_page(image_path)
+                    extension = '.jpg'
+
+                info = zipfile.ZipInfo(f"{number:0{width}d}{extension}", date_time=time.localtime()[:6])
+                with open(image_path, 'rb') as source, archive.open(info, 'w', force_zip64=True) as target:
+                    while True:
+                        chunk = source.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield from buffer.drain()
+                yield from buffer.drain()
+
+            comic_info = (
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<ComicInfo>'
+                f'<Title>{escape(title)}</Title>'
+                f'<PageCount>{len(pages)}</PageCount>'
+                '</ComicInfo>'
+            )
+            archive.writestr('ComicInfo.xml', comic_info)
+        yield from buffer.drain()
+
+    # --- PDF ---
+
+    def stream_pdf(self, pages, title=""):
+        """
+        Генератор байтов PDF. Каждая страница - JPEG-изображение (DCTDecode)
+        в размер страницы. Таблица ссылок пишется в конце, поэтому документ
+        не нужно держать в памяти целиком.
+        """
+        offsets = {}
+        position = 0
+
+        def emit(data):
+            nonlocal position
+            position += len(data)
+            return data
+
+        def obj(number, body):
+            offsets[number] = position
+            return emit(f"{number} 0 obj\n".encode('ascii') + body + b"\nendobj\n")
+
+        # 1 - каталог, 2 - дерево страниц, 3 - информация о документе,
+        # далее по три объекта на страницу: страница, изображение, содержимое
+        yield emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+        page_ids = []
+        for index, image_path in enumerate(pages):
+            image_encoder.wait(image_path)
+            jpeg_path = self.jpeg_page(image_path)
+            with Image.open(jpeg_path) as image:
+                width, height = image.size
+            length = os.path.getsize(jpeg_path)
+
+            page_id, image_id, content_id = 4 + index * 3, 5 + index * 3, 6 + index * 3
+            page_ids.append(page_id)
+
+            offsets[image_id] = position
+            yield emit(
+                f"{image_id} 0 obj\n<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {length} >>\nstream\n"
+                .encode('ascii')
+            )
+            with open(jpeg_path, 'rb') as source:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield emit(chunk)
+            yield emit(b"\nendstream\nendobj\n")
+
+            content = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode('ascii')
+            yield obj(content_id, f"<< /Length {len(content)} >>\nstream\n".encode('ascii') + content + b"\nendstream")
+            yield obj(page_id, (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+                f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+            ).encode('ascii'))
+
+        kids = ' '.join(f"{page_id} 0 R" for page_id in page_ids)
+        yield obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode('ascii'))
+        yield obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        title_hex = (b'\xfe\xff' + title.encode('utf-16-be')).hex()
+        yield obj(3, f"<< /Title <{title_hex}> /Producer (comic-gen) >>".encode('ascii'))
+
+        size = 4 + len(pages) * 3
+        xref_offset = position
+        xref = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for number in range(1, size):
+            xref.append(f"{offsets[number]:010d} 00000 n \n")
+        yield emit(''.join(xref).encode('ascii'))
+        yield emit(
+            f"trailer\n<< /Size {size} /Root 1 0 R /Info 3 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('ascii')
+        )
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import threading
+import numpy as np
+from PIL import Image
+from utils.storage import MetadataStore
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+# Матрица DCT-II для pHash (вычисляется один раз)
+_n = np.arange(PHASH_SIZE)
+_DCT = np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * PHASH_SIZE))
+
+
+def _bits_to_int(bits):
+    return int(''.join('1' if bit else '0' for bit in bits.flatten()), 2)
+
+
+def phash(image):
+    """
+    Перцептивный хэш (64 бита): знаки низкочастотных коэффициентов DCT
+    относительно медианы. Устойчив к пересжатию и изменению размера.
+    """
+    pixels = np.asarray(image.convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    dct = _DCT @ pixels @ _DCT.T
+    low = dct[:HASH_SIZE, :HASH_SIZE]
+    # Постоянная составляющая не несет информации о структуре изображения
+    median = np.median(low.flatten()[1:])
+    return _bits_to_int(low > median)
+
+
+def dhash(image):
+    """
+    Разностный хэш (64 бита): направление градиента яркости между соседними пикселями
+    """
+    pixels = np.asarray(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def file_digest(path):
+    """
+    SHA-1 содержимого файла (точное совпадение)
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _popcount64(values):
+    """
+    Число единичных бит в каждом элементе массива uint64
+    """
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ImageHashIndex:
+    """
+    Индекс перцептивных хэшей изображений персонажей (основных и референсов).
+
+    Запись индекса - персонаж: список его изображений с URL, видом изображения,
+    pHash, dHash и SHA-1 содержимого. Индекс хранится в MetadataStore
+    и обновляется при создании, изменении и удалении персонажей.
+    Производные структуры (URL -> персонажи, SHA-1 -> URL, массив хэшей
+    для векторного поиска похожих) пересобираются один раз после изменения индекса.
+    """
+    def __init__(self, path):
+        self.entries = MetadataStore(path)
+
+        self._lock = threading.Lock()
+        self._cache_version = None
+        self._cache = None
+
+    def compute(self, path, image=None, digest=True):
+        """
+        Хэши изображения: pHash, dHash и SHA-1 файла.
+        digest=False - без SHA-1, если файл еще может кодироваться в фоне.
+        """
+        if image is None:
+            with Image.open(path) as source:
+                source.load()
+                image = source
+        return {
+            "phash": f"{phash(image):016x}",
+            "dhash": f"{dhash(image):016x}",
+            "sha1": file_digest(path) if digest else None,
+        }
+
+    @staticmethod
+    def _with_image(record, url, kind, hashes):
+        images = [image for image in record.get('images', []) if image['url'] != url]
+        images.append({"url": url, "kind": kind, **hashes})
+        return {"images": images}
+
+    def add(self, character_id, url, kind, hashes):
+        """
+        Добавляет или заменяет изображение персонажа
+        """
+        record = self.entries.get(character_id, {})
+        self.entries.put(character_id, self._with_image(record, url, kind, hashes))
+
+    def add_many(self, images):
+        """
+        Индексирует несколько персонажей одной записью в журнал.
+        images - {character_id: [(url, kind, hashes), ...]}
+        """
+        records = {}
+        for character_id, character_images in images.items():
+            record = self.entries.get(character_id, {})
+            for url, kind, hashes in character_images:
+                record = self._with_image(record, url, kind, hashes)
+            records[character_id] = record
+        self.entries.put_many(records)
+
+    def get(self, character_id, url):
+        record = self.entries.get(character_id, {})
+        return next((image for image in record.get('images', []) if image['url'] == url), None)
+
+    def has_character(self, character_id):
+        return character_id in self.entries
+
+    def remove_character(self, character_id):
+        """
+        Удаляет записи персонажа
+        """
+        self.entries.delete(character_id)
+
+    def _derived(self):
+        """
+        Производные структуры индекса, пересобираются при его изменении
+        """
+        version = self.entries.version()
+        with self._lock:
+            if self._cache_version != version:
+                owners = {}
+                by_sha1 = {}
+                character_ids = []
+                hashes = []
+                for character_id, record in self.entries.items():
+                    for image in record.get('images', []):
+                        owners.setdefault(image['url'], set()).add(character_id)
+                        if image['kind'] == "reference" and image.get('sha1'):
+                            by_sha1.setdefault(image['sha1'], image['url'])
+                        character_ids.append(character_id)
+                        hashes.append(int(image['phash'], 16))
+                self._cache = {
+                    "owners": owners,
+                    "by_sha1": by_sha1,
+                    "character_ids": np.array(character_ids, dtype=object),
+                    "hashes": np.array(hashes, dtype=np.uint64),
+                }
+                self._cache_version = version
+            return self._cache
+
+    def is_shared(self, url, character_id):
+        """
+        Используется ли изображение другими персонажами
+        """
+        return bool(self._derived()["owners"].get(url, set()) - {character_id})
+
+    def find_duplicate(self, sha1):
+        """
+        URL уже сохраненного референса с тем же содержимым или None.
+        Файл переиспользуется только при точном совпадении: перцептивные хэши
+        считаются по яркости и не различают, например, перекрашенные варианты.
+        """
+        return self._derived()["by_sha1"].get(sha1)
+
+    def similar(self, character_id, limit=10, max_distance=24):
+        """
+        Персонажи, изображения которых ближе всего к изображениям данного.
+        Возвращает список (character_id, расстояние) по возрастанию расстояния.
+        """
+        derived = self._derived()
+        character_ids, hashes = derived["character_ids"], derived["hashes"]
+        if not len(hashes):
+            return []
+        own = hashes[character_ids == character_id]
+        if not len(own):
+            return []
+
+        # Расстояния от каждого изображения персонажа до всех изображений индекса
+        distances = np.stack([_popcount64(np.bitwise_xor(hashes, value)) for value in own]).min(axis=0)
+
+        best = {}
+        for index in np.argsort(distances, kind='stable'):
+            distance = int(distances[index])
+            if distance > max_distance:
+                break
+            other = character_ids[index]
+            if other != character_id and other not in best:
+                best[other] = distance
+                if len(best) >= limit:
+                    break
+        return list(best.items())
@@ -0,0 +1,281 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from utils.storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые форматы вывода: расширение файла и имя формата PIL
+OUTPUT_FORMATS = {
+    'png': ('.png', 'PNG'),
+    'webp': ('.webp', 'WEBP'),
+    'jpeg': ('.jpg', 'JPEG'),
+    'avif': ('.avif', 'AVIF'),
+}
+
+
+def format_for_path(path):
+    """
+    Определяет формат PIL по расширению файла
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return Image.registered_extensions().get(extension, 'PNG')
+
+
+def save_image(image, output_path, **params):
+    """
+    Атомарно сохраняет изображение: во временный файл, fsync и rename.
+    При сбое на диске не остается недописанных файлов под итоговым именем.
+    """
+    with atomic_write(output_path, 'wb') as f:
+        image.save(f, format=format_for_path(output_path), **params)
+    return output_path
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"Некорректное значение {name}, используется {default}")
+        return default
+
+
+class ImageEncoder:
+    """
+    Кодирует и сохраняет выходные изображения.
+
+    Настройки из переменных окружения:
+        OUTPUT_FORMAT          png | webp | jpeg | avif (png)
+        PNG_COMPRESS_LEVEL     уровень сжатия PNG 0-9 (1 - быстро, файл чуть больше)
+        OUTPUT_QUALITY         качество JPEG/AVIF (95)
+        ENCODE_WORKERS         потоков для кодирования, 0 - кодировать в потоке запроса (2)
+        KEEP_IMAGES_IN_MEMORY  сколько последних изображений держать в памяти
+                               для следующих этапов обработки, 0 - не держать (0)
+
+    Пока файл кодируется в фоне, рядом с ним лежит метка <файл>.pending:
+    по ней wait() дожидается записи и в других процессах сервера.
+    Ошибка фоновой записи не теряется: wait() возвращает False,
+    а watch() сообщает о ней тем, кто уже сохранил метаданные файла.
+    """
+    PENDING_SUFFIX = '.pending'
+    # Сколько последних ошибок фоновой записи помнить для wait() и watch()
+    FAILED_KEEP = 256
+
+    def __init__(self, output_format=None, png_compress_level=None, quality=None,
+                 workers=None, keep_in_memory=None):
+        output_format = (output_format or os.environ.get('OUTPUT_FORMAT', 'png')).lower()
+        if output_format == 'jpg':
+            output_format = 'jpeg'
+        if output_format not in OUTPUT_FORMATS:
+            logger.warning(f"Неизвестный формат вывода {output_format}, используется png")
+            output_format = 'png'
+        if output_format == 'avif' and 'AVIF' not in Image.SAVE:
+            logger.warning("Pillow собран без поддержки AVIF, используется png")
+            output_format = 'png'
+
+        self.output_format = output_format
+        self.extension, self.pil_format = OUTPUT_FORMATS[output_format]
+        self.png_compress_level = png_compress_level if png_compress_level is not None else _env_int('PNG_COMPRESS_LEVEL', 1)
+        self.quality = quality if quality is not None else _env_int('OUTPUT_QUALITY', 95)
+        self.workers = workers if workers is not None else _env_int('ENCODE_WORKERS', 2)
+        self.keep_in_memory = keep_in_memory if keep_in_memory is not None else _env_int('KEEP_IMAGES_IN_MEMORY', 0)
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._failed = OrderedDict()
+        self._memory = OrderedDict()
+
+    def save_params(self, pil_format=None):
+        """
+        Параметры PIL для сохранения в заданном формате
+        """
+        pil_format = pil_format or self.pil_format
+        if pil_format == 'PNG':
+            return {"compress_level": self.png_compress_level}
+        if pil_format == 'WEBP':
+            return {"lossless": True, "method": 2}
+        if pil_format == 'JPEG':
+            return {"quality": self.quality, "subsampling": 0, "optimize": False}
+        if pil_format == 'AVIF':
+            return {"quality": self.quality}
+        return {}
+
+    def filename(self, name):
+        """
+        Имя выходного файла с расширением текущего формата
+        """
+        return f"{name}{self.extension}"
+
+    def _encode(self, image, output_path):
+        pil_format = format_for_path(output_path)
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        save_image(image, output_path, **self.save_params(pil_format))
+
+        # Запоминаем версию файла: если его перезапишет другой процесс,
+        # изображение из памяти больше не соответствует диску
+        key = os.path.abspath(output_path)
+        mtime = os.stat(output_path).st_mtime_ns
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] is image:
+                self._memory[key] = (image, mtime)
+        return output_path
+
+    def _encode_pending(self, image, output_path):
+        try:
+            return self._encode(image, output_path)
+        except Exception:
+            self.forget(output_path)
+            raise
+        finally:
+            try:
+                os.remove(output_path + self.PENDING_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def _remember(self, output_path, image):
+        if self.keep_in_memory <= 0:
+            return
+        with self._lock:
+            self._memory[os.path.abspath(output_path)] = (image, None)
+            self._memory.move_to_end(os.path.abspath(output_path))
+            while len(self._memory) > self.keep_in_memory:
+                self._memory.popitem(last=False)
+
+    def forget(self, path):
+        """
+        Убирает изображение из памяти (например, при удалении файла)
+        """
+        with self._lock:
+            self._memory.pop(os.path.abspath(path), None)
+
+    def save(self, image, output_path):
+        """
+        Сохраняет изображение. Если включены потоки кодирования, запись идет
+        в фоне, а файл становится доступен для чтения через wait().
+        Без потоков кодирования ошибка записи бросается сразу.
+        """
+        self._remember(output_path, image)
+
+        key = os.path.abspath(output_path)
+        with self._lock:
+            self._failed.pop(key, None)
+
+        if self.workers <= 0:
+            self._encode(image, output_path)
+            return True
+
+        # Метка для других процессов: URL файла уже может уйти клиенту
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+        open(output_path + self.PENDING_SUFFIX, 'wb').close()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='encoder')
+            future = self._executor.submit(self._encode_pending, image, output_path)
+            self._pending[key] = (future, image)
+
+        def on_done(done_future):
+            error = done_future.exception()
+            with self._lock:
+                if self._pending.get(key, (None,))[0] is done_future:
+                    del self._pending[key]
+                    if error is not None:
+                        self._failed[key] = error
+                        while len(self._failed) > self.FAILED_KEEP:
+                            self._failed.popitem(last=False)
+            if error is not None:
+                logger.error(f"Не удалось сохранить изображение {output_path}: {error}")
+
+        future.add_done_callback(on_done)
+        return True
+
+    def watch(self, path, on_error):
+        """
+        Вызывает on_error(ошибка), если фоновая запись файла не удастся,
+        или сразу, если она уже не удалась. Вызов идет из потока кодирования.
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            future, _ = self._pending.get(key, (None, None))
+            error = self._failed.get(key)
+        if future is not None:
+            def callback(done_future):
+                if done_future.exception() is not None:
+                    on_error(done_future.exception())
+            future.add_done_callback(callback)
+        elif error is not None:
+            on_error(error)
+
+    def wait(self, path, timeout=30):
+        """
+        Дожидается окончания фоновой записи файла, если она идет
+        (в этом или в другом процессе сервера).
+        Возвращает True, если файл записан, False - если запись не удалась
+        или не закончилась за timeout.
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            future, _ = self._pending.get(key, (None, None))
+            failed = key in self._failed
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка ожидания записи {path}: {e}")
+                return False
+        if failed:
+            return False
+
+        marker = path + self.PENDING_SUFFIX
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                # Метка, оставшаяся после сбоя процесса, не должна задерживать запросы
+                if time.time() - os.stat(marker).st_mtime > timeout:
+                    return os.path.exists(path)
+            except FileNotFoundError:
+                # Запись закончилась; при ошибке новый файл не появляется
+                return os.path.exists(path)
+            time.sleep(0.05)
+        return False
+
+    def peek(self, path):
+        """
+        Изображение, которое еще кодируется в фоне, без ожидания записи.
+        None, если фоновой записи нет.
+        """
+        with self._lock:
+            return self._pending.get(os.path.abspath(path), (None, None))[1]
+
+    def load(self, path):
+        """
+        Возвращает изображение из памяти, если оно только что сгенерировано,
+        иначе читает файл с диска
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is not None:
+            image, mtime = entry
+            try:
+                # Пока идет своя запись, версия из памяти - самая новая
+                if mtime is None or os.stat(path).st_mtime_ns == mtime:
+                    return image
+            except FileNotFoundError:
+                pass
+            self.forget(path)
+        self.wait(path)
+        with Image.open(path) as image:
+            image.load()
+            return image
+
+
+# Общий кодировщик процесса
+image_encoder = ImageEncoder()
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from utils.storage import MetadataStore
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class JobManager:
+    """
+    Фоновые задачи (пакетная генерация и т.п.).
+
+    Состояние задачи (статус и счетчики) хранится в MetadataStore, поэтому прогресс
+    виден из любого процесса сервера. Результаты по элементам дописываются
+    в отдельный файл <job_id>.results.ndjson, а пока задача выполняется,
+    их можно получать потоком (в процессе, который ее запустил).
+    Старые задачи вместе с результатами удаляет remove_expired() (из фоновой очистки).
+    """
+    RESULTS_SUFFIX = '.results.ndjson'
+
+    def __init__(self, folder, workers=2):
+        self.folder = folder
+        self.workers = workers
+        os.makedirs(folder, exist_ok=True)
+        self.jobs = MetadataStore(os.path.join(folder, 'jobs_metadata.json'))
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        # Пул создается лениво, уже в рабочем процессе после форка
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Выполняет функцию в пуле задач, возвращает Future
+        """
+        return self._get_executor().submit(fn, *args, **kwargs)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def results_path(self, job_id):
+        return os.path.join(self.folder, f"{job_id}{self.RESULTS_SUFFIX}")
+
+    def remove_expired(self, ttl, now=None):
+        """
+        Удаляет задачи, которые не обновлялись дольше ttl секунд, и их результаты.
+        Выполняющаяся задача обновляется после каждой порции, поэтому под условие
+        попадают завершенные задачи и задачи, прерванные перезапуском сервера.
+        Возвращает число удаленных задач.
+        """
+        now = now if now is not None else time.time()
+        expired = set()
+        for job_id, job in self.jobs.items():
+            try:
+                updated = datetime.fromisoformat(job['updated_at']).timestamp()
+            except (KeyError, TypeError, ValueError):
+                updated = 0
+            if now - updated > ttl:
+                expired.add(job_id)
+
+        for job_id in expired:
+            self.jobs.delete(job_id)
+        # Заодно - файлы результатов, оставшиеся без записи задачи
+        for entry in os.scandir(self.folder):
+            if not entry.name.endswith(self.RESULTS_SUFFIX):
+                continue
+            job_id = entry.name[:-len(self.RESULTS_SUFFIX)]
+            try:
+                if job_id in expired or (job_id not in self.jobs and now - entry.stat().st_mtime > ttl):
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        return len(expired)
+
+    def create(self, kind, total=0):
+        job_id = str(uuid.uuid4())
+        timestamp = datetime.now().isoformat()
+        job = {
+            "id": job_id,
+            "kind": kind,
+            "status": "queued",
+            "total": total,
+            "done": 0,
+            "failed": 0,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+        }
+        self.jobs.put(job_id, job)
+        return job
+
+    def start(self, job, runner):
+        """
+        Запускает задачу в отдельном потоке. runner(job, report) должен вызывать
+        report(results) для каждой завершенной порции элементов.
+        """
+        job_id = job['id']
+        results_queue = queue.Queue()
+
+        def report(results):
+            job.update(
+                done=job['done'] + sum(1 for r in results if r.get('status') == 'ok'),
+                failed=job['failed'] + sum(1 for r in results if r.get('status') != 'ok'),
+                updated_at=datetime.now().isoformat(),
+            )
+            # Результаты дописываются в свой файл, в журнал метаданных - только счетчики
+            with open(self.results_path(job_id), 'ab') as f:
+                f.write(b''.join(json.dumps(r, ensure_ascii=False).encode('utf-8') + b'\n' for r in results))
+            self.jobs.put(job_id, job)
+            for result in results:
+                results_queue.put(result)
+
+        def run():
+            job.update(status="running", updated_at=datetime.now().isoformat())
+            self.jobs.put(job_id, job)
+            try:
+                runner(job, report)
+                job['status'] = "completed"
+            except Exception as e:
+                logger.error(f"Задача {job_id} завершилась с ошибкой: {e}")
+                job['status'] = "failed"
+                job['error'] = str(e)
+            job['updated_at'] = datetime.now().isoformat()
+            self.jobs.put(job_id, job)
+            results_queue.put(_END)
+
+        threading.Thread(target=run, name=f"job-{job_id[:8]}", daemon=True).start()
+        return results_queue
+
+    def stream(self, results_queue):
+        """
+        Генератор результатов задачи по мере их появления
+        """
+        while True:
+            result = results_queue.get()
+            if result is _END:
+                return
+            yield result
@@ -0,0 +1,236 @@
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+from PIL import Image, ImageDraw
+from utils.storage import MetadataStore, atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Ключевые точки OpenPose (COCO, 18 точек):
+# 0 нос, 1 шея, 2-4 правая рука, 5-7 левая рука, 8-10 правая нога,
+# 11-13 левая нога, 14-15 глаза, 16-17 уши
+NUM_KEYPOINTS = 18
+
+# Пары точек, образующие конечности, и их цвета - как в рендере OpenPose,
+# на котором обучен ControlNet
+LIMBS = [
+    (1, 2), (1, 5), (2, 3), (3, 4), (5, 6), (6, 7), (1, 8), (8, 9), (9, 10),
+    (1, 11), (11, 12), (12, 13), (1, 0), (0, 14), (14, 16), (0, 15), (15, 17),
+]
+COLORS = [
+    (255, 0, 0), (255, 85, 0), (255, 170, 0), (255, 255, 0), (170, 255, 0), (85, 255, 0),
+    (0, 255, 0), (0, 255, 85), (0, 255, 170), (0, 255, 255), (0, 170, 255), (0, 85, 255),
+    (0, 0, 255), (85, 0, 255), (170, 0, 255), (255, 0, 255), (255, 0, 170), (255, 0, 85),
+]
+
+
+def _stock(points):
+    return np.array([[[x, y, 1.0] for x, y in points]], dtype=np.float32)
+
+
+# Стандартные позы: координаты нормированы на квадратный кадр
+STOCK_POSES = {
+    "standing": _stock([
+        (0.50, 0.15), (0.50, 0.24), (0.42, 0.25), (0.39, 0.38), (0.38, 0.50),
+        (0.58, 0.25), (0.61, 0.38), (0.62, 0.50), (0.45, 0.52), (0.45, 0.70),
+        (0.45, 0.88), (0.55, 0.52), (0.55, 0.70), (0.55, 0.88), (0.48, 0.13),
+        (0.52, 0.13), (0.46, 0.14), (0.54, 0.14),
+    ]),
+    "arms_up": _stock([
+        (0.50, 0.20), (0.50, 0.29), (0.42, 0.30), (0.36, 0.20), (0.34, 0.08),
+        (0.58, 0.30), (0.64, 0.20), (0.66, 0.08), (0.45, 0.56), (0.45, 0.73),
+        (0.45, 0.90), (0.55, 0.56), (0.55, 0.73), (0.55, 0.90), (0.48, 0.18),
+        (0.52, 0.18), (0.46, 0.19), (0.54, 0.19),
+    ]),
+    "walking": _stock([
+        (0.52, 0.15), (0.50, 0.24), (0.43, 0.25), (0.46, 0.38), (0.50, 0.49),
+        (0.57, 0.25), (0.54, 0.38), (0.51, 0.48), (0.46, 0.52), (0.40, 0.69),
+        (0.36, 0.86), (0.54, 0.52), (0.58, 0.69), (0.62, 0.86), (0.50, 0.13),
+        (0.54, 0.13), (0.48, 0.14), (0.56, 0.14),
+    ]),
+}
+
+
+class PoseLibrary:
+    """
+    Библиотека поз для ControlNet OpenPose.
+
+    Позы хранятся компактно - как массивы ключевых точек (люди x 18 x [x, y, уверенность]),
+    нормированные на размер исходного кадра. Детекция выполняется один раз
+    при добавлении позы, карты для ControlNet рисуются по запросу
+    и кэшируются по (поза, размер).
+    """
+    def __init__(self, folder, cache_size=64):
+        self.folder = folder
+        self.cache_size = cache_size
+        os.makedirs(folder, exist_ok=True)
+        self.poses = MetadataStore(os.path.join(folder, 'poses_metadata.json'))
+
+        self._detector = None
+        self._lock = threading.Lock()
+        self._keypoints = {}
+        self._maps = OrderedDict()
+
+    def list_poses(self):
+        """Возвращает список всех поз, включая стандартные"""
+        stock = [{"id": pose_id, "name": pose_id, "stock": True} for pose_id in STOCK_POSES]
+        return stock + self.poses.values()
+
+    def has_pose(self, pose_id):
+        return pose_id in STOCK_POSES or pose_id in self.poses
+
+    def _keypoints_path(self, pose_id):
+        return os.path.join(self.folder, f"{pose_id}.npz")
+
+    def get_keypoints(self, pose_id):
+        """
+        Возвращает ключевые точки позы и соотношение сторон кадра
+        """
+        if pose_id in STOCK_POSES:
+            return STOCK_POSES[pose_id], 1.0
+
+        with self._lock:
+            cached = self._keypoints.get(pose_id)
+        if cached is not None:
+            return cached
+
+        pose = self.poses.get(pose_id)
+        if pose is None:
+            return None
+        with np.load(self._keypoints_path(pose_id)) as data:
+            cached = (data['keypoints'], float(data['aspect']))
+        with self._lock:
+            self._keypoints[pose_id] = cached
+        return cached
+
+    def _get_detector(self):
+        if self._detector is None:
+            # Опциональная зависимость: нужна только для добавления новых поз
+            from controlnet_aux import OpenposeDetector
+            self._detector = OpenposeDetector.from_pretrained("lllyasviel/Annotators")
+        return self._detector
+
+    def extract_keypoints(self, image):
+        """
+        Находит позы людей на изображении
+        """
+        detector = self._get_detector()
+        poses = detector.detect_poses(np.array(image.convert('RGB')))
+
+        people = []
+        for pose in poses:
+            person = np.zeros((NUM_KEYPOINTS, 3), dtype=np.float32)
+            for index, keypoint in enumerate(pose.body.keypoints[:NUM_KEYPOINTS]):
+                if keypoint is not None:
+                    person[index] = (keypoint.x, keypoint.y, keypoint.score)
+            people.append(person)
+
+        if not people:
+            return None
+        return np.stack(people)
+
+    def add_pose(self, name, image_path):
+        """
+        Добавляет позу из референсного изображения.
+        Повторная загрузка того же изображения возвращает уже сохраненную позу.
+        """
+        with open(image_path, 'rb') as f:
+            source_hash = hashlib.sha1(f.read()).hexdigest()
+
+        for pose in self.poses.values():
+            if pose.get('source_hash') == source_hash:
+                return pose
+
+        try:
+            with Image.open(image_path) as image:
+                image.load()
+                keypoints = self.extract_keypoints(image)
+                aspect = image.width / image.height
+        except ImportError:
+            logger.error("Для извлечения поз нужен пакет controlnet_aux")
+            return None
+        except Exception as e:
+            logger.error(f"Не удалось извлечь позу из {image_path}: {e}")
+            return None
+
+        if keypoints is None:
+            logger.error(f"На изображении не найдено людей: {image_path}")
+            return None
+
+        pose_id = str(uuid.uuid4())
+        with atomic_write(self._keypoints_path(pose_id), 'wb') as f:
+            np.savez_compressed(f, keypoints=keypoints, aspect=np.float32(aspect))
+
+        pose = {
+            "id": pose_id,
+            "name": name or pose_id,
+            "people": int(keypoints.shape[0]),
+            "source_hash": source_hash,
+            "created_at": datetime.now().isoformat(),
+        }
+        self.poses.put(pose_id, pose)
+        return pose
+
+    def render(self, pose_id, width, height):
+        """
+        Рисует карту позы для ControlNet заданного размера (с кэшем)
+        """
+        key = (pose_id, width, height)
+        with self._lock:
+            cached = self._maps.get(key)
+            if cached is not None:
+                self._maps.move_to_end(key)
+                return cached
+
+        result = self.get_keypoints(pose_id)
+        if result is None:
+            return None
+        keypoints, aspect = result
+        pose_map = render_pose_map(keypoints, aspect, width, height)
+
+        with self._lock:
+            self._maps[key] = pose_map
+            while len(self._maps) > self.cache_size:
+                self._maps.popitem(last=False)
+        return pose_map
+
+
+def render_pose_map(keypoints, aspect, width, height, min_confidence=0.1):
+    """
+    Рисует скелеты в стиле OpenPose. Исходный кадр с соотношением сторон aspect
+    вписывается по центру целевого размера без искажений.
+    """
+    if width / height > aspect:
+        frame_h = height
+        frame_w = height * aspect
+    else:
+        frame_w = width
+        frame_h = width / aspect
+    offset_x = (width - frame_w) / 2
+    offset_y = (height - frame_h) / 2
+
+    image = Image.new('RGB', (width, height), (0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    stick_width = max(2, round(min(width, height) / 128))
+
+    for person in keypoints:
+        points = [
+            (offset_x + x * frame_w, offset_y + y * frame_h) if confidence >= min_confidence else None
+            for x, y, confidence in person
+        ]
+        for index, (start, end) in enumerate(LIMBS):
+            if points[start] is not None and points[end] is not None:
+                draw.line([points[start], points[end]], fill=COLORS[index], width=stick_width * 2)
+        for index, point in enumerate(points):
+            if point is not None:
+                x, y = point
+                draw.ellipse(
+                    [(x - stick_width, y - stick_width), (x + stick_width, y + stick_width)],
+                    fill=COLORS[index],
+                )
+    return image
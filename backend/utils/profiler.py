@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from utils.storage import atomic_write
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# torch.profiler допускает один активный профиль на процесс
+_torch_profile_lock = threading.Lock()
+
+
+def collapse_stack(frame):
+    """
+    Стек в формате collapsed (Brendan Gregg): "корень;...;лист".
+    Кадры - файл:функция, чтобы стеки с разных строк одной функции складывались.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def format_collapsed(counts):
+    """
+    Текст для flamegraph.pl / speedscope: "стек количество" в строке
+    """
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def _torch():
+    # torch импортирован только в реальном режиме - сами его не загружаем
+    return sys.modules.get('torch')
+
+
+@contextmanager
+def span(name):
+    """
+    Отмечает этап внутри профилируемого запроса. Вне профилирования
+    ничего не делает; при загруженном torch этап попадает и в трассу torch.profiler.
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+        return
+
+    torch = _torch()
+    record = torch.profiler.record_function(name) if torch is not None else None
+    started = time.monotonic()
+    if record is not None:
+        record.__enter__()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record.__exit__(None, None, None)
+        if torch is not None and torch.cuda.is_available():
+            # Время GPU-этапов видно только после синхронизации
+            torch.cuda.synchronize()
+        profile.spans.append({
+            "name": name,
+            "start": round(started - profile.started, 6),
+            "duration": round(time.monotonic() - started, 6),
+        })
+
+
+class RequestProfile:
+    """
+    Профиль одного запроса: выборки стека потока запроса,
+    интервалы span() и, если загружен torch, трасса torch.profiler
+    """
+    def __init__(self, profile_id, thread_id, interval, meta):
+        self.id = profile_id
+        self.thread_id = thread_id
+        self.interval = interval
+        self.meta = meta
+        self.samples = Counter()
+        self.spans = []
+        self.started = time.monotonic()
+        self.duration = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name=f"profile-{profile_id[:8]}", daemon=True)
+        self._torch_profile = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+
+    def start(self):
+        torch = _torch()
+        if torch is not None and _torch_profile_lock.acquire(blocking=False):
+            try:
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self._torch_profile = torch.profiler.profile(activities=activities)
+                self._torch_profile.__enter__()
+            except Exception as e:
+                logger.warning(f"Не удалось запустить torch.profiler: {e}")
+                self._torch_profile = None
+                _torch_profile_lock.release()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.monotonic() - self.started
+        if self._torch_profile is not None:
+            try:
+                self._torch_profile.__exit__(None, None, None)
+            finally:
+                _torch_profile_lock.release()
+
+
+class Profiler:
+    """
+    Профилирование по запросу.
+
+    - профиль запроса: поток запроса опрашивается sys._current_frames() с шагом
+      interval, стеки сохраняются в формате collapsed (flamegraph), интервалы
+      span() - в JSON, трасса torch.profiler - в формате Chrome trace;
+    - непрерывный режим: все потоки процесса опрашиваются редко (continuous_interval),
+      выборки копятся в окнах по window секунд, хранится не больше windows окон.
+
+    Профили хранятся в папке folder, старые удаляются сверх лимита keep.
+    """
+    def __init__(self, folder, interval=0.005, keep=50, continuous_interval=0.1, window=60, windows=30):
+        self.folder = folder
+        self.interval = interval
+        self.keep = keep
+        self.continuous_interval = continuous_interval
+        self.window = window
+        self.windows = windows
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._armed = {}
+        self._continuous = None
+        self._continuous_pid = None
+        self._buffer = deque(maxlen=windows)
+
+    @classmethod
+    def from_env(cls, folder):
+        """
+        Настройки из переменных окружения:
+            PROFILE_INTERVAL_MS             шаг выборки профиля запроса, мс (5)
+            PROFILE_KEEP                    сколько профилей хранить (50)
+            PROFILE_CONTINUOUS_INTERVAL_MS  шаг непрерывной выборки, мс (100)
+            PROFILE_CONTINUOUS_WINDOW       длина окна непрерывной выборки, сек (60)
+            PROFILE_CONTINUOUS_WINDOWS      сколько окон хранить (30)
+        """
+        return cls(
+            folder,
+            interval=float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000,
+            keep=int(os.environ.get('PROFILE_KEEP', 50)),
+            continuous_interval=float(os.environ.get('PROFILE_CONTINUOUS_INTERVAL_MS', 100)) / 1000,
+            window=float(os.environ.get('PROFILE_CONTINUOUS_WINDOW', 60)),
+            windows=int(os.environ.get('PROFILE_CONTINUOUS_WINDOWS', 30)),
+        )
+
+    # --- профиль запроса ---
+
+    def arm(self, path, count=1):
+        """
+        Профилировать следующие count запросов к path (в этом процессе)
+        """
+        with self._lock:
+            if count > 0:
+                self._armed[path] = count
+            else:
+                self._armed.pop(path, None)
+
+    def take_armed(self, path):
+        with self._lock:
+            count = self._armed.get(path)
+            if not count:
+                return False
+            if count > 1:
+                self._armed[path] = count - 1
+            else:
+                del self._armed[path]
+            return True
+
+    def start_request(self, meta):
+        """
+        Начинает профилирование текущего потока. Возвращает ID профиля.
+        """
+        profile = RequestProfile(uuid.uuid4().hex, threading.get_ident(), self.interval, meta)
+        _local.profile = profile
+        profile.start()
+        return profile.id
+
+    def stop_request(self, meta=None):
+        """
+        Завершает профилирование текущего потока и сохраняет профиль.
+        meta - сведения, известные только в конце запроса (например, статус ответа).
+        """
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return None
+        _local.profile = None
+        profile.stop()
+        profile.meta.update(meta or {})
+        try:
+            self._store(profile)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить профиль {profile.id}: {e}")
+        return profile.id
+
+    def _path(self, profile_id, extension):
+        return os.path.join(self.folder, f"{profile_id}{extension}")
+
+    def _store(self, profile):
+        with atomic_write(self._path(profile.id, '.collapsed'), 'w', encoding='utf-8') as f:
+            f.write(format_collapsed(profile.samples))
+        if profile._torch_profile is not None:
+            profile._torch_profile.export_chrome_trace(self._path(profile.id, '.trace.json'))
+
+        info = {
+            "id": profile.id,
+            **profile.meta,
+            "created_at": time.time(),
+            "duration": round(profile.duration, 6),
+            "interval": profile.interval,
+            "samples": sum(profile.samples.values()),
+            "spans": profile.spans,
+            "torch_trace": profile._torch_profile is not None,
+        }
+        with atomic_write(self._path(profile.id, '.json'), 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False, indent=2)
+        self._trim()
+
+    def _trim(self):
+        profiles = sorted(
+            (entry.stat().st_mtime, entry.name[:-len('.json')])
+            for entry in os.scandir(self.folder)
+            if entry.name.endswith('.json') and not entry.name.endswith('.trace.json')
+        )
+        for _, profile_id in profiles[:max(0, len(profiles) - self.keep)]:
+            for extension in ('.json', '.collapsed', '.trace.json'):
+                try:
+                    os.remove(self._path(profile_id, extension))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self):
+        profiles = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.json') and not entry.name.endswith('.trace.json'):
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        info = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                info.pop('spans', None)
+                profiles.append(info)
+        return sorted(profiles, key=lambda p: p.get('created_at', 0), reverse=True)
+
+    def profile_file(self, profile_id, kind):
+        """
+        Путь к файлу профиля: kind - json, collapsed или trace. None, если файла нет.
+        """
+        extension = {"json": '.json', "collapsed": '.collapsed', "trace": '.trace.json'}.get(kind)
+        # ID профиля - hex, другие значения не должны превращаться в путь
+        if extension is None or not profile_id.isalnum():
+            return None
+        path = self._path(profile_id, extension)
+        return path if os.path.exists(path) else None
+
+    # --- непрерывная выборка ---
+
+    def set_continuous(self, enabled):
+        """
+        Включает или выключает непрерывную выборку в этом процессе
+        """
+        with self._lock:
+            running = self._continuous is not None and self._continuous_pid == os.getpid()
+            if enabled and not running:
+                self._continuous = threading.Event()
+                self._continuous_pid = os.getpid()
+                threading.Thread(
+                    target=self._continuous_loop, args=(self._continuous,), name='profile-continuous', daemon=True
+                ).start()
+            elif not enabled and running:
+                self._continuous.set()
+                self._continuous = None
+
+    def start_continuous(self):
+        """
+        Включает непрерывную выборку один раз на процесс (после форка).
+        Если ее затем выключили, повторно не включает.
+        """
+        if self._continuous_pid != os.getpid():
+            self.set_continuous(True)
+
+    @property
+    def continuous_enabled(self):
+        return self._continuous is not None and self._continuous_pid == os.getpid()
+
+    def _continuous_loop(self, stop):
+        own = threading.get_ident()
+        window_started = time.monotonic()
+        counts = Counter()
+        with self._lock:
+            self._buffer.append(counts)
+        while not stop.wait(self.continuous_interval):
+            stacks = [collapse_stack(frame) for thread_id, frame in sys._current_frames().items() if thread_id != own]
+            with self._lock:
+                counts.update(stacks)
+            if time.monotonic() - window_started >= self.window:
+                # Новое окно; самое старое вытесняется из ограниченного буфера
+                window_started = time.monotonic()
+                counts = Counter()
+                with self._lock:
+                    self._buffer.append(counts)
+
+    def continuous_profile(self):
+        """
+        Сумма выборок по всем хранимым окнам в формате collapsed
+        """
+        total = Counter()
+        with self._lock:
+            for counts in self._buffer:
+                total.update(counts)
+        return format_collapsed(total)
+
+    def status(self):
+        with self._lock:
+            return {
+                "continuous": self.continuous_enabled,
+                "continuous_windows": len(self._buffer),
+                "armed": dict(self._armed),
+            }
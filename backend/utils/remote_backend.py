@@ -0,0 +1,285 @@
+import os
+import io
+import time
+import base64
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from utils.storage import atomic_write
+from utils.image_utils import image_encoder
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteBackendError(Exception):
+    pass
+
+
+class RemoteBackend:
+    """
+    Состояние одного сервера генерации
+    """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "healthy": self.healthy,
+        }
+
+
+class RemoteBackendPool:
+    """
+    Пул удаленных серверов генерации (API в стиле AUTOMATIC1111: /txt2img, /img2img).
+
+    - одна HTTP-сессия с keep-alive и пулом соединений на все серверы;
+    - балансировка по наименьшему числу запросов в обработке;
+    - фоновые проверки здоровья, исключение сервера после серии ошибок;
+    - таймауты и повторы на другом сервере;
+    - если сервер умеет отдавать картинку напрямую (Content-Type: image/*),
+      ответ пишется в файл потоком, без base64 в памяти.
+    """
+    def __init__(self, urls, connect_timeout=5, read_timeout=300, retries=2, pool_size=16,
+                 health_path='/health', health_interval=10, eject_after=3, eject_time=30):
+        if not urls:
+            raise ValueError("Не задан ни один сервер генерации")
+        self.backends = [RemoteBackend(url) for url in urls]
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends), pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._health_thread = None
+        self._rotation = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Создает пул по переменным окружения:
+            SD_API_URL              адреса серверов через запятую
+            SD_API_CONNECT_TIMEOUT  таймаут соединения, сек (5)
+            SD_API_READ_TIMEOUT     таймаут ответа, сек (300)
+            SD_API_RETRIES          число повторов на других серверах (2)
+            SD_API_POOL_SIZE        соединений на сервер (16)
+            SD_API_HEALTH_PATH      путь проверки здоровья (/health)
+            SD_API_HEALTH_INTERVAL  период проверки здоровья, сек (10)
+        """
+        urls = [url.strip() for url in os.environ.get('SD_API_URL', 'http://localhost:7860/api/v1').split(',') if url.strip()]
+        return cls(
+            urls,
+            connect_timeout=float(os.environ.get('SD_API_CONNECT_TIMEOUT', 5)),
+            read_timeout=float(os.environ.get('SD_API_READ_TIMEOUT', 300)),
+            retries=int(os.environ.get('SD_API_RETRIES', 2)),
+            pool_size=int(os.environ.get('SD_API_POOL_SIZE', 16)),
+            health_path=os.environ.get('SD_API_HEALTH_PATH', '/health'),
+            health_interval=float(os.environ.get('SD_API_HEALTH_INTERVAL', 10)),
+        )
+
+    # --- выбор сервера и учет ошибок ---
+
+    def _acquire(self, exclude):
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and b.healthy]
+            if not candidates:
+                # Все исключены - пробуем тот, что вернется раньше остальных
+                candidates = sorted(
+                    (b for b in self.backends if b not in exclude),
+                    key=lambda b: b.ejected_until
+                )[:1]
+            if not candidates:
+                return None
+            # При равной загрузке серверы выбираются по кругу
+            self._rotation = (self._rotation + 1) % len(candidates)
+            candidates = candidates[self._rotation:] + candidates[:self._rotation]
+            backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def _release(self, backend, ok):
+        with self._lock:
+            backend.outstanding -= 1
+            if ok:
+                backend.failures = 0
+                backend.ejected_until = 0.0
+            else:
+                self._record_failure(backend)
+
+    def _record_failure(self, backend):
+        backend.failures += 1
+        if backend.failures >= self.eject_after:
+            backend.ejected_until = time.monotonic() + self.eject_time
+            logger.warning(f"Сервер генерации {backend.url} исключен на {self.eject_time} с")
+
+    # --- проверки здоровья ---
+
+    def _ensure_health_thread(self):
+        # Поток запускается при первом запросе, уже в воркере (после форка)
+        if self._health_thread is not None and self._health_thread.is_alive():
+            return
+        with self._lock:
+            if self._health_thread is not None and self._health_thread.is_alive():
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, name='sd-health', daemon=True)
+            self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            for backend in self.backends:
+                self.check_health(backend)
+
+    def check_health(self, backend):
+        try:
+            response = self.session.get(backend.url + self.health_path, timeout=self.timeout[0])
+            ok = response.status_code < 500
+        except requests.RequestException:
+            ok = False
+        with self._lock:
+            if ok:
+                if backend.failures:
+                    logger.info(f"Сервер генерации {backend.url} снова доступен")
+                backend.failures = 0
+                backend.ejected_until = 0.0
+            else:
+                self._record_failure(backend)
+        return ok
+
+    def status(self):
+        with self._lock:
+            return [backend.to_dict() for backend in self.backends]
+
+    # --- запросы ---
+
+    def _save_response(self, response, output_path):
+        content_type = response.headers.get('Content-Type', '')
+        expected_type = f"image/{image_encoder.output_format}"
+
+        if content_type.startswith(expected_type):
+            # Картинка в нужном формате - пишем поток прямо в файл
+            with atomic_write(output_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            return
+
+        if content_type.startswith('image/'):
+            image = Image.open(io.BytesIO(response.content))
+        else:
+            # JSON-ответ в стиле AUTOMATIC1111: {"images": ["<base64>", ...]}
+            images = response.json().get('images') or []
+            if not images:
+                raise RemoteBackendError("Сервер не вернул изображений")
+            image = Image.open(io.BytesIO(base64.b64decode(images[0].split(',', 1)[-1])))
+        image.load()
+        image_encoder.save(image, output_path)
+
+    def request(self, endpoint, payload, output_path):
+        """
+        Отправляет запрос генерации и сохраняет результат в output_path.
+        При сбое сервера (5xx, нет соединения, таймаут) повторяет запрос на другом сервере;
+        ответ 4xx - ошибка самого запроса, он сразу возвращается вызывающему.
+        """
+        self._ensure_health_thread()
+        tried = set()
+        last_error = None
+
+        for _ in range(self.retries + 1):
+            backend = self._acquire(tried)
+            if backend is None:
+                break
+            tried.add(backend)
+            failed = False
+            rejected = None
+            try:
+                with self.session.post(
+                    f"{backend.url}/{endpoint}",
+                    json=payload,
+                    timeout=self.timeout,
+                    stream=True,
+                    headers={"Accept": f"image/{image_encoder.output_format}, application/json"},
+                ) as response:
+                    if 400 <= response.status_code < 500:
+                        rejected = RemoteBackendError(
+                            f"Сервер генерации {backend.url} отклонил запрос: "
+                            f"{response.status_code} {response.text[:200]}"
+                        )
+                    else:
+                        response.raise_for_status()
+                        self._save_response(response, output_path)
+                        return True
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                # Сбой сервера - учитывается при исключении сервера из ротации
+                failed = True
+                last_error = e
+                logger.warning(f"Ошибка сервера генерации {backend.url}: {e}")
+            except (requests.RequestException, RemoteBackendError, ValueError, OSError) as e:
+                # Некорректный ответ: пробуем другой сервер, но сбоем это не считаем
+                last_error = e
+                logger.warning(f"Ошибка ответа сервера генерации {backend.url}: {e}")
+            finally:
+                self._release(backend, not failed)
+            if rejected is not None:
+                logger.warning(str(rejected))
+                raise rejected
+
+        raise RemoteBackendError(f"Все попытки генерации неудачны: {last_error}")
+
+    @staticmethod
+    def encode_image(image):
+        """
+        Кодирует изображение (PIL или путь) в base64 PNG для JSON-запроса
+        """
+        if isinstance(image, str):
+            image = image_encoder.load(image)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=1)
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    def txt2img(self, prompt, output_path, negative_prompt="", width=512, height=768, pose_image=None):
+        payload = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "width": width,
+            "height": height,
+        }
+        if pose_image is not None:
+            payload["alwayson_scripts"] = {
+                "controlnet": {
+                    "args": [{
+                        "image": self.encode_image(pose_image),
+                        "module": "none",
+                        "model": os.environ.get('SD_API_CONTROLNET_MODEL', 'control_v11p_sd15_openpose'),
+                    }]
+                }
+            }
+        return self.request('txt2img', payload, output_path)
+
+    def img2img(self, prompt, init_image, output_path, negative_prompt="", strength=0.6, width=512, height=768):
+        payload = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "init_images": [self.encode_image(init_image)],
+            "denoising_strength": strength,
+            "width": width,
+            "height": height,
+        }
+        return self.request('img2img', payload, output_path)
@@ -0,0 +1,122 @@
+"""
+Локальный сервер-заглушка с API генерации (/txt2img, /img2img, /health).
+
+Нужен для проверки удаленного режима (SD_BACKEND=remote) без GPU:
+    python -m utils.sd_stub_server --port 7861
+    SD_BACKEND=remote SD_API_URL=http://localhost:7861/api/v1 python app.py
+
+Если клиент принимает image/* (заголовок Accept), картинка отдается напрямую,
+иначе - JSON с base64, как у AUTOMATIC1111. Параметры --delay и --fail-rate
+позволяют проверить таймауты, повторы и исключение серверов. Запрос без prompt
+(или img2img без init_images) получает 422, как у AUTOMATIC1111.
+В тестах заглушка запускается в фоновом потоке через start_stub_server().
+"""
+import io
+import json
+import time
+import base64
+import random
+import argparse
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image, ImageDraw
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'png': 'PNG', 'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0.0
+    fail_rate = 0.0
+    # Пути принятых POST-запросов (для тестов)
+    received = None
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.endswith('/health'):
+            self._send(200, 'application/json', b'{"status": "ok"}')
+        else:
+            self._send(404, 'application/json', b'{"error": "not found"}')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+
+        if not (self.path.endswith('/txt2img') or self.path.endswith('/img2img')):
+            self._send(404, 'application/json', b'{"error": "not found"}')
+            return
+        if self.received is not None:
+            self.received.append(self.path)
+        if not payload.get('prompt') or (self.path.endswith('/img2img') and not payload.get('init_images')):
+            self._send(422, 'application/json', b'{"error": "prompt and init_images are required"}')
+            return
+
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self._send(503, 'application/json', b'{"error": "overloaded"}')
+            return
+
+        width = int(payload.get('width', 512))
+        height = int(payload.get('height', 768))
+        image = Image.new('RGB', (width, height), (230, 235, 245))
+        draw = ImageDraw.Draw(image)
+        draw.text((10, 10), f"stub {self.path.rsplit('/', 1)[-1]}: {payload.get('prompt', '')[:80]}", fill=(0, 0, 0))
+
+        accept = self.headers.get('Accept', '')
+        for name, pil_format in FORMATS.items():
+            if f"image/{name}" in accept:
+                buffer = io.BytesIO()
+                image.save(buffer, format=pil_format)
+                self._send(200, f"image/{name}", buffer.getvalue())
+                return
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        body = json.dumps({"images": [base64.b64encode(buffer.getvalue()).decode('ascii')]}).encode('utf-8')
+        self._send(200, 'application/json', body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def start_stub_server(host='127.0.0.1', port=0, delay=0.0, fail_rate=0.0):
+    """
+    Запускает заглушку в фоновом потоке (port=0 - свободный порт).
+    Возвращает сервер: адрес - server.url, принятые запросы - server.received,
+    остановка - server.shutdown().
+    """
+    handler = type('StubHandler', (StubHandler,), {"delay": delay, "fail_rate": fail_rate, "received": []})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.url = f"http://{host}:{server.server_address[1]}/api/v1"
+    server.received = handler.received
+    threading.Thread(target=server.serve_forever, name='sd-stub', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сервер-заглушка API генерации")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7861)
+    parser.add_argument('--delay', type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="доля ответов 503")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    StubHandler.delay = args.delay
+    StubHandler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    logger.info(f"Stub generation server on http://{args.host}:{args.port}/api/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,12 @@ import os
 import sys
 import logging
 import io
+import threading
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
+from utils.image_utils import image_encoder
+from utils.storage import atomic_write
+from utils.profiler import span
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +16,13 @@ class StableDiffusionWrapper:
         self.api_url = os.environ.get('SD_API_URL', 'http://localhost:7860/api/v1')
         self.is_initialized = False
         self.mock_mode = mock_mode
+        self.controlnet_pipeline = None
+        self.img2img_pipeline = None
+        
+        # Эмбеддинги промптов: описание персонажа кодируется один раз на процесс
+        self._prompt_embeddings = OrderedDict()
+        self._prompt_embeddings_lock = threading.Lock()
+        self.prompt_cache_size = int(os.environ.get('PROMPT_EMBEDDING_CACHE', 256))
         
         # В реальном режиме будут проверки наличия GPU и т.д.
         if not mock_mode:
@@ -22,6 +34,15 @@ class StableDiffusionWrapper:
                 logger.warning("PyTorch not available, forcing mock mode")
                 self.mock_mode = True
                 self.device = "cpu"
+        
+        # Удаленный режим: генерация на серверах из SD_API_URL, локальные модели не нужны
+        self.remote = None
+        if os.environ.get('SD_BACKEND', 'local').lower() == 'remote':
+            from utils.remote_backend import RemoteBackendPool
+            self.remote = RemoteBackendPool.from_env()
+            self.mock_mode = False
+            self.is_initialized = True
+            logger.info(f"Using remote generation backends: {[b.url for b in self.remote.backends]}")
     
     def initialize(self):
         """
@@ -74,10 +95,69 @@ class StableDiffusionWrapper:
             return self.initialize()
         return True
     
-    def generate(self, prompt, output_path, negative_prompt="", width=512, height=768):
+    def _call_remote(self, method, *args, **kwargs):
+        """
+        Вызывает удаленный сервер генерации. В отличие от локального режима
+        ошибка не подменяется мок-изображением, а возвращается как неудача.
+        """
+        from utils.remote_backend import RemoteBackendError
+        try:
+            return method(*args, **kwargs)
+        except RemoteBackendError as e:
+            logger.error(f"Remote generation failed: {e}")
+            return False
+    
+    def _save_latents(self, latents, latents_path):
+        """
+        Сохраняет латенты в сжатый .npz (float16) рядом с изображением
+        """
+        import numpy as np
+        array = latents.detach().to("cpu").float().numpy().astype(np.float16)
+        with atomic_write(latents_path, 'wb') as f:
+            np.savez_compressed(f, latents=array)
+    
+    def _load_latents(self, latents_path):
+        import numpy as np
+        import torch
+        with np.load(latents_path) as data:
+            array = data['latents']
+        return torch.from_numpy(array).to(device=self.device, dtype=self.anime_model.unet.dtype)
+    
+    def _decode_latents(self, latents):
+        import torch
+        vae = self.anime_model.vae
+        with torch.no_grad():
+            decoded = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+        return self.anime_model.image_processor.postprocess(decoded, output_type="pil")[0]
+    
+    def _run_pipeline(self, pipeline, output_path, latents_path=None, **kwargs):
+        """
+        Запускает пайплайн и сохраняет изображение.
+        Если задан latents_path, финальные латенты сохраняются для повторного использования.
+        """
+        if latents_path is None:
+            with span("diffusion"):
+                image = pipeline(**kwargs).images[0]
+        else:
+            with span("diffusion"):
+                latents = pipeline(output_type="latent", **kwargs).images
+            with span("save_latents"):
+                self._save_latents(latents, latents_path)
+            with span("vae_decode"):
+                image = self._decode_latents(latents)
+        
+        # Сохраняем изображение: кодирование идет в фоновом пуле,
+        # здесь измеряется только постановка в очередь
+        with span("submit_encode"):
+            image_encoder.save(image, output_path)
+    
+    def generate(self, prompt, output_path, negative_prompt="", width=512, height=768, latents_path=None):
         """
         Генерирует изображение на основе текстового описания
         """
+        if self.remote:
+            return self._call_remote(self.remote.txt2img, prompt, output_path, negative_prompt, width, height)
+        
         if self.mock_mode:
             return self._create_mock_image(prompt, output_path, width, height)
             
@@ -85,26 +165,77 @@ class StableDiffusionWrapper:
             return self._create_mock_image(prompt, output_path, width, height)
         
         try:
-            # В реальном проекте здесь будет вызов модели для генерации изображения
-            image = self.anime_model(
+            self._run_pipeline(
+                self.anime_model,
+                output_path,
+                latents_path,
                 prompt=prompt,
                 negative_prompt=negative_prompt,
                 width=width,
                 height=height,
-            ).images[0]
-            
-            # Сохраняем изображение
-            image.save(output_path)
+            )
             
             return True
         except Exception as e:
             logger.error(f"Error generating image: {e}")
             return self._create_mock_image(prompt, output_path, width, height)
     
+    def _get_img2img_pipeline(self):
+        """
+        Собирает img2img-пайплайн из компонентов аниме-модели
+        """
+        if self.img2img_pipeline is None:
+            from diffusers import StableDiffusionImg2ImgPipeline
+            self.img2img_pipeline = StableDiffusionImg2ImgPipeline(**self.anime_model.components)
+        return self.img2img_pipeline
+    
+    def generate_from_latents(self, prompt, source_latents_path, output_path, negative_prompt="",
+                              strength=0.5, latents_path=None, width=512, height=768, source_image=None):
+        """
+        Генерирует изображение, начиная с сохраненных латентов (img2img в латентном пространстве).
+        Выполняется только доля шагов, равная strength. Если латентов нет,
+        выполняется полная генерация.
+        source_image - исходное изображение: удаленные серверы латентов не принимают,
+        поэтому им отправляется img2img по изображению с той же strength.
+        """
+        if self.remote:
+            # Исходное изображение могло еще не дописаться в фоне
+            if source_image and image_encoder.wait(source_image):
+                return self._call_remote(
+                    self.remote.img2img, prompt, source_image, output_path, negative_prompt, strength, width, height
+                )
+            return self.generate(prompt, output_path, negative_prompt, width, height, latents_path)
+        
+        if self.mock_mode or not source_latents_path or not os.path.exists(source_latents_path):
+            return self.generate(prompt, output_path, negative_prompt, width, height, latents_path)
+            
+        if not self.check_initialized():
+            return self._create_mock_image(prompt, output_path, width, height)
+        
+        try:
+            # Тензор с 4 каналами пайплайн воспринимает как готовые латенты и не кодирует VAE
+            self._run_pipeline(
+                self._get_img2img_pipeline(),
+                output_path,
+                latents_path,
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=self._load_latents(source_latents_path),
+                strength=strength,
+            )
+            
+            return True
+        except Exception as e:
+            logger.error(f"Error generating image from latents: {e}")
+            return self.generate(prompt, output_path, negative_prompt, width, height, latents_path)
+    
     def generate_with_reference(self, prompt, reference_image, output_path, negative_prompt=""):
         """
         Генерирует изображение на основе текстового описания и референсного изображения
         """
+        if self.remote:
+            return self._call_remote(self.remote.img2img, prompt, reference_image, output_path, negative_prompt)
+        
         if self.mock_mode:
             return self._create_mock_image(prompt, output_path, ref_image=reference_image)
             
@@ -114,7 +245,7 @@ class StableDiffusionWrapper:
         try:
             # Загружаем референсное изображение
             if isinstance(reference_image, str):
-                reference_img = Image.open(reference_image)
+                reference_img = image_encoder.load(reference_image)
             else:
                 reference_img = reference_image
             
@@ -124,42 +255,215 @@ class StableDiffusionWrapper:
             # В реальном проекте здесь будет вызов IP-Adapter или другого метода для сохранения персонажа
             
             # Для демонстрации просто копируем референсное изображение
-            reference_img.save(output_path)
+            image_encoder.save(reference_img, output_path)
             
             return True
         except Exception as e:
             logger.error(f"Error generating image with reference: {e}")
             return self._create_mock_image(prompt, output_path, ref_image=reference_image)
     
-    def generate_scene(self, prompt, character_image, output_path, negative_prompt=""):
+    def _get_controlnet_pipeline(self):
+        """
+        Собирает пайплайн ControlNet из компонентов аниме-модели,
+        чтобы не загружать веса повторно
+        """
+        if self.controlnet_pipeline is None:
+            from diffusers import StableDiffusionControlNetPipeline
+            self.controlnet_pipeline = StableDiffusionControlNetPipeline(
+                **self.anime_model.components,
+                controlnet=self.controlnet,
+            )
+        return self.controlnet_pipeline
+    
+    def generate_scene(self, prompt, character_image, output_path, negative_prompt="", pose_image=None,
+                       width=768, height=512, latents_path=None):
         """
-        Генерирует сюжетную сцену с персонажем
+        Генерирует сюжетную сцену с персонажем.
+        pose_image - карта позы OpenPose для ControlNet.
+        character_image (путь к изображению персонажа) сейчас не используется:
+        внешность персонажа задается только текстом промпта.
         """
+        if self.remote:
+            with span("remote_txt2img"):
+                return self._call_remote(
+                    self.remote.txt2img, prompt, output_path, negative_prompt, width, height, pose_image=pose_image
+                )
+        
         if self.mock_mode:
-            return self._create_mock_image(prompt, output_path, width=768, height=512, scene=True)
+            with span("mock_image"):
+                return self._create_mock_image(prompt, output_path, width=width, height=height, scene=True)
             
         if not self.check_initialized():
-            return self._create_mock_image(prompt, output_path, width=768, height=512, scene=True)
+            return self._create_mock_image(prompt, output_path, width=width, height=height, scene=True)
         
         try:
-            # Загружаем изображение персонажа
-            if isinstance(character_image, str):
-                char_img = Image.open(character_image)
-            else:
-                char_img = character_image
-            
-            # В реальном проекте здесь будет использование ControlNet для сохранения персонажа
-            
-            # Для демонстрации создаем тестовое изображение
-            image = self._create_dummy_image(768, 512)
+            # Без позы генерируем сцену только по описанию
+            if pose_image is None:
+                return self.generate(prompt, output_path, negative_prompt, width, height, latents_path)
             
-            # Сохраняем изображение
-            image.save(output_path)
+            # Поза задает композицию кадра через ControlNet OpenPose
+            with span("load_controlnet_pipeline"):
+                pipeline = self._get_controlnet_pipeline()
+            self._run_pipeline(
+                pipeline,
+                output_path,
+                latents_path,
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=pose_image,
+                width=width,
+                height=height,
+            )
             
             return True
         except Exception as e:
             logger.error(f"Error generating scene: {e}")
-            return self._create_mock_image(prompt, output_path, width=768, height=512, scene=True)
+            return self._create_mock_image(prompt, output_path, width=width, height=height, scene=True)
+    
+    def _encode_prompt(self, prompt):
+        """
+        Эмбеддинг текста для UNet (с LRU-кэшем по тексту промпта)
+        """
+        import torch
+        with self._prompt_embeddings_lock:
+            embedding = self._prompt_embeddings.get(prompt)
+            if embedding is not None:
+                self._prompt_embeddings.move_to_end(prompt)
+                return embedding
+        
+        pipe = self.anime_model
+        tokens = pipe.tokenizer(
+            prompt,
+            padding="max_length",
+            max_length=pipe.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        with torch.no_grad():
+            embedding = pipe.text_encoder(tokens.input_ids.to(self.device))[0]
+        
+        with self._prompt_embeddings_lock:
+            self._prompt_embeddings[prompt] = embedding
+            while len(self._prompt_embeddings) > self.prompt_cache_size:
+                self._prompt_embeddings.popitem(last=False)
+        return embedding
+    
+    def _region_masks(self, regions, width, height):
+        """
+        Маски областей в разрешении латентов, форма (N, 1, h, w).
+        В местах пересечения областей веса делятся поровну.
+        """
+        import torch
+        h, w = height // 8, width // 8
+        masks = torch.zeros(len(regions), 1, h, w)
+        for index, (x0, y0, x1, y1) in enumerate(regions):
+            masks[index, :, round(y0 * h):round(y1 * h), round(x0 * w):round(x1 * w)] = 1.0
+        coverage = masks.sum(dim=0, keepdim=True)
+        return masks / coverage.clamp(min=1.0)
+    
+    def _regional_denoise(self, embeddings, masks, pose_image, width, height, steps, guidance_scale, region_weight):
+        """
+        Цикл денойзинга с региональными промптами.
+        embeddings - [негативный, общий, регион 1, ..., регион N]: на каждом шаге
+        UNet (и ControlNet) вызывается одним батчем, затем предсказания регионов
+        подмешиваются к общему по маскам и применяется classifier-free guidance.
+        """
+        import torch
+        pipe = self.anime_model
+        unet = pipe.unet
+        # Свой планировщик на вызов: у планировщика есть состояние шагов
+        scheduler = pipe.scheduler.__class__.from_config(pipe.scheduler.config)
+        scheduler.set_timesteps(steps, device=self.device)
+        
+        batch = embeddings.shape[0]
+        masks = masks.to(device=self.device, dtype=unet.dtype)
+        coverage = masks.sum(dim=0, keepdim=True)
+        
+        latents = torch.randn(
+            (1, unet.config.in_channels, height // 8, width // 8), device=self.device, dtype=unet.dtype
+        ) * scheduler.init_noise_sigma
+        
+        control = None
+        if pose_image is not None:
+            control = self._get_controlnet_pipeline().prepare_image(
+                image=pose_image,
+                width=width,
+                height=height,
+                batch_size=batch,
+                num_images_per_prompt=1,
+                device=self.device,
+                dtype=self.controlnet.dtype,
+            )
+        
+        with torch.no_grad():
+            for t in scheduler.timesteps:
+                model_input = scheduler.scale_model_input(latents, t).expand(batch, -1, -1, -1)
+                residuals = {}
+                if control is not None:
+                    down, mid = self.controlnet(
+                        model_input, t, encoder_hidden_states=embeddings, controlnet_cond=control, return_dict=False
+                    )
+                    residuals = {"down_block_additional_residuals": down, "mid_block_additional_residual": mid}
+                noise = unet(model_input, t, encoder_hidden_states=embeddings, return_dict=False, **residuals)[0]
+                
+                uncond, base, regional = noise[:1], noise[1:2], noise[2:]
+                cond = base * (1 - region_weight * coverage) + region_weight * (regional * masks).sum(dim=0, keepdim=True)
+                noise_pred = uncond + guidance_scale * (cond - uncond)
+                latents = scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+        return latents
+    
+    def generate_regional_scene(self, prompt, regions, output_path, negative_prompt="", pose_image=None,
+                                width=768, height=512, latents_path=None):
+        """
+        Генерирует сцену с несколькими персонажами за один проход диффузии.
+        prompt - общее описание сцены, regions - список (промпт персонажа, (x0, y0, x1, y1))
+        с областью в долях кадра. Эмбеддинги промптов персонажей кэшируются,
+        поэтому сцена с N персонажами стоит примерно как одна генерация.
+        """
+        combined_prompt = ", ".join([prompt] + [region_prompt for region_prompt, _ in regions])
+        
+        if self.remote:
+            # Удаленные серверы не поддерживают региональные промпты - отправляем общий промпт
+            with span("remote_txt2img"):
+                return self._call_remote(
+                    self.remote.txt2img, combined_prompt, output_path, negative_prompt, width, height,
+                    pose_image=pose_image
+                )
+        
+        if self.mock_mode or not self.check_initialized():
+            with span("mock_image"):
+                return self._create_mock_image(combined_prompt, output_path, width=width, height=height, scene=True)
+        
+        try:
+            import torch
+            with span("encode_prompts"):
+                embeddings = torch.cat(
+                    [self._encode_prompt(negative_prompt), self._encode_prompt(prompt)]
+                    + [self._encode_prompt(region_prompt) for region_prompt, _ in regions]
+                )
+            with span("diffusion"):
+                latents = self._regional_denoise(
+                    embeddings,
+                    self._region_masks([region for _, region in regions], width, height),
+                    pose_image,
+                    width,
+                    height,
+                    steps=int(os.environ.get('SCENE_STEPS', 30)),
+                    guidance_scale=float(os.environ.get('SCENE_GUIDANCE_SCALE', 7.5)),
+                    region_weight=float(os.environ.get('REGION_WEIGHT', 0.8)),
+                )
+            if latents_path is not None:
+                with span("save_latents"):
+                    self._save_latents(latents, latents_path)
+            with span("vae_decode"):
+                image = self._decode_latents(latents)
+            with span("submit_encode"):
+                image_encoder.save(image, output_path)
+            
+            return True
+        except Exception as e:
+            logger.error(f"Error generating regional scene: {e}")
+            return self._create_mock_image(combined_prompt, output_path, width=width, height=height, scene=True)
     
     def _create_mock_image(self, prompt, output_path, width=512, height=768, ref_image=None, scene=False):
         """
@@ -247,13 +551,13 @@ class StableDiffusionWrapper:
                 draw.line([(0, y), (width, y)], fill=light_color)
                 
             # Сохраняем изображение
-            image.save(output_path)
+            image_encoder.save(image, output_path)
             
             return True
         except Exception as e:
             logger.error(f"Error creating mock image: {e}")
             # В крайнем случае создаем совсем простое изображение
-            self._create_dummy_image(width, height).save(output_path)
+            image_encoder.save(self._create_dummy_image(width, height), output_path)
             return True
     
     def _create_dummy_image(self, width, height):
@@ -0,0 +1,363 @@
+import os
+import json
+import time
+import hashlib
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # На Windows межпроцессная блокировка недоступна,
+    # там сервер работает в одном процессе (waitress)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def fsync_dir(path):
+    """
+    Сбрасывает на диск запись каталога (нужно после rename)
+    """
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_write(path, mode='wb', encoding=None):
+    """
+    Пишет файл через временный файл в той же папке, fsync и rename.
+    Читатели видят либо старую, либо новую версию файла целиком.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_dir(directory)
+
+
+def atomic_copy(source, destination):
+    """
+    Атомарно копирует файл
+    """
+    with open(source, 'rb') as src, atomic_write(destination, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    shutil.copystat(source, destination)
+    return destination
+
+
+def write_json_atomic(path, data):
+    """
+    Атомарно записывает JSON-файл
+    """
+    with atomic_write(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def shard_dir(record_id):
+    """
+    Подпапка для записи: два уровня по 256 папок по хэшу ID,
+    чтобы в одной папке не скапливались миллионы файлов
+    """
+    digest = hashlib.sha1(record_id.encode('utf-8')).hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
+
+
+def sharded_path(folder, record_id, filename):
+    """
+    Путь к файлу записи в шардированной структуре папок
+    """
+    return os.path.join(folder, shard_dir(record_id), filename)
+
+
+def relative_path(folder, path):
+    """
+    Путь относительно папки хранилища в формате URL
+    """
+    return os.path.relpath(path, folder).replace(os.sep, '/')
+
+
+def path_from_url(folder, url):
+    """
+    Путь к файлу по URL вида /uploads/<папка>/<относительный путь>
+    """
+    relative = url.split('/', 3)[3]
+    return os.path.join(folder, *relative.split('/'))
+
+
+class MetadataStore:
+    """
+    Хранилище метаданных: JSON-снапшот и журнал изменений (append-only).
+
+    Каждое изменение дописывается в журнал одной строкой и сбрасывается на диск,
+    снапшот периодически перезаписывается атомарно, а журнал очищается.
+    При запуске состояние восстанавливается как снапшот + журнал, без обхода
+    папки uploads. Запись защищена блокировкой потоков и файловой блокировкой
+    процессов, поэтому несколько воркеров могут работать с одним хранилищем.
+    """
+    CORRUPT_SUFFIX = '.corrupt-'
+
+    def __init__(self, path, compact_every=500):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock_path = path + '.lock'
+        self.compact_every = compact_every
+
+        self._lock = threading.RLock()
+        self._records = {}
+        self._snapshot_id = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.reload()
+
+    # --- блокировки ---
+
+    @contextmanager
+    def _process_lock(self, exclusive):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    # --- чтение с диска ---
+
+    def _file_id(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            # Не затираем поврежденный файл - откладываем его для ручного восстановления
+            corrupt_path = f"{self.path}{self.CORRUPT_SUFFIX}{int(time.time())}"
+            logger.error(f"Ошибка при чтении файла метаданных: {self.path}, файл сохранен как {corrupt_path}")
+            os.replace(self.path, corrupt_path)
+            return {}
+
+    def _apply(self, entry):
+        op = entry.get('op')
+        if op == 'put':
+            self._records[entry['id']] = entry['record']
+        elif op == 'delete':
+            self._records.pop(entry['id'], None)
+        else:
+            logger.warning(f"Неизвестная операция в журнале {self.journal_path}: {op}")
+
+    def _replay_journal(self):
+        """
+        Применяет записи журнала, добавленные с прошлого чтения.
+        Недописанная последняя строка (сбой во время записи) пропускается.
+        """
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        end = data.rfind(b'\n')
+        if end < 0:
+            return
+
+        for line in data[:end].split(b'\n'):
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+                self._journal_entries += 1
+            except (ValueError, KeyError) as e:
+                logger.error(f"Пропущена поврежденная запись журнала {self.journal_path}: {e}")
+        self._journal_offset += end + 1
+
+    def _refresh(self):
+        """
+        Подтягивает изменения, сделанные другими процессами
+        """
+        snapshot_id = self._file_id(self.path)
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            journal_size = 0
+
+        if snapshot_id != self._snapshot_id or journal_size < self._journal_offset:
+            self._records = self._load_snapshot()
+            self._snapshot_id = self._file_id(self.path)
+            self._journal_offset = 0
+            self._journal_entries = 0
+
+        if journal_size > self._journal_offset:
+            self._replay_journal()
+
+    def reload(self):
+        """
+        Полностью перечитывает снапшот и журнал
+        """
+        with self._lock, self._process_lock(exclusive=False):
+            self._snapshot_id = None
+            self._refresh()
+
+    # --- запись ---
+
+    def _append(self, entries):
+        payload = b''.join(
+            json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n'
+            for entry in entries
+        )
+        with open(self.journal_path, 'ab') as f:
+            # Хвост после последней полной строки - след прерванной записи, отрезаем его
+            if f.tell() > self._journal_offset:
+                f.truncate(self._journal_offset)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_offset += len(payload)
+        for entry in entries:
+            self._apply(entry)
+            self._journal_entries += 1
+
+    def _write(self, entries):
+        with self._lock, self._process_lock(exclusive=True):
+            self._refresh()
+            self._append(entries)
+            if self._journal_entries >= self.compact_every:
+                self._compact()
+
+    def put(self, record_id, record):
+        """
+        Сохраняет запись
+        """
+        self._write([{"op": "put", "id": record_id, "record": record}])
+
+    def put_many(self, records):
+        """
+        Сохраняет несколько записей одной операцией записи в журнал
+        """
+        entries = [{"op": "put", "id": record_id, "record": record} for record_id, record in records.items()]
+        if entries:
+            self._write(entries)
+
+    def delete(self, record_id):
+        """
+        Удаляет запись. Возвращает False, если записи не было.
+        """
+        with self._lock, self._process_lock(exclusive=True):
+            self._refresh()
+            if record_id not in self._records:
+                return False
+            self._append([{"op": "delete", "id": record_id}])
+            if self._journal_entries >= self.compact_every:
+                self._compact()
+            return True
+
+    def _compact(self):
+        write_json_atomic(self.path, self._records)
+        # Если сбой произойдет до очистки журнала, повторное применение записей
+        # к новому снапшоту даст тот же результат
+        with open(self.journal_path, 'wb') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._snapshot_id = self._file_id(self.path)
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+    def compact(self):
+        """
+        Записывает снапшот и очищает журнал
+        """
+        with self._lock, self._process_lock(exclusive=True):
+            self._refresh()
+            self._compact()
+
+    # --- доступ к данным ---
+
+    def _read(self):
+        with self._lock, self._process_lock(exclusive=False):
+            self._refresh()
+            return self._records
+
+    def get(self, record_id, default=None):
+        with self._lock:
+            record = self._read().get(record_id)
+            return dict(record) if record is not None else default
+
+    def __getitem__(self, record_id):
+        record = self.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def __contains__(self, record_id):
+        with self._lock:
+            return record_id in self._read()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._read())
+
+    def keys(self):
+        with self._lock:
+            return list(self._read().keys())
+
+    def values(self):
+        with self._lock:
+            return [dict(record) for record in self._read().values()]
+
+    def items(self):
+        with self._lock:
+            return [(record_id, dict(record)) for record_id, record in self._read().items()]
+
+    def corrupt_snapshots(self):
+        """
+        Отложенные поврежденные снапшоты. Пока они есть, хранилище могло потерять
+        записи, и по его содержимому нельзя решать, какие файлы лишние.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + self.CORRUPT_SUFFIX
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix))
+
+    def version(self):
+        """
+        Метка состояния хранилища: меняется при любом изменении,
+        в том числе сделанном другим процессом. Для кэшей поверх хранилища.
+        """
+        with self._lock:
+            self._read()
+            return (self._snapshot_id, self._journal_offset)
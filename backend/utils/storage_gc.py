@@ -0,0 +1,341 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from utils.storage import sharded_path, relative_path
+from utils.admission import TokenBucket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_flat_layout(folder, store, url_prefix):
+    """
+    Переносит файлы из плоской папки (<uuid>.png) в шардированную структуру
+    и обновляет пути в метаданных. Повторный запуск ничего не делает.
+    """
+    def move(record_id, relative):
+        if '/' in relative:
+            return relative
+        source = os.path.join(folder, relative)
+        destination = sharded_path(folder, record_id, relative)
+        if os.path.exists(source):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(source, destination)
+        elif not os.path.exists(destination):
+            return relative
+        return relative_path(folder, destination)
+
+    changed = {}
+    for record_id, record in store.items():
+        updated = dict(record)
+        if updated.get('image_url'):
+            updated['image_url'] = f"{url_prefix}/{move(record_id, updated['image_url'].split('/', 3)[3])}"
+        if updated.get('references'):
+            updated['references'] = [
+                f"{url_prefix}/{move(record_id, url.split('/', 3)[3])}" for url in updated['references']
+            ]
+        if updated.get('latents'):
+            updated['latents'] = move(record_id, updated['latents'])
+        if updated != record:
+            changed[record_id] = updated
+
+    if changed:
+        store.put_many(changed)
+        logger.info(f"Перенесено в шардированную структуру записей: {len(changed)} ({folder})")
+    return len(changed)
+
+
+class StorageGC:
+    """
+    Фоновая очистка папки uploads.
+
+    - удаляет временные загрузки старше temp_ttl;
+    - удаляет сцены персонажей, которых больше нет;
+    - сверяет метаданные с файлами и удаляет файлы-сироты старше orphan_grace;
+    - при превышении квоты на диск удаляет производные данные (латенты), начиная со старых;
+    - удаляет фоновые задачи (и их результаты), не обновлявшиеся дольше jobs_ttl;
+    - дописывает в индекс хэшей персонажей, которых в нем нет (созданных до его появления).
+
+    Удаления ограничены по скорости, обход папок идет с паузами,
+    чтобы не создавать всплесков нагрузки на диск. Если сервер запущен
+    в несколько процессов, очистку выполняет только один из них.
+
+    Сироты не удаляются, пока у хранилища метаданных есть отложенный поврежденный
+    снапшот, а также если за проход пришлось бы удалить больше max_orphan_fraction
+    файлов или сцен: такая картина говорит о потере метаданных, а не о мусоре.
+    """
+    # Столько сирот удаляется без проверки доли (маленькие хранилища)
+    ORPHAN_MIN_CHECKED = 2
+
+    def __init__(self, uploads_folder, character_generator, scene_generator, temp_folder, jobs=None,
+                 interval=600, temp_ttl=3600, orphan_grace=3600, quota_bytes=0, deletes_per_second=20,
+                 max_orphan_fraction=0.1, jobs_ttl=7 * 24 * 3600):
+        self.uploads_folder = uploads_folder
+        self.character_generator = character_generator
+        self.scene_generator = scene_generator
+        self.temp_folder = temp_folder
+        self.jobs = jobs
+        self.jobs_ttl = jobs_ttl
+        self.interval = interval
+        self.temp_ttl = temp_ttl
+        self.orphan_grace = orphan_grace
+        self.quota_bytes = quota_bytes
+        self.max_orphan_fraction = max_orphan_fraction
+        self._deletes = TokenBucket(deletes_per_second, max(1, deletes_per_second))
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.last_run = None
+
+    @classmethod
+    def from_env(cls, uploads_folder, character_generator, scene_generator, temp_folder, jobs=None):
+        """
+        Настройки из переменных окружения:
+            GC_INTERVAL             период очистки, сек (600)
+            TEMP_TTL                время жизни временных загрузок, сек (3600)
+            ORPHAN_GRACE            возраст файла-сироты для удаления, сек (3600)
+            DISK_QUOTA_MB           квота на папку uploads, МБ, 0 - без квоты (0)
+            GC_DELETES_PER_SECOND   максимум удалений в секунду (20)
+            GC_MAX_ORPHAN_FRACTION  максимальная доля сирот, удаляемых за проход (0.1)
+            JOBS_TTL                время хранения фоновых задач и их результатов, сек (604800)
+        """
+        return cls(
+            uploads_folder,
+            character_generator,
+            scene_generator,
+            temp_folder,
+            jobs,
+            interval=float(os.environ.get('GC_INTERVAL', 600)),
+            temp_ttl=float(os.environ.get('TEMP_TTL', 3600)),
+            orphan_grace=float(os.environ.get('ORPHAN_GRACE', 3600)),
+            quota_bytes=int(float(os.environ.get('DISK_QUOTA_MB', 0)) * 1024 * 1024),
+            deletes_per_second=float(os.environ.get('GC_DELETES_PER_SECOND', 20)),
+            max_orphan_fraction=float(os.environ.get('GC_MAX_ORPHAN_FRACTION', 0.1)),
+            jobs_ttl=float(os.environ.get('JOBS_TTL', 7 * 24 * 3600)),
+        )
+
+    # --- запуск ---
+
+    def start(self):
+        """
+        Запускает фоновый поток (один раз на процесс, после форка)
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='storage-gc', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        lock_file = open(os.path.join(self.uploads_folder, '.gc.lock'), 'a')
+        if fcntl is not None:
+            # Очистку выполняет только процесс, захвативший блокировку
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(self.interval)
+
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой очистки: {e}")
+            time.sleep(self.interval)
+
+    # --- шаги очистки ---
+
+    def _remove(self, path):
+        while True:
+            retry_after = self._deletes.consume()
+            if not retry_after:
+                break
+            time.sleep(retry_after)
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _walk(self, folder):
+        """
+        Обходит файлы папки рекурсивно, с паузами между порциями.
+        Возвращает пары (entry, stat); файлы, удаленные или переименованные
+        во время обхода (временные файлы записи, фоновое кодирование), пропускаются.
+        """
+        scanned = 0
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            try:
+                entries = list(os.scandir(current))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry, stat
+                scanned += 1
+                if scanned % 1000 == 0:
+                    time.sleep(0.05)
+
+    def clean_temp(self, now):
+        removed = 0
+        for entry, stat in self._walk(self.temp_folder):
+            if now - stat.st_mtime > self.temp_ttl and self._remove(entry.path):
+                removed += 1
+        return removed
+
+    def _metadata_damaged(self):
+        """
+        Есть ли поврежденные снапшоты метаданных, ожидающие восстановления
+        """
+        damaged = False
+        for store in (self.character_generator.characters, self.scene_generator.scenes):
+            for path in store.corrupt_snapshots():
+                logger.warning(f"Удаление сирот пропущено: поврежденный снапшот метаданных {path}")
+                damaged = True
+        return damaged
+
+    def _too_many(self, candidates, total, what):
+        if len(candidates) <= self.ORPHAN_MIN_CHECKED or len(candidates) <= total * self.max_orphan_fraction:
+            return False
+        logger.warning(
+            f"Удаление сирот пропущено: {what} без метаданных {len(candidates)} из {total}, "
+            f"похоже на потерю метаданных"
+        )
+        return True
+
+    def remove_orphan_scenes(self, now):
+        characters = self.character_generator.characters
+        scenes = self.scene_generator.scenes.items()
+        candidates = []
+        for scene_id, scene in scenes:
+            # Сцена принадлежит главному персонажу; остальные исключаются из нее при удалении
+            if scene.get('character_id') in characters:
+                continue
+            try:
+                created = datetime.fromisoformat(scene['created_at']).timestamp()
+            except (KeyError, TypeError, ValueError):
+                created = now
+            if now - created > self.orphan_grace:
+                candidates.append(scene_id)
+
+        if self._too_many(candidates, len(scenes), "сцен"):
+            return 0
+        for scene_id in candidates:
+            self.scene_generator.delete(scene_id)
+        return len(candidates)
+
+    def _referenced_files(self):
+        referenced = set()
+        for character in self.character_generator.characters.values():
+            referenced.update(os.path.abspath(p) for p in self.character_generator.character_files(character))
+        for scene in self.scene_generator.scenes.values():
+            referenced.update(os.path.abspath(p) for p in self.scene_generator.scene_files(scene))
+        return referenced
+
+    def remove_orphan_files(self, now):
+        """
+        Удаляет файлы, на которые не ссылаются метаданные.
+        Возвращает число удаленных файлов и суммарный размер оставшихся.
+        """
+        referenced = self._referenced_files()
+        total_size = 0
+        files = 0
+        candidates = []
+        for folder in (self.character_generator.output_folder, self.scene_generator.output_folder):
+            for entry, stat in self._walk(folder):
+                total_size += stat.st_size
+                # Служебные файлы хранилища метаданных лежат в корне папки
+                if os.path.dirname(entry.path) == folder and '_metadata.json' in entry.name:
+                    continue
+                files += 1
+                if os.path.abspath(entry.path) not in referenced and now - stat.st_mtime > self.orphan_grace:
+                    candidates.append((entry.path, stat.st_size))
+
+        if self._too_many(candidates, files, "файлов"):
+            return 0, total_size
+        removed = 0
+        for path, size in candidates:
+            if self._remove(path):
+                removed += 1
+                total_size -= size
+        return removed, total_size
+
+    def enforce_quota(self, total_size):
+        """
+        Освобождает место, удаляя латенты: их можно потерять без потери данных,
+        пострадает только скорость вариаций
+        """
+        if not self.quota_bytes or total_size <= self.quota_bytes:
+            return 0
+
+        candidates = []
+        for generator, store in ((self.character_generator, self.character_generator.characters),
+                                 (self.scene_generator, self.scene_generator.scenes)):
+            for record_id, record in store.items():
+                if record.get('latents'):
+                    path = os.path.join(generator.output_folder, record['latents'])
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    candidates.append((stat.st_mtime, stat.st_size, path, store, record_id))
+
+        freed = 0
+        for _, size, path, store, record_id in sorted(candidates, key=lambda c: c[0]):
+            if total_size - freed <= self.quota_bytes:
+                break
+            record = store.get(record_id)
+            if record is None:
+                continue
+            record['latents'] = None
+            store.put(record_id, record)
+            if self._remove(path):
+                freed += size
+
+        if total_size - freed > self.quota_bytes:
+            logger.warning(f"Превышена квота на диск: {(total_size - freed) // (1024 * 1024)} МБ")
+        return freed
+
+    def run_once(self):
+        """
+        Выполняет один проход очистки и возвращает статистику
+        """
+        now = time.time()
+        stats = {"temp_removed": self.clean_temp(now), "scenes_removed": 0, "orphans_removed": 0}
+        if self._metadata_damaged():
+            total_size = sum(
+                stat.st_size
+                for folder in (self.character_generator.output_folder, self.scene_generator.output_folder)
+                for _, stat in self._walk(folder)
+            )
+        else:
+            stats["scenes_removed"] = self.remove_orphan_scenes(now)
+            stats["orphans_removed"], total_size = self.remove_orphan_files(now)
+        stats["quota_freed"] = self.enforce_quota(total_size)
+        stats["total_size"] = total_size - stats["quota_freed"]
+        stats["indexed"] = self.character_generator.index_missing()
+        stats["jobs_removed"] = self.jobs.remove_expired(self.jobs_ttl, now) if self.jobs is not None else 0
+        self.last_run = {"finished_at": time.time(), **stats}
+        if any(stats[key] for key in ("temp_removed", "scenes_removed", "orphans_removed", "quota_freed",
+                                      "indexed", "jobs_removed")):
+            logger.info(f"Фоновая очистка: {stats}")
+        return stats
@@ -52,7 +52,7 @@ REM Активация виртуального окружения и устан
 echo [INFO] Установка Python-зависимостей...
 cd backend
 call venv\Scripts\activate.bat
-pip install flask flask-cors Pillow requests
+pip install flask flask-cors Pillow numpy requests waitress
 echo [INFO] Python-зависимости установлены
 
 REM Создание необходимых папок
@@ -63,7 +63,7 @@ if not exist uploads\temp mkdir uploads\temp
 
 REM Запуск бэкенда в фоновом режиме
 echo [INFO] Запуск бэкенда...
-start cmd /k "venv\Scripts\activate.bat && python app.py"
+start cmd /k "venv\Scripts\activate.bat && python serve.py"
 
 REM Переход к настройке фронтенда
 cd ..
@@ -49,7 +49,7 @@ fi
 echo "[INFO] Установка Python-зависимостей..."
 cd backend
 source venv/bin/activate
-pip install flask flask-cors Pillow requests
+pip install flask flask-cors Pillow numpy requests gunicorn
 echo "[INFO] Python-зависимости установлены"
 
 # Создание необходимых папок
@@ -59,7 +59,7 @@ mkdir -p uploads/temp
 
 # Запуск бэкенда в фоновом режиме
 echo "[INFO] Запуск бэкенда..."
-(source venv/bin/activate && python app.py) &
+(source venv/bin/activate && python serve.py) &
 BACKEND_PID=$!
 
 # Переход к настройке фронтенда